@@ -1,40 +1,25 @@
 """
 Inspectors
 """
-import os
-import glob
+import copy
+import asyncio
 import logging
 import asyncssh
 
 from cuvette.utils import find_all_sub_module, load_all_sub_module
 from cuvette.utils.parameters import get_all_parameters
+from cuvette.inspectors.ssh import SSHPool, BatchedConnection
+from cuvette.inspectors.host_cache import HostCache
 
 logger = logging.getLogger(__name__)
 
-__all__ = find_all_sub_module(__file__, exclude=['base'])
-Inspectors = dict((k, v.Inspector()) for k, v in load_all_sub_module(__name__).items())
-
-
-SSH_USER = 'root'
-SSH_PASSWORD = 'redhat'
+# Limits for inspecting many machines at once
+INSPECT_CONCURRENCY = 32
+INSPECT_CONCURRENCY_PER_LAB = 8
+INSPECT_TIMEOUT = 300
 
-
-def load_all_keys():
-    key_files = glob.glob(
-        os.path.join(os.path.dirname(__file__), '..') + "/keys/*")
-    user_key_files = [os.path.expanduser(file_) for file_ in [
-        '~/.ssh/id_ed25519',
-        '~/.ssh/id_ecdsa',
-        '~/.ssh/id_rsa',
-        '~/.ssh/id_dsa'
-    ]]
-    keys = []
-    for file_ in key_files + user_key_files:
-        try:
-            keys.append(asyncssh.read_private_key(file_))
-        except Exception:
-            pass
-    return keys
+__all__ = find_all_sub_module(__file__, exclude=['base', 'ssh', 'host_cache'])
+Inspectors = dict((k, v.Inspector()) for k, v in load_all_sub_module(__name__).items())
 
 
 Parameters = get_all_parameters(Inspectors.values(), 'inspectors',
@@ -42,19 +27,68 @@ Parameters = get_all_parameters(Inspectors.values(), 'inspectors',
                                 conflict=True)
 
 
-async def perform_check(machine):
+async def perform_check(machine, force=False):
+    """
+    Inspect a machine, cached facts of the host are used unless force is True
+
+    Inspectors only write to the local machine object, fields they
+    changed are saved to the pool once the inspection is done.
+    """
+    before = copy.deepcopy(dict(machine))
     try:
-        async with asyncssh.connect(machine['hostname'],
-                                    known_hosts=None,
-                                    username=SSH_USER,
-                                    password=SSH_PASSWORD,
-                                    client_keys=load_all_keys()
-                                    ) as conn:
+        async with SSHPool.connection(machine['hostname']) as conn:
             # TODO: Disabled host key checking
             # TODO: Accept password
             # TODO: Accept username
-            for ins in Inspectors.values():
-                await ins.inspect(machine, conn)
+            conn = BatchedConnection(conn)
+            host_cache = await HostCache.load(machine, conn, force)
+            inspectors = host_cache.apply(machine, conn, list(Inspectors.values()))
+            await conn.prefetch([command for ins in inspectors for command in ins.COMMANDS])
+            await asyncio.gather(*[ins.inspect(machine, conn) for ins in inspectors])
+            await host_cache.save(machine, conn, inspectors)
     except (OSError, asyncssh.Error) as error:
         logger.exception('Failed inspecting machine %s with exception:', machine)
         await machine.fail()
+        return
+    await save_inspected(machine, before)
+
+
+async def save_inspected(machine, before):
+    """
+    Save top level fields of a machine which changed since before
+    """
+    changed = dict((key, value) for key, value in machine.items()
+                   if key != '_id' and (key not in before or before[key] != value))
+    removed = [key for key in before if key not in machine]
+    if changed:
+        await machine.set(changed)
+    if removed:
+        await machine.unset(removed)
+
+
+async def perform_checks(machines, concurrency=INSPECT_CONCURRENCY,
+                         concurrency_per_lab=INSPECT_CONCURRENCY_PER_LAB,
+                         timeout=INSPECT_TIMEOUT, force=False):
+    """
+    Inspect a group of machines concurrently, with a global concurrency limit,
+    a limit for each lab controller, and a timeout for each host.
+    """
+    global_semaphore = asyncio.Semaphore(concurrency)
+    lab_semaphores = {}
+
+    async def check(machine):
+        lab_semaphore = lab_semaphores.setdefault(
+            machine.get('lab_controller'), asyncio.Semaphore(concurrency_per_lab))
+        async with lab_semaphore:
+            async with global_semaphore:
+                try:
+                    await asyncio.wait_for(perform_check(machine, force), timeout=timeout)
+                except asyncio.TimeoutError:
+                    logger.error('Inspecting machine %s timed out after %ss', machine.get('hostname'), timeout)
+                    await machine.fail('Inspection timeout')
+                except Exception as error:
+                    logger.exception('Failed inspecting machine %s with exception:', machine)
+                    await machine.fail(error)
+
+    if machines:
+        await asyncio.wait([check(machine) for machine in machines])
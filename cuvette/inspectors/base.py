@@ -5,6 +5,7 @@ import abc
 import logging
 
 from asyncssh.connection import SSHConnection
+from cuvette.utils.matcher import compile_query
 
 logger = logging.getLogger(__name__)
 
@@ -12,35 +13,19 @@ logger = logging.getLogger(__name__)
 def flat_match(self, machine, query: dict):
     """
     Flat compare, this could be used as a helper.
-    """
-    OPERATE_MAP = {
-        '$eq': lambda x, val: x == val,
-        '$in': lambda x, val: x in val,
-        '$lt': lambda x, val: x < val,
-        '$lte': lambda x, val: x <= val,
-        '$gt': lambda x, val: x > val,
-        '$gte': lambda x, val: x >= val,
-    }
 
-    for prop, meta in self.PARAMETERS.items():
-        if prop not in query.keys():
+    Only keys in PARAMETERS are compared, the query is compiled
+    into a python function (cached per query shape) by compile_query.
+    """
+    flat_query = {}
+    for prop, value in query.items():
+        if prop not in self.PARAMETERS:
             continue
         if prop not in machine.keys():
             logger.error("Machine don't have prop %s, machine content %s", prop, machine)
             continue
-
-        # op is None for plain value
-        for op, value in query[prop].items()\
-                if isinstance(query[prop], dict) else {None: query[prop]}:
-            # Use default op specified by inspector (or 'eq') if None is given
-            op = op or meta.get('default_op', 'eq')
-
-            if OPERATE_MAP.get(op) is None:
-                logger.error('Unknown operation: "%s"', query[prop][0])
-            elif OPERATE_MAP.get(op)(machine['prop'], query[prop][1]) is False:
-                return False
-
-    return True
+        flat_query[prop] = value
+    return compile_query(flat_query)(machine)
 
 
 def flat_filter(self, query: dict):
@@ -59,9 +44,13 @@ def flat_filter(self, query: dict):
 
         if isinstance(query[prop], dict):
             ret[prop] = query[prop]
+            continue
 
         op = meta.get('default_op', None)
-        if op:
+        if meta.get('type') is list and isinstance(query[prop], list):
+            # Machine should have all listed values
+            ret[prop] = {'$all': query[prop]}
+        elif op:
             ret[prop] = {op: query[prop]}
         else:
             ret[prop] = query[prop]
@@ -78,6 +67,22 @@ class InspectorBase(object, metaclass=abc.ABCMeta):
     """
     What parameters are provided by this Inspector
     """
+    HARDWARE_FACTS = []
+    """
+    Fields set by this Inspector that never change for a host, if all of them
+    are cached for the host, inspect() could be skipped.
+    """
+    COMMANDS = []
+    """
+    Commands inspect() will run, they are collected for all inspectors
+    with one exec before inspect() is called, conn.run() of these
+    commands returns the collected output.
+    """
+    RUNTIME_COMMANDS = []
+    """
+    Commands in COMMANDS with output may change without a reboot, they
+    are never cached for the host.
+    """
     def __init__(self):
         """
         Do some self check or setup code here.
@@ -90,6 +95,9 @@ class InspectorBase(object, metaclass=abc.ABCMeta):
 
         ssh connection is managed outside this function so each
         inspector have their own ssh context for cleaner detection.
+
+        Inspectors run concurrently on the same connection, other
+        commands not listed in COMMANDS run as a new channel.
         """
         pass
 
@@ -110,17 +118,16 @@ class InspectorBase(object, metaclass=abc.ABCMeta):
             ...
         }
 
-        Use flat_match for built-in native python type compare.
+        Use flat_match for built-in native python type compare, see
+        cuvette.utils.matcher for supported operations.
 
         This function should return immediately, and it should be considered
         an error if any machine prop is absent, cause inspect() is async and
         time comsuming, but match should alway return immediately, inspect()
         should always be called before match().
 
-        # TODO
-        For better performance, use create_filter to create a filter to make use
-        of MongoDB's index. We keep the query mongodb style to make it easier to
-        pass it to mongodb.
+        We keep the query mongodb style so the same query could be passed
+        to mongodb or evaluated in memory.
         """
         return flat_match(self, machine, query)
 
@@ -135,12 +142,13 @@ class InspectorBase(object, metaclass=abc.ABCMeta):
 
     def soft_filter(self, query: dict):
         """
-        Filter out machines by soft limits, not used yet.
+        Filter out machines by soft limits,
 
         This should return a mongodb query which filters all machine
-        don't meet but CAN be transformed to meet the query condition.
+        don't meet and CAN'T be transformed to meet the query condition,
+        same as hard_filter unless some parameters could be transformed.
         """
-        return flat_filter(self, query)
+        return self.hard_filter(query)
 
     def provision_filter(self, query: dict):
         """
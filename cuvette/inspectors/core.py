@@ -58,6 +58,8 @@ class Inspector(InspectorBase):
         },
     }
 
+    COMMANDS = ['cat /proc/cpuinfo']
+
     async def inspect(self: InspectorBase, machine, conn):
         """
         This inspector won't detect anything as all properties should be provide by provisioner
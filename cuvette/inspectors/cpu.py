@@ -44,6 +44,10 @@ class Inspector(InspectorBase):
         },
     }
 
+    HARDWARE_FACTS = ['cpu-arch', 'cpu-vendor', 'cpu-model']
+
+    COMMANDS = ['lscpu']
+
     async def inspect(self, machine, conn):
         res = await conn.run('lscpu')
         res_dict = dict([
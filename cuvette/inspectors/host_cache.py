@@ -0,0 +1,117 @@
+"""
+Per host inspection cache
+
+Stored in the hosts collection, keyed by hostname:
+- When the fingerprint of a host (boot id, machine id, distro and
+  provision start time) is unchanged, cached outputs of inspector
+  COMMANDS are reused so they are not run again. RUNTIME_COMMANDS
+  (eg. /proc/meminfo) change without a reboot and are never cached.
+- Hardware facts are reused across provisions of the same host,
+  inspectors with all HARDWARE_FACTS cached are skipped.
+
+Both expire after HOST_CACHE_TTL, or can be ignored with force=True.
+"""
+import hashlib
+import logging
+import datetime
+
+from cuvette.mongodb import get_host_collection
+from cuvette.inspectors.ssh import BatchedResult
+
+logger = logging.getLogger(__name__)
+
+HOST_CACHE_TTL = 604800
+
+FINGERPRINT_COMMANDS = [
+    'cat /proc/sys/kernel/random/boot_id',
+    'cat /etc/machine-id',
+]
+
+FINGERPRINT_FIELDS = ['beaker-distro', 'start_time']
+
+
+class HostCache(object):
+    def __init__(self, db, hostname, fingerprint, host=None):
+        self.db = db
+        self.hostname = hostname
+        self.fingerprint = fingerprint
+        self.host = host
+        self.hit = False
+
+    @classmethod
+    async def load(cls, machine, conn, force=False):
+        """
+        Compute the fingerprint of a machine and load the cache of its host
+        """
+        await conn.prefetch(FINGERPRINT_COMMANDS)
+        sha1 = hashlib.sha1()
+        for command in FINGERPRINT_COMMANDS:
+            sha1.update((await conn.run(command)).stdout.strip().encode('utf8'))
+        for field in FINGERPRINT_FIELDS:
+            sha1.update(str(machine.get(field)).encode('utf8'))
+        fingerprint = sha1.hexdigest()
+
+        host = None
+        if not force:
+            host = await get_host_collection(machine.db).find_one({
+                'hostname': machine['hostname'],
+                'updated': {
+                    '$gte': datetime.datetime.now() - datetime.timedelta(seconds=HOST_CACHE_TTL)
+                }
+            })
+        return cls(machine.db, machine['hostname'], fingerprint, host)
+
+    def apply(self, machine, conn, inspectors):
+        """
+        Apply cached data, return inspectors still need to run
+        """
+        if not self.host:
+            return inspectors
+
+        if self.host.get('fingerprint') == self.fingerprint:
+            self.hit = True
+            for output in self.host.get('outputs', []):
+                conn.results.setdefault(output['command'], BatchedResult(
+                    output['command'], output['stdout'], output.get('exit_status', 0)))
+
+        facts = self.host.get('facts', {})
+        remaining = []
+        for inspector in inspectors:
+            if inspector.HARDWARE_FACTS and all(fact in facts for fact in inspector.HARDWARE_FACTS):
+                for fact in inspector.HARDWARE_FACTS:
+                    machine.setdefault(fact, facts[fact])
+            else:
+                remaining.append(inspector)
+        return remaining
+
+    async def save(self, machine, conn, inspectors):
+        """
+        Save facts and command outputs of a freshly inspected machine
+        """
+        if self.hit:
+            return
+        facts = {}
+        outputs = []
+        for inspector in inspectors:
+            for fact in inspector.HARDWARE_FACTS:
+                if machine.get(fact) is not None:
+                    facts[fact] = machine[fact]
+            for command in inspector.COMMANDS:
+                if command in inspector.RUNTIME_COMMANDS:
+                    continue
+                result = conn.results.get(command)
+                if result is not None:
+                    outputs.append({
+                        'command': command,
+                        'stdout': result.stdout,
+                        'exit_status': result.exit_status,
+                    })
+        update = {
+            'fingerprint': self.fingerprint,
+            'outputs': outputs,
+            'updated': datetime.datetime.now(),
+        }
+        for fact, value in facts.items():
+            update['facts.{}'.format(fact)] = value
+        await get_host_collection(self.db).update_one(
+            {'hostname': self.hostname}, {'$set': update}, upsert=True)
@@ -1,7 +1,7 @@
 """
 Inspect a machine's CPU
 """
-from cuvette.inspectors.base import InspectorBase
+from cuvette.inspectors.base import InspectorBase, flat_filter
 
 
 class Inspector(InspectorBase):
@@ -13,7 +13,27 @@ class Inspector(InspectorBase):
             "type": int,
             "description": "Memory size in MB"
         },
+        "memory-hugepages": {
+            "type": int,
+            "description": "Number of hugepages reserved"
+        },
     }
 
+    COMMANDS = ['cat /proc/meminfo']
+
+    # Hugepages could be reserved by transformers
+    RUNTIME_COMMANDS = ['cat /proc/meminfo']
+
     async def inspect(cls, machine, conn):
-        pass
+        res = await conn.run('cat /proc/meminfo')
+        for line in res.stdout.splitlines():
+            if line.startswith('HugePages_Total:'):
+                machine['memory-hugepages'] = int(line.split(':', 1)[1])
+
+    def soft_filter(self, query: dict):
+        """
+        Hugepages could be reserved by transformers
+        """
+        query = dict(query)
+        query.pop('memory-hugepages', None)
+        return flat_filter(self, query)
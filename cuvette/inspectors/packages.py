@@ -0,0 +1,28 @@
+"""
+Inspect a machine's packages
+"""
+from cuvette.inspectors.base import InspectorBase
+
+
+class Inspector(InspectorBase):
+    """
+    Track packages installed by provisioners and transformers
+    """
+    PARAMETERS = {
+        "packages": {
+            "type": list,
+            "description": "Packages need to be installed",
+        },
+    }
+
+    async def inspect(self: InspectorBase, machine, conn):
+        """
+        Do nothing
+        """
+        machine.setdefault('packages', [])
+
+    def soft_filter(self, query: dict):
+        """
+        Packages could be installed by transformers
+        """
+        return {}
@@ -0,0 +1,322 @@
+"""
+SSH connection pool for inspectors
+
+Keep one connection per host and reuse it between inspections,
+connections are closed after idling for a while or when the machine
+is teared down.
+"""
+import os
+import glob
+import time
+import uuid
+import asyncio
+import logging
+import asyncssh
+
+logger = logging.getLogger(__name__)
+
+SSH_USER = 'root'
+SSH_PASSWORD = 'redhat'
+
+IDLE_TIMEOUT = 300
+
+MAX_CONNECTIONS = 64
+
+# Run a dummy command before reusing a connection idled for longer than this
+HEALTH_CHECK_INTERVAL = 60
+
+_keys = None
+
+
+def load_all_keys(reload=False):
+    """
+    Load all private keys, keys are only read from disk once unless reload is True
+    """
+    global _keys
+    if _keys is not None and not reload:
+        return _keys
+    key_files = glob.glob(
+        os.path.join(os.path.dirname(__file__), '..') + "/keys/*")
+    user_key_files = [os.path.expanduser(file_) for file_ in [
+        '~/.ssh/id_ed25519',
+        '~/.ssh/id_ecdsa',
+        '~/.ssh/id_rsa',
+        '~/.ssh/id_dsa'
+    ]]
+    keys = []
+    for file_ in key_files + user_key_files:
+        try:
+            keys.append(asyncssh.read_private_key(file_))
+        except Exception:
+            pass
+    _keys = keys
+    return keys
+
+
+class PooledConnection(object):
+    """
+    A pooled connection and its usage info
+    """
+    def __init__(self, hostname, conn):
+        self.hostname = hostname
+        self.conn = conn
+        self.users = 0
+        self.closed = False
+        self.last_used = time.monotonic()
+        self.idle_handle = None
+
+
+class PooledClient(asyncssh.SSHClient):
+    """
+    Drop the connection from pool when it's lost
+    """
+    def __init__(self, pool, hostname):
+        self.pool = pool
+        self.hostname = hostname
+        self.pooled = None
+
+    def connection_lost(self, exc):
+        if self.pooled is not None:
+            self.pool._forget(self.pooled)
+
+
+class SSHConnectionPool(object):
+    def __init__(self, max_connections=MAX_CONNECTIONS, idle_timeout=IDLE_TIMEOUT,
+                 health_check_interval=HEALTH_CHECK_INTERVAL):
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.connections = {}
+        self._connecting = {}
+        self._semaphore = None
+        self.stats = {
+            'handshakes': 0,
+            'handshake_time': 0.0,
+            'reuses': 0,
+            'evictions': 0,
+            'health_check_failures': 0,
+        }
+
+    @property
+    def semaphore(self):
+        # Created lazily so it's binded to the running loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_connections)
+        return self._semaphore
+
+    def get_stats(self):
+        ret = dict(self.stats)
+        handshakes = ret['handshakes']
+        average = ret['handshake_time'] / handshakes if handshakes else 0.0
+        ret['connections'] = len(self.connections)
+        ret['handshake_time_saved'] = average * ret['reuses']
+        return ret
+
+    def _forget(self, pooled):
+        """
+        Drop a connection from the pool, a newer connection to the
+        same host is kept, the slot is released only once.
+        """
+        if self.connections.get(pooled.hostname) is pooled:
+            del self.connections[pooled.hostname]
+        if not pooled.closed:
+            pooled.closed = True
+            if pooled.idle_handle:
+                pooled.idle_handle.cancel()
+            self.semaphore.release()
+
+    def _close(self, pooled):
+        self._forget(pooled)
+        pooled.conn.close()
+
+    def _evict_idle(self):
+        """
+        Close the least recently used idle connection, return False if there is none
+        """
+        idle = [pooled for pooled in self.connections.values() if pooled.users == 0]
+        if not idle:
+            return False
+        self._close(min(idle, key=lambda pooled: pooled.last_used))
+        self.stats['evictions'] += 1
+        return True
+
+    async def _connect(self, hostname):
+        if self.semaphore.locked():
+            self._evict_idle()
+        await self.semaphore.acquire()
+        started = time.monotonic()
+        try:
+            conn, client = await asyncssh.create_connection(
+                lambda: PooledClient(self, hostname), hostname,
+                known_hosts=None,
+                username=SSH_USER,
+                password=SSH_PASSWORD,
+                client_keys=load_all_keys())
+        except BaseException:
+            self.semaphore.release()
+            raise
+        self.stats['handshakes'] += 1
+        self.stats['handshake_time'] += time.monotonic() - started
+        pooled = client.pooled = self.connections[hostname] = PooledConnection(hostname, conn)
+        return pooled
+
+    async def _is_healthy(self, pooled):
+        if time.monotonic() - pooled.last_used < self.health_check_interval:
+            return True
+        try:
+            await asyncio.wait_for(pooled.conn.run('true'), timeout=10)
+        except (OSError, asyncssh.Error, asyncio.TimeoutError):
+            self.stats['health_check_failures'] += 1
+            return False
+        return True
+
+    async def acquire(self, hostname):
+        pooled = self.connections.get(hostname)
+        if pooled is not None:
+            if pooled.idle_handle:
+                pooled.idle_handle.cancel()
+                pooled.idle_handle = None
+            pooled.users += 1
+            if await self._is_healthy(pooled):
+                self.stats['reuses'] += 1
+                pooled.last_used = time.monotonic()
+                return pooled
+            pooled.users -= 1
+            self._close(pooled)
+
+        # Only one handshake for concurrent acquire of the same host
+        connecting = self._connecting.get(hostname)
+        if connecting is None:
+            connecting = self._connecting[hostname] = asyncio.ensure_future(self._connect(hostname))
+            try:
+                pooled = await connecting
+            finally:
+                self._connecting.pop(hostname, None)
+        else:
+            pooled = await asyncio.shield(connecting)
+            self.stats['reuses'] += 1
+        pooled.users += 1
+        pooled.last_used = time.monotonic()
+        return pooled
+
+    def release(self, pooled):
+        pooled.users -= 1
+        pooled.last_used = time.monotonic()
+        if pooled.users == 0 and not pooled.closed:
+            pooled.idle_handle = asyncio.get_event_loop().call_later(
+                self.idle_timeout, self._close, pooled)
+
+    def evict(self, hostname):
+        """
+        Close the connection to a host, eg. when it's teared down
+        """
+        pooled = self.connections.get(hostname)
+        if pooled is not None:
+            self._close(pooled)
+            self.stats['evictions'] += 1
+
+    def close(self):
+        for pooled in list(self.connections.values()):
+            self._close(pooled)
+
+    def connection(self, hostname):
+        """
+        Borrow a connection with:
+
+            async with SSHPool.connection(hostname) as conn:
+                await conn.run('lscpu')
+        """
+        return BorrowedConnection(self, hostname)
+
+
+class BorrowedConnection(object):
+    def __init__(self, pool, hostname):
+        self.pool = pool
+        self.hostname = hostname
+        self.pooled = None
+
+    async def __aenter__(self):
+        self.pooled = await self.pool.acquire(self.hostname)
+        return self.pooled.conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.pool.release(self.pooled)
+        if exc_type is not None and issubclass(exc_type, (OSError, asyncssh.Error)):
+            # Connection might be broken, don't reuse it
+            self.pool.evict(self.hostname)
+
+
+class BatchedResult(object):
+    """
+    Result of a command ran in a batched script, mimic SSHCompletedProcess
+    """
+    def __init__(self, command, stdout, exit_status):
+        self.command = command
+        self.stdout = stdout
+        self.stderr = ''
+        self.exit_status = exit_status
+
+
+def build_batch_script(commands, marker):
+    """
+    Build one shell script running all commands, each output section
+    is wrapped by marker lines so they could be splited later, the end
+    marker always starts a new line, output without a trailing newline
+    is kept as is.
+    """
+    lines = []
+    for idx, command in enumerate(commands):
+        lines.append("echo '{} begin {}'".format(marker, idx))
+        lines.append("( {} ) 2>/dev/null".format(command))
+        lines.append("printf '\\n{} end {} %s\\n' \"$?\"".format(marker, idx))
+    return '\n'.join(lines)
+
+
+def parse_batch_output(commands, output, marker):
+    """
+    Split output of a batched script into {command: BatchedResult}
+    """
+    ret = {}
+    for idx, command in enumerate(commands):
+        begin = '{} begin {}\n'.format(marker, idx)
+        end = '\n{} end {} '.format(marker, idx)
+        start = output.find(begin)
+        if start < 0:
+            continue
+        start += len(begin)
+        stop = output.find(end, start)
+        if stop < 0:
+            continue
+        exit_status = output[stop + len(end):].split('\n', 1)[0]
+        ret[command] = BatchedResult(command, output[start:stop], int(exit_status))
+    return ret
+
+
+class BatchedConnection(object):
+    """
+    Wrap a SSH connection, commands known ahead are collected with one
+    exec by prefetch(), run() of these commands returns the collected
+    output, other commands run as a new channel of the same connection.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.results = {}
+
+    async def prefetch(self, commands):
+        commands = [command for command in dict.fromkeys(commands) if command not in self.results]
+        if not commands:
+            return
+        marker = '__cuvette_{}__'.format(uuid.uuid4().hex)
+        res = await self.conn.run(build_batch_script(commands, marker))
+        self.results.update(parse_batch_output(commands, res.stdout, marker))
+
+    async def run(self, command, *args, **kwargs):
+        if command in self.results and not args and not kwargs:
+            return self.results[command]
+        return await self.conn.run(command, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+SSHPool = SSHConnectionPool()
@@ -5,16 +5,38 @@ Use MongoDB collection as the main machine pool,
 every machine object stored in it is "in the pool"
 """
 import uuid
+import asyncio
 import logging
 
 from datetime import datetime
 from motor.motor_asyncio import AsyncIOMotorCollection
 
 from cuvette.mongodb import get_machine_collection
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 from pymongo.collection import ReturnDocument
 
 logger = logging.getLogger(__name__)
 
+# Default flush window in seconds for write behind mode
+WRITE_BEHIND_WINDOW = 1
+
+# Counters of buffered update operations and the real updates sent to the pool
+WRITE_STATS = {
+    'buffered': 0,
+    'flushed': 0,
+}
+
+
+def write_stats():
+    """
+    Return write behind counters, 'saved' is how many round trips are
+    merged away by the buffer.
+    """
+    ret = dict(WRITE_STATS)
+    ret['saved'] = max(ret['buffered'] - ret['flushed'], 0)
+    return ret
+
 
 class UpdateDict(dict):
     """
@@ -35,6 +57,23 @@ class UpdateDict(dict):
         self.__updates__ = []
 
 
+class MachineBatch(object):
+    """
+    Async context manager returned by Machine.batch()
+    """
+    def __init__(self, machine):
+        self.machine = machine
+
+    async def __aenter__(self):
+        self.machine._batch_depth += 1
+        return self.machine
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.machine._batch_depth -= 1
+        if self.machine._batch_depth == 0:
+            await self.machine.flush()
+
+
 class Machine(UpdateDict):
     """
     A pure machine model with no logic binded
@@ -45,6 +84,8 @@ class Machine(UpdateDict):
     Operate like a dict and call save() for bulk operation
     Use .set() and .inc(), .dec() etc for atomic operation
     """
+    # Callables called with (machine, deleted) after this process wrote a machine
+    listeners = []
 
     @classmethod
     async def find_all(cls, db, query={}, count=None, pool=None, **kwargs):
@@ -61,6 +102,112 @@ class Machine(UpdateDict):
         pool = pool or get_machine_collection(db)
         return cls(db, await pool.find_one(query, **kwargs))
 
+    @classmethod
+    async def claim(cls, db, query: dict, update: dict, count=1, pool=None):
+        """
+        Atomically set fields of up to count machines matching the query,
+        one find_one_and_update each, so a machine is never claimed twice
+        as long as the update makes it unmatched by the query.
+        """
+        pool = pool or get_machine_collection(db)
+        ret = []
+        for _ in range(count):
+            machine = await pool.find_one_and_update(
+                query, {'$set': update}, return_document=ReturnDocument.AFTER)
+            if machine is None:
+                break
+            machine = cls(db, machine)
+            machine._notify()
+            ret.append(machine)
+        return ret
+
+    @classmethod
+    async def find_all_tasks(cls, db, pool=None):
+        """
+        Collect all tasks in the pool with one aggregation,
+        return a list of (task_uuid, task, machines) tuple.
+
+        One task may be assigned to multiple machines, they are grouped together.
+        """
+        pool = pool or get_machine_collection(db)
+        ret = []
+        for group in await pool.aggregate([
+            {'$match': {'tasks': {'$gt': {}}}},
+            {'$addFields': {'_task': {'$objectToArray': '$tasks'}}},
+            {'$unwind': '$_task'},
+            {'$group': {
+                '_id': '$_task.k',
+                'task': {'$first': '$_task.v'},
+                'machines': {'$push': '$$ROOT'},
+            }},
+        ]).to_list(None):
+            machines = []
+            for machine in group['machines']:
+                machine.pop('_task', None)
+                machines.append(cls(db, machine))
+            ret.append((group['_id'], group['task'], machines))
+        return ret
+
+    @classmethod
+    async def bulk_update(cls, machines, op, fields, check=True):
+        """
+        Apply the same update operation to a group of machines with one
+        unordered bulk_write, so the cost don't grow with machine number.
+
+        Machines in batch/write behind mode get the update buffered instead.
+        """
+        direct = []
+        for machine in machines:
+            if machine._buffering():
+                await machine._update(op, dict(fields), check=check)
+            else:
+                direct.append(machine)
+        if not direct:
+            return None
+
+        try:
+            result = await get_machine_collection(direct[0].db).bulk_write([
+                UpdateOne(machine._ident(), {op: fields}) for machine in direct
+            ], ordered=False)
+        except BulkWriteError as error:
+            for write_error in error.details.get('writeErrors', []):
+                logger.error('Failed updating machine %s: %s',
+                             direct[write_error['index']], write_error.get('errmsg'))
+            raise RuntimeError("Failed updating {} machine(s)".format(len(error.details.get('writeErrors', []))))
+
+        for machine in direct:
+            for key, value in fields.items():
+                machine._apply_local(op, key, value)
+            machine._notify()
+
+        if result.matched_count != len(direct):
+            raise RuntimeError("{} of machines {} was deleted while accessing".format(
+                len(direct) - result.matched_count, direct))
+
+        if check:
+            for machine in direct:
+                await machine.self_check()
+
+        return result
+
+    @classmethod
+    async def bulk_set(cls, machines, update, value=None):
+        """
+        Like set(), but for a group of machines
+        """
+        if isinstance(update, dict) and value is None:
+            return await cls.bulk_update(machines, '$set', dict(update))
+        else:
+            return await cls.bulk_update(machines, '$set', {update: value})
+
+    @classmethod
+    async def bulk_unset(cls, machines, key):
+        """
+        Like unset(), but for a group of machines
+        """
+        keys = key if isinstance(key, list) else [key]
+        return await cls.bulk_update(machines, '$unset', dict([(key, "") for key in keys]))
+
     @classmethod
     async def create_one(cls, db, query={}, pool=None, **kwargs):
         return cls(db, await pool.find_one(query, **kwargs))
@@ -84,10 +231,22 @@ class Machine(UpdateDict):
         self.update(kwargs)
 
         self.db = db
+        self._pending = {'$set': {}, '$unset': {}, '$inc': {}}
+        self._batch_depth = 0
+        self._write_behind_window = None
+        self._flush_handle = None
+        self._flush_lock = None
 
     def __setitem__(self, item, value):
         dict.__setitem__(self, item, value)
 
+    def _notify(self, deleted=False):
+        for listener in self.listeners:
+            try:
+                listener(self, deleted)
+            except Exception:
+                logger.exception('Machine listener %s failed', listener)
+
     def _ident(self):
         """
         Filter used to get this object from mongodb pool
@@ -122,27 +281,193 @@ class Machine(UpdateDict):
                 ret[key] = value
         return ret
 
-    async def inc(self, key, value=1):
+    def batch(self):
+        """
+        Buffer every set/unset/inc/dec issued inside the block and
+        flush them with a single update when the block exits:
+
+            async with machine.batch():
+                await machine.set('status', 'preparing')
+                await machine.set('meta.beaker-pull_count', 0)
+
+        Local content is updated immediately, so reads inside the
+        block still see the new values.
+        """
+        return MachineBatch(self)
+
+    def write_behind(self, window=WRITE_BEHIND_WINDOW):
+        """
+        Keep buffering updates and flush them in background at most
+        once every `window` seconds, call again with window=None to
+        turn it off (pending updates are flushed by flush()).
+        """
+        self._write_behind_window = window
+
+    def _buffering(self):
+        return self._batch_depth > 0 or self._write_behind_window is not None
+
+    def _apply_local(self, op, key, value):
+        """
+        Apply an update operation on local content, "." in key is
+        treated as nested object like MongoDB does.
+        """
+        node = self
+        path = key.split('.')
+        for name in path[:-1]:
+            child = node.get(name)
+            if not isinstance(child, dict):
+                if op == '$unset':
+                    return
+                child = node[name] = {}
+            node = child
+        if op == '$set':
+            node[path[-1]] = value
+        elif op == '$unset':
+            node.pop(path[-1], None)
+        elif op == '$inc':
+            node[path[-1]] = node.get(path[-1], 0) + value
+
+    def _merge_pending(self, op, fields):
+        """
+        Merge given operation into pending update document without
+        touching local content.
+        """
+        for key, value in fields.items():
+            for pending_fields in self._pending.values():
+                for pending in list(pending_fields.keys()):
+                    if pending.startswith(key + '.'):
+                        # Overwritten by a update on the parent path
+                        if op != '$inc':
+                            del pending_fields[pending]
+
+            if op == '$inc':
+                if key in self._pending['$set']:
+                    self._pending['$set'][key] += value
+                elif key in self._pending['$unset']:
+                    del self._pending['$unset'][key]
+                    self._pending['$set'][key] = value
+                else:
+                    self._pending['$inc'][key] = self._pending['$inc'].get(key, 0) + value
+            else:
+                for other_op in ('$set', '$unset', '$inc'):
+                    if other_op != op:
+                        self._pending[other_op].pop(key, None)
+                self._pending[op][key] = value
+
+    @staticmethod
+    def _get_path(node, key):
+        for name in key.split('.'):
+            if not isinstance(node, dict) or name not in node:
+                return None
+            node = node[name]
+        return node
+
+    def _restore_pending(self, update):
+        """
+        Put back updates failed to flush, updates buffered after the
+        flush started are newer so they are merged on top.
+        """
+        newer = self._pending
+        self._pending = {'$set': {}, '$unset': {}, '$inc': {}}
+        for op, fields in update.items():
+            self._merge_pending(op, fields)
+        for op, fields in newer.items():
+            for key, value in fields.items():
+                parents = [pending for pending in list(self._pending['$set']) + list(self._pending['$unset'])
+                           if key.startswith(pending + '.')]
+                if parents:
+                    # Local content already has both, resend the parent as a whole
+                    self._merge_pending('$set', {parents[0]: self._get_path(self, parents[0])})
+                else:
+                    self._merge_pending(op, {key: value})
+
+    async def _buffer(self, op, fields):
+        """
+        Merge given operation into pending update document,
+        pending update on a parent path forces a flush first as MongoDB
+        won't accept conflicting paths in one update.
+        """
+        for key in fields.keys():
+            if any(key.startswith(pending + '.')
+                   for pending_fields in self._pending.values() for pending in pending_fields):
+                await self.flush()
+                break
+
+        for key, value in fields.items():
+            WRITE_STATS['buffered'] += 1
+            self._apply_local(op, key, value)
+        self._merge_pending(op, fields)
+
+        if self._batch_depth == 0 and self._write_behind_window is not None and self._flush_handle is None:
+            loop = asyncio.get_event_loop()
+            self._flush_handle = loop.call_later(
+                self._write_behind_window,
+                lambda: asyncio.ensure_future(self._background_flush()))
+
+    async def _background_flush(self):
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception('Failed flushing buffered updates of machine %s', self)
+
+    async def _update(self, op, fields, check=True):
+        if self._buffering():
+            await self._buffer(op, fields)
+            return
         ret = await get_machine_collection(self.db).find_one_and_update(self._ident(), {
-            '$inc': {
-                key: value
-            }
+            op: fields
         }, return_document=ReturnDocument.AFTER)
         if ret:
             self.update(ret)
+            self._notify()
         else:
             raise RuntimeError("Machine {} was deleted while accessing".format(self))
+        if check:
+            await self.self_check()
 
-    async def dec(self, key, value=1):
-        ret = await get_machine_collection(self.db).find_one_and_update(self._ident(), {
-            '$inc': {
-                key: -value
-            }
-        }, return_document=ReturnDocument.AFTER)
-        if ret:
+    async def flush(self):
+        """
+        Send all buffered updates to the pool with one find_one_and_update.
+
+        Updates buffered while the flush is on its way are kept pending
+        for the next flush, and are put back on failure.
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            update = dict((op, fields) for op, fields in self._pending.items() if fields)
+            if not update:
+                return
+            self._pending = {'$set': {}, '$unset': {}, '$inc': {}}
+            WRITE_STATS['flushed'] += 1
+            try:
+                ret = await get_machine_collection(self.db).find_one_and_update(
+                    self._ident(), update, return_document=ReturnDocument.AFTER)
+            except BaseException:
+                self._restore_pending(update)
+                raise
+            if not ret:
+                self._restore_pending(update)
+                raise RuntimeError("Machine {} was deleted while accessing".format(self))
             self.update(ret)
-        else:
-            raise RuntimeError("Machine {} was deleted while accessing".format(self))
+            # Don't let the response clobber updates buffered during the flush
+            for op, fields in self._pending.items():
+                for key, value in fields.items():
+                    if op == '$inc':
+                        self._apply_local('$set', key, (self._get_path(ret, key) or 0) + value)
+                    else:
+                        self._apply_local(op, key, value)
+            self._notify()
+        await self.self_check()
+
+    async def inc(self, key, value=1):
+        await self._update('$inc', {key: value}, check=False)
+
+    async def dec(self, key, value=1):
+        await self._update('$inc', {key: -value}, check=False)
 
     async def set(self, update, value=None):
         """
@@ -150,20 +475,9 @@ class Machine(UpdateDict):
         eg. set("meta.beaker-pull_count", 0)
         """
         if isinstance(update, dict) and value is None:
-            ret = await get_machine_collection(self.db).find_one_and_update(self._ident(), {
-                '$set': update
-            }, return_document=ReturnDocument.AFTER)
+            await self._update('$set', dict(update))
         else:
-            ret = await get_machine_collection(self.db).find_one_and_update(self._ident(), {
-                '$set': {
-                    update: value
-                }
-            }, return_document=ReturnDocument.AFTER)
-        if ret:
-            self.update(ret)
-        else:
-            raise RuntimeError("Machine {} was deleted while accessing".format(self))
-        await self.self_check()
+            await self._update('$set', {update: value})
 
     async def unset(self, key):
         """
@@ -172,32 +486,16 @@ class Machine(UpdateDict):
         """
         if isinstance(key, list):
             keys = key
-            ret = await get_machine_collection(self.db).find_one_and_update(
-                self._ident(), {
-                    "$unset": dict([(key, "") for key in keys])
-                },
-                return_document=ReturnDocument.AFTER
-            )
+            await self._update('$unset', dict([(key, "") for key in keys]))
         else:
-            ret = await get_machine_collection(self.db).find_one_and_update(
-                self._ident(), {
-                    "$unset": {
-                        key: ""
-                    }
-                },
-                return_document=ReturnDocument.AFTER
-            )
-        if ret:
-            self.update(ret)
-        else:
-            raise RuntimeError("Machine {} was deleted while accessing".format(self))
-        await self.self_check()
+            await self._update('$unset', {key: ""})
 
     async def refresh(self):
         machine = await get_machine_collection(self.db).find_one(self._ident())
         if not machine:
             raise RuntimeError("Machine %s is deleted while some coroutine still attached" % self)
         self.update(machine)
+        self._notify()
 
     async def save(self):
         """
@@ -208,6 +506,7 @@ class Machine(UpdateDict):
             self['_id'] = (await get_machine_collection(self.db)
                            .insert_one(self)).inserted_id
             self.clean_update_history()
+            self._notify()
         else:
             delete = set()
             update = {}
@@ -231,6 +530,7 @@ class Machine(UpdateDict):
                     self._ident(),
                     query
                 )
+                self._notify()
             self.clean_update_history()
 
     async def mark_delete(self):
@@ -245,6 +545,7 @@ class Machine(UpdateDict):
         Delete this machine from all pools
         """
         await get_machine_collection(self.db).delete_one(self._ident())
+        self._notify(deleted=True)
 
     async def fail(self, error=None):
         """
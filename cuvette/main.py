@@ -11,49 +11,78 @@ from aiohttp_session.cookie_storage import EncryptedCookieStorage
 
 from cuvette.middlewares import Middlewares
 from cuvette.settings import Settings
-from cuvette.pool import setup as pool_setup
-from cuvette.views import index, parameters, provisioners, MachineView
+from cuvette.pool import setup as pool_setup, HouseKeepers
+from cuvette.pipeline import IndexedParameters
+from cuvette.views import index, parameters, provisioners, provisioners_rank, indexes, metrics, MachineView
 from cuvette.views.callbacks import tear_me_down, describ_me, release_me
+from cuvette.views.tickets import TicketView
 from cuvette.machine import Machine
-from cuvette.mongodb import setup as mongodb_setup
+from cuvette.mongodb import setup as mongodb_setup, ensure_indexes
 from cuvette.tasks import resume_task
+from cuvette.inspectors import SSHPool
 
 
 THIS_DIR = Path(__file__).parent
 BASE_DIR = THIS_DIR.parent
 
+# How many interrupted tasks are resumed at the same time, resumed runs
+# are not limited as provisions may take hours
+RESUME_CONCURRENCY = 10
+
+
+async def restore_tasks(app: web.Application):
+    """
+    Resume all interrupted tasks, tasks are fetched with one aggregation
+    and resumed concurrently, at most RESUME_CONCURRENCY of them are being
+    resumed at the same time, then they run on their own.
+    """
+    logger = logging.getLogger('cuvette')
+    semaphore = asyncio.Semaphore(RESUME_CONCURRENCY)
+
+    async def resume(uuid, task, machines):
+        async with semaphore:
+            try:
+                await resume_task(uuid, task['type'], task['query'], machines)
+            except Exception:
+                logger.exception('Failed resuming task %s', uuid)
+
+    tasks = await Machine.find_all_tasks(app['db'])
+    logger.info("Restoring %s interrupted tasks...", len(tasks))
+    if tasks:
+        await asyncio.wait([resume(uuid, task, machines) for uuid, task, machines in tasks])
+    logger.info("All interrupted tasks restored.")
+
 
 async def startup(app: web.Application):
     logging.basicConfig(level=logging.DEBUG)
     logger = logging.getLogger('cuvette')
     logger.setLevel(logging.INFO)
     logger.info("Info Cuvette starting...")
+    await ensure_indexes(app['db'], IndexedParameters,
+                         [house_keeper.query() for house_keeper in HouseKeepers])
     pool_setup(asyncio.get_event_loop(), app)
 
     logger.info("Restore Interupted tasks...")
 
-    tasks = {}
-    for machine in await Machine.find_all(app['db']):
-        # There might be duplicated tasks, as one task may assigned to multiple machines
-        tasks.update(machine['tasks'])
-
-    for uuid, task in tasks.items():
-        machines = await Machine.find_all(app['db'], {
-            "tasks.{}".format(uuid): {
-                "$exists": True
-            }
-        })
-        await resume_task(uuid, task['type'], task['query'], machines)
+    # Don't block the server from serving while restoring
+    app['restore_future'] = asyncio.ensure_future(restore_tasks(app))
 
 
 async def cleanup(app: web.Application):
-    pass
+    if app.get('restore_future') is not None and not app['restore_future'].done():
+        app['restore_future'].cancel()
+    if app.get('machine_cache') is not None:
+        app['machine_cache'].stop()
+    SSHPool.close()
 
 
 def setup_routes(app):
     app.router.add_get('/', index, name='index')
     app.router.add_get('/parameters', parameters, name='parameters')
     app.router.add_get('/provisioners', provisioners, name='provisioners')
+    app.router.add_get('/provisioners/rank', provisioners_rank, name='provisioners_rank')
+    app.router.add_get('/indexes', indexes, name='indexes')
+    app.router.add_get('/metrics', metrics, name='metrics')
     app.router.add_get('/machines', MachineView.get, name='machine_get')
     app.router.add_post('/machines', MachineView.post, name='machine_post')
     app.router.add_delete('/machines', MachineView.delete, name='machine_delete')
@@ -61,7 +90,12 @@ def setup_routes(app):
     app.router.add_post('/machines/request', MachineView.request, name='machine_request_post')
     app.router.add_post('/machines/provision', MachineView.provision, name='machine_provision')
     app.router.add_post('/machines/teardown', MachineView.teardown, name='machine_teardown')
+    app.router.add_post('/machines/inspect', MachineView.inspect, name='machine_inspect')
     app.router.add_post('/machines/release', MachineView.release, name='machine_release')
+    app.router.add_post('/tickets', TicketView.post, name='ticket_post')
+    app.router.add_get('/tickets/{ticket}', TicketView.get, name='ticket_get')
+    app.router.add_get('/tickets/{ticket}/events', TicketView.events, name='ticket_events')
+    app.router.add_get('/tickets/{ticket}/ws', TicketView.websocket, name='ticket_websocket')
 
     app.router.add_get('/release_me', release_me, name='release_me')
     app.router.add_get('/describ_me', describ_me, name='describ_me')
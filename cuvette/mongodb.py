@@ -1,4 +1,33 @@
+import logging
+import datetime
+import collections
+
 from motor import motor_asyncio
+from pymongo import ASCENDING
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+# Parameter types worth an index, other types are never used in a filter
+INDEXABLE_TYPES = (str, int, float, bool, list, datetime.datetime)
+
+# Most queries are looking for ready machines, index hardware
+# fields only for them to keep the index small and writes cheap.
+READY_FILTER = {'status': 'ready'}
+
+# Indexes always needed by the pool
+DEFAULT_INDEXES = [
+    ([('magic', ASCENDING)], {'unique': True}),
+    # Not unique, failed and deleted records of a reused host stay for a while
+    ([('hostname', ASCENDING)], {'sparse': True}),
+    ([('status', ASCENDING)], {'name': 'status_ready', 'partialFilterExpression': READY_FILTER}),
+    ([('status', ASCENDING), ('expire_time', ASCENDING)], {}),
+]
+
+RECENT_QUERY_LIMIT = 100
+
+# Query shape -> last seen query, used for explain reports
+RecentQueries = collections.OrderedDict()
 
 
 # Currently we have one main pool for active machines
@@ -6,6 +35,11 @@ def get_machine_collection(db):
     return db.machines
 
 
+# Facts of physical hosts, kept across provisions
+def get_host_collection(db):
+    return db.hosts
+
+
 def setup(settings):
     """
     Setup the database connection, and build pool indexes
@@ -21,7 +55,125 @@ def setup(settings):
 
     db = client[settings.DB_NAME]
 
-    # TODO get_machine_collection(db).create_index("hostname", unique=True) uniq or null
     get_machine_collection(db).create_index("magic", unique=True)
 
     return db
+
+
+def _query_fields(query: dict):
+    """
+    Split fields of a query into equality and range fields
+    """
+    equality, ranges = [], []
+    for key, cond in query.items():
+        if key.startswith('$'):
+            continue
+        if isinstance(cond, dict) and cond and all(op.startswith('$') for op in cond.keys()):
+            if set(cond.keys()) <= {'$eq', '$in', '$all'}:
+                equality.append(key)
+            else:
+                ranges.append(key)
+        else:
+            equality.append(key)
+    return sorted(equality), sorted(ranges)
+
+
+def candidate_indexes(parameters: dict, queries=None):
+    """
+    Build a list of (keys, options) of indexes for given parameters
+    and queries.
+
+    Each query get a compound index with equality fields first and range
+    fields last, each indexable parameter get a partial index for ready machines.
+    """
+    ret = list(DEFAULT_INDEXES)
+    seen = set(tuple(keys) for keys, _ in ret)
+
+    for query in queries or []:
+        equality, ranges = _query_fields(query)
+        keys = [(field, ASCENDING) for field in equality + ranges]
+        if keys and tuple(keys) not in seen:
+            seen.add(tuple(keys))
+            ret.append((keys, {}))
+
+    for name, meta in sorted(parameters.items()):
+        if meta.get('type') not in INDEXABLE_TYPES:
+            continue
+        keys = [(name, ASCENDING)]
+        if tuple(keys) in seen:
+            continue
+        seen.add(tuple(keys))
+        ret.append((keys, {
+            'name': 'ready_{}'.format(name),
+            'partialFilterExpression': READY_FILTER,
+        }))
+    return ret
+
+
+async def ensure_indexes(db, parameters: dict, queries=None):
+    """
+    Create all candidate indexes and the host facts index, failures (eg.
+    conflicting options of an existing index) are logged and won't block
+    the startup.
+    """
+    collection = get_machine_collection(db)
+    try:
+        # Created by older versions, re-provisioning a host would violate it
+        if (await collection.index_information()).get('hostname_1', {}).get('unique'):
+            await collection.drop_index('hostname_1')
+    except OperationFailure as error:
+        logger.error('Failed dropping unique hostname index: %s', error)
+    indexes = [(collection, keys, options) for keys, options in candidate_indexes(parameters, queries)]
+    indexes.append((get_host_collection(db), [('hostname', ASCENDING)], {'unique': True}))
+    created = []
+    for index_collection, keys, options in indexes:
+        try:
+            created.append(await index_collection.create_index(keys, background=True, **options))
+        except OperationFailure as error:
+            logger.error('Failed creating index %s %s: %s', keys, options, error)
+    return created
+
+
+def record_query(query: dict):
+    """
+    Remember a query issued to the pool, so it could be explained later
+    """
+    shape = repr(sorted((key, sorted(cond.keys()) if isinstance(cond, dict) else None)
+                        for key, cond in query.items()))
+    RecentQueries.pop(shape, None)
+    RecentQueries[shape] = query
+    while len(RecentQueries) > RECENT_QUERY_LIMIT:
+        RecentQueries.popitem(last=False)
+
+
+def _plan_stages(plan: dict):
+    """
+    Walk a query plan and yield all stages
+    """
+    yield plan
+    for child in plan.get('inputStages', []):
+        for stage in _plan_stages(child):
+            yield stage
+    if 'inputStage' in plan:
+        for stage in _plan_stages(plan['inputStage']):
+            yield stage
+
+
+async def explain_report(db, queries=None):
+    """
+    Explain given queries (or all recently recorded queries),
+    return which of them still do a collection scan.
+    """
+    collection = get_machine_collection(db)
+    ret = []
+    for query in (queries if queries is not None else list(RecentQueries.values())):
+        explain = await collection.find(query).explain()
+        stages = list(_plan_stages(explain.get('queryPlanner', {}).get('winningPlan', {})))
+        stage_names = [stage.get('stage') for stage in stages]
+        ret.append({
+            'query': query,
+            'stages': stage_names,
+            'indexes': [stage['indexName'] for stage in stages if 'indexName' in stage],
+            'collscan': 'COLLSCAN' in stage_names,
+        })
+    return ret
@@ -13,9 +13,13 @@ import cuvette.transformers as transformers
 import cuvette.provisioners as provisioners
 
 from cuvette.machine import Machine
-from cuvette.tasks import ProvisionTask, ReserveTask, retrive_tasks_from_machine
+from cuvette.mongodb import record_query, get_machine_collection
+from cuvette.tasks import ProvisionTask, ReserveTask, InspectTask, TransformTask, Tasks, retrive_tasks_from_machine
 from cuvette.tasks import Parameters as TaskParameters
 from cuvette.utils.parameters import check_and_merge_parameter
+from cuvette.utils.pagination import paginate
+
+from .coalescer import ProvisionCoalescer
 
 
 Inspectors = inspectors.Inspectors
@@ -60,14 +64,84 @@ def setup_parameters():
 
 Parameters = setup_parameters()
 
+# Hardware facts both inspected and accepted by provisioners, requests mostly filter on these
+IndexedParameters = dict((name, meta) for name, meta in Parameters.items()
+                         if name in InspectorsParameters and name in ProvisionersParameters)
+
 
 DEFAULT_POOL_SIZE = 50
 
+# Max number of transformable machines to consider for a request
+TRANSFORM_CANDIDATES = 50
+
 
 class PipelineException(Exception):
     pass
 
 
+def compose_filter(query_params: dict):
+    """
+    Compose the MongoDB filter from hard filters of all inspectors
+    """
+    query_params = copy.deepcopy(query_params)
+    composed_filter = {}
+
+    for inspector in Inspectors.values():
+        composed_filter.update(inspector.hard_filter(query_params))
+
+    record_query(composed_filter)
+    return composed_filter
+
+
+def compose_soft_filter(query_params: dict):
+    """
+    Compose the MongoDB filter from soft filters of all inspectors
+    """
+    query_params = copy.deepcopy(query_params)
+    composed_filter = {}
+
+    for inspector in Inspectors.values():
+        composed_filter.update(inspector.soft_filter(query_params))
+
+    return composed_filter
+
+
+async def find_transform_plans(db, query_params: dict, count: int):
+    """
+    Return [(machine, transformers, cost)] of idle machines failing the hard
+    filters but passing the soft filters, cheapest first, at most count of them
+    """
+    transformable_filter = {'$and': [
+        compose_soft_filter(query_params),
+        {'$nor': [compose_filter(query_params)]},
+        {'tasks': {}},
+    ]}
+    plans = []
+    for machine in await Machine.find_all(db, transformable_filter, TRANSFORM_CANDIDATES):
+        transformers = [transformer for transformer in Transformers.values()
+                        if transformer.needed(machine, query_params)]
+        if not transformers:
+            continue
+        cost = sum(transformer.cost(machine, query_params) for transformer in transformers)
+        if cost < float('inf'):
+            plans.append((machine, transformers, cost))
+    return sorted(plans, key=lambda plan: plan[2])[:count]
+
+
+def prepare_provision(query_params: dict):
+    """
+    Return the cheapest provisioner for the query and the query
+    filtered for provisioning, provisioner is None if no one accepts it
+    """
+    min_cost_provisioner = provisioners.find_avaliable(query_params)
+    for inspector in Inspectors.values():
+        query_params = inspector.provision_filter(query_params)
+    return min_cost_provisioner, query_params
+
+
+Coalescer = ProvisionCoalescer(prepare_provision)
+
+
 class Pipeline(object):
     """
     Do the most common operation, provision, reserve, teardown
@@ -84,22 +158,35 @@ class Pipeline(object):
         """
         self.request = request
 
+    def compose_filter(self, query_params: dict):
+        return compose_filter(query_params)
+
+    def query_cursor(self, query_params: dict, nocount=None,
+                     projection=None, sort=None, limit=None, after=None):
+        """
+        Like query, but return a Motor cursor of raw documents, projection,
+        sorting and pagination are pushed down to MongoDB.
+        """
+        if not nocount:
+            limit = min(limit or query_params['count'], query_params['count'])
+        composed_filter, kwargs = paginate(
+            self.compose_filter(query_params), projection, sort, limit, after)
+        return get_machine_collection(self.request.app['db']).find(composed_filter, **kwargs)
+
     async def query(self, query_params: dict, nocount=None):
         """
         Return if there is any machine matches required query or
         return the already provisining machine.
         """
-        count = query_params['count']
-
-        query_params = copy.deepcopy(query_params)
-        composed_filter = {}
-
-        for inspector in Inspectors.values():
-            composed_filter.update(inspector.hard_filter(query_params))
-
-        machines = await Machine.find_all(
-            self.request.app['db'],
-            composed_filter, None if nocount else count)
+        count = query_params.get('count')
+        composed_filter = self.compose_filter(query_params)
+        cache = self.request.app.get('machine_cache')
+        if cache is not None:
+            machines = await cache.find_all(composed_filter, None if nocount else count)
+        else:
+            machines = await Machine.find_all(
+                self.request.app['db'],
+                composed_filter, None if nocount else count)
 
         return machines
 
@@ -112,12 +199,9 @@ class Pipeline(object):
         if not await self.request['magic'].allow_provision(query_params):
             return []
 
-        min_cost_provisioner = provisioners.find_avaliable(query_params)
-
         count = query_params['count']
 
-        for inspector in Inspectors.values():
-            query_params = inspector.provision_filter(query_params)
+        min_cost_provisioner, query_params = prepare_provision(query_params)
 
         machines = [Machine(self.request.app['db']) for _ in range(count)]
 
@@ -144,17 +228,89 @@ class Pipeline(object):
                 await machine.delete()
             raise
 
-    async def reserve(self, query_params: dict):
+    async def provision_coalesced(self, query_params: dict, on_launch=None):
         """
-        Reserve a machine, if greedy, reserve as much as possible without checking
+        Provision and wait for machines, concurrent requests of the same
+        shape share one provision.
         """
-        machines = await self.query(query_params)
-        for machine in machines:
-            if machine['tasks']:
-                raise RuntimeError("Can't reserve machine {} {} with tasks".format(
-                    machine.get('hostname', 'no-host'), machine.get('magic', 'no-magic')))
-        reserve_task = ReserveTask(machines, query_params)
-        asyncio.ensure_future(reserve_task.run())
+        if not await self.request['magic'].allow_provision(query_params):
+            return []
+
+        machines = await Coalescer.join(self.request.app['db'], query_params, on_launch)
+        await self.request['magic'].pre_provision(machines, query_params)
+        return machines
+
+    async def transform(self, query_params: dict, machines, on_launch=None):
+        """
+        Transform machines to match the query and wait for it, return
+        machines transformed successfully.
+
+        Each machine is claimed with an atomic update that sets the transform
+        task on it first, machines no longer idle are skipped.
+        """
+        transform_task = TransformTask([], query_params)
+        machines = await Machine.claim(self.request.app['db'], {
+            'magic': {'$in': [machine['magic'] for machine in machines]},
+            'status': 'ready',
+            'tasks': {},
+        }, {
+            'tasks.{}'.format(transform_task.uuid): transform_task.to_dict(),
+        }, len(machines))
+        if not machines:
+            Tasks.pop(transform_task.uuid, None)
+            return []
+        if on_launch is not None:
+            on_launch(machines)
+        transform_task.machines = machines
+        await transform_task.run()
+        return transform_task.transformed
+
+    async def transform_or_provision(self, query_params: dict, on_launch=None):
+        """
+        Get machines for the query from the cheaper way, transform idle
+        machines if it costs less than provisioning new ones, provision the rest.
+
+        on_launch is called with machines being transformed or provisioned.
+        """
+        count = query_params.get('count') or 1
+        ranking = provisioners.Registry.rank(query_params)
+        provision_cost = ranking[0][1] if ranking else float('inf')
+        plans = await find_transform_plans(self.request.app['db'], query_params, count)
+        machines = [machine for machine, transformers, cost in plans if cost < provision_cost]
+        if machines:
+            logger.debug('Transforming %s machine(s), costs %s, provision costs %s',
+                         len(machines), [cost for _, _, cost in plans[:len(machines)]], provision_cost)
+            machines = await self.transform(query_params, machines, on_launch)
+        if len(machines) < count:
+            machines += await self.provision_coalesced(dict(query_params, count=count - len(machines)), on_launch)
+        return machines
+
+    async def reserve(self, query_params: dict, machines=None):
+        """
+        Reserve ready machines without tasks matching the query, up to count of them.
+        Reserve given machines instead if not None, those no longer ready are skipped.
+
+        Each machine is claimed with an atomic update that sets the reserve task
+        on it, so concurrent requests never reserve the same machine.
+        """
+        reserve_task = ReserveTask([], query_params)
+        if machines is not None:
+            claim_filter = {'magic': {'$in': [machine['magic'] for machine in machines]}}
+            count = len(machines)
+        else:
+            claim_filter = self.compose_filter(query_params)
+            count = query_params.get('count') or 1
+        claim_filter = {'$and': [claim_filter, {'status': 'ready', 'tasks': {}}]}
+        machines = await Machine.claim(self.request.app['db'], claim_filter, {
+            'status': 'reserved',
+            'reservation': reserve_task.uuid,
+            'tasks.{}'.format(reserve_task.uuid): reserve_task.to_dict(),
+        }, count)
+        if machines:
+            reserve_task.machines = machines
+            asyncio.ensure_future(reserve_task.run())
+        else:
+            Tasks.pop(reserve_task.uuid, None)
         return machines
 
     async def release(self, query_params: dict):
@@ -175,9 +331,15 @@ class Pipeline(object):
 
     async def inspect(self, query_params: dict):
         """
-        Inspect some machines
+        Inspect all machines matching the query, machines with running
+        tasks are skipped. Return without waiting for the inspection.
         """
-        pass
+        machines = [machine for machine in await self.query(query_params, nocount=True)
+                    if not machine['tasks']]
+        if machines:
+            inspect_task = InspectTask(machines, query_params)
+            asyncio.ensure_future(inspect_task.run())
+        return machines
 
     async def teardown(self, query_params: dict):
         """
@@ -186,10 +348,14 @@ class Pipeline(object):
         machines = await self.query(query_params)
         if not machines:
             raise PipelineException("Can't find any machine to teardown")
-        for provisioner, machines in itertools.groupby(machines, lambda x: x['provisioner']):
-            for machine in machines:
+        by_provisioner = sorted(machines, key=lambda x: x['provisioner'])
+        for provisioner, group in itertools.groupby(by_provisioner, lambda x: x['provisioner']):
+            group = list(group)
+            for machine in group:
                 await machine.mark_delete()  # only mark in case some task running
                 for task in await retrive_tasks_from_machine(machine):
                     task.cancel()
-            await Provisioners[provisioner].teardown(machines, query_params)
+            await Provisioners[provisioner].teardown(group, query_params)
+            for machine in group:
+                inspectors.SSHPool.evict(machine.get('hostname'))
         return machines
@@ -0,0 +1,177 @@
+"""
+Coalesce concurrent provision requests
+
+Requests of the same shape (sanitized query without count and status)
+arriving within COALESCE_WINDOW join one flight, the flight is launched
+as one provision of all machines requested, which is one multi-recipe
+job for beaker. Machines are split between waiters in arrival order at
+launch, each waiter gets its machines as soon as they are ready and free
+of tasks.
+"""
+import json
+import asyncio
+import hashlib
+import logging
+
+from cuvette.machine import Machine
+from cuvette.tasks import ProvisionTask
+
+logger = logging.getLogger(__name__)
+
+# Keys don't make a request different
+NON_SHAPE_KEYS = ['count', 'provision-count', 'status', 'magic']
+
+COALESCE_WINDOW = 1
+
+# Max number of machines provisioned by one flight
+COALESCE_MAX_BATCH = 10
+
+
+def request_shape(query: dict):
+    """
+    Return (key, shape) of a sanitized query
+    """
+    shape = dict((key, value) for key, value in query.items() if key not in NON_SHAPE_KEYS)
+    canonical = json.dumps(shape, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha1(canonical.encode('utf8')).hexdigest(), shape
+
+
+class Waiter(object):
+    def __init__(self, count, on_launch=None):
+        self.count = count
+        self.on_launch = on_launch
+        self.machines = []
+        self.future = asyncio.get_event_loop().create_future()
+
+    def resolve(self):
+        if not self.future.done():
+            self.future.set_result(self.machines)
+
+
+class Flight(object):
+    def __init__(self, db, key, shape):
+        self.db = db
+        self.key = key
+        self.shape = shape
+        self.waiters = []
+        self.machines = {}
+        # Magic -> waiter the machine is launched for
+        self.owners = {}
+        self.handle = None
+
+    @property
+    def count(self):
+        return sum(waiter.count for waiter in self.waiters)
+
+
+class ProvisionCoalescer(object):
+    def __init__(self, prepare, window=COALESCE_WINDOW, max_batch=COALESCE_MAX_BATCH):
+        """
+        prepare takes a query and returns (provisioner, query for provisioning)
+        """
+        self.prepare = prepare
+        self.window = window
+        self.max_batch = max_batch
+        self.open = {}
+        self.flying = {}
+        self.stats = {
+            'requests': 0,
+            'flights': 0,
+            'coalesced': 0,
+        }
+        Machine.listeners.append(self.on_machine_write)
+
+    def get_stats(self):
+        ret = dict(self.stats)
+        ret['in_flight'] = len(set(self.flying.values()))
+        return ret
+
+    async def join(self, db, query: dict, on_launch=None):
+        """
+        Wait for query['count'] machines provisioned for the query,
+        may return less machines if some of them failed.
+
+        on_launch is called with the machines launched for this request.
+        """
+        key, shape = request_shape(query)
+        count = query.get('count') or 1
+        self.stats['requests'] += 1
+        flight = self.open.get(key)
+        if flight is not None and flight.count + count > self.max_batch:
+            flight.handle.cancel()
+            await self.launch(flight)
+            flight = None
+        if flight is None:
+            flight = self.open[key] = Flight(db, key, shape)
+            flight.handle = asyncio.get_event_loop().call_later(
+                self.window, lambda: asyncio.ensure_future(self.launch(flight)))
+            self.stats['flights'] += 1
+        else:
+            self.stats['coalesced'] += 1
+        waiter = Waiter(count, on_launch)
+        flight.waiters.append(waiter)
+        return await asyncio.shield(waiter.future)
+
+    def _fail(self, flight, error):
+        for waiter in flight.waiters:
+            if not waiter.future.done():
+                waiter.future.set_exception(error)
+
+    async def launch(self, flight):
+        if self.open.get(flight.key) is flight:
+            del self.open[flight.key]
+        count = flight.count
+        provisioner, query = self.prepare(dict(flight.shape, count=count, **{'provision-count': count}))
+        if provisioner is None:
+            self._fail(flight, RuntimeError('Failed to provision a machine, as no one machine matched your need, '
+                                            'or there are zero machine.'))
+            return
+        machines = [Machine(flight.db) for _ in range(count)]
+        try:
+            for machine in machines:
+                await machine.save()
+        except Exception as error:
+            for machine in machines:
+                await machine.delete()
+            self._fail(flight, error)
+            return
+        for machine in machines:
+            flight.machines[machine['magic']] = machine
+            self.flying[machine['magic']] = flight
+        offset = 0
+        for waiter in flight.waiters:
+            share = machines[offset:offset + waiter.count]
+            offset += waiter.count
+            for machine in share:
+                flight.owners[machine['magic']] = waiter
+            if waiter.on_launch is not None:
+                waiter.on_launch(share)
+        logger.debug('Provisioning %s machine(s) with %s for %s request(s)',
+                     count, provisioner.NAME, len(flight.waiters))
+        future = asyncio.ensure_future(ProvisionTask(machines, query, provisioner).run())
+        future.add_done_callback(lambda _: self.settle(flight))
+
+    def on_machine_write(self, machine, deleted):
+        flight = self.flying.get(machine.get('magic'))
+        if flight is None:
+            return
+        if deleted or machine.get('status') in ['failed', 'deleted']:
+            self.flying.pop(machine['magic'])
+        elif machine.get('status') == 'ready' and not machine.get('tasks'):
+            self.flying.pop(machine['magic'])
+            waiter = flight.owners[machine['magic']]
+            waiter.machines.append(flight.machines[machine['magic']])
+            if len(waiter.machines) == waiter.count:
+                waiter.resolve()
+        if not any(flight is other for other in self.flying.values()):
+            self.settle(flight)
+
+    def settle(self, flight):
+        """
+        Provision finished, waiters get whatever they have
+        """
+        for magic in list(flight.machines):
+            if self.flying.get(magic) is flight:
+                del self.flying[magic]
+        for waiter in flight.waiters:
+            waiter.resolve()
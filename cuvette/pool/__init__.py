@@ -1,14 +1,20 @@
 from .scheduler import setup as scheduler_setup
-from .house_keeper import CleanExpiredMachine, CleanDeadMachine, CleanDeletedMachine
+from .house_keeper import CleanExpiredMachine, CleanDeadMachine, CleanDeletedMachine, InspectIdleMachine
+from .warm_pool import WarmPoolController, RequestDemand
+from .cache import MachineCache
 
-__all__ = ['setup']
+__all__ = ['setup', 'HouseKeepers', 'RequestDemand', 'WarmPoolController']
+
+HouseKeepers = [CleanDeadMachine, CleanExpiredMachine, CleanDeletedMachine, InspectIdleMachine, WarmPoolController]
 
 
 def setup(loop, app):
     # XXX: scheduler should run out side the app loop
     # XXX: Maybe after switch to celery after celery 4 is out
     scheduler = scheduler_setup(loop)
-    for house_keeper in [CleanDeadMachine, CleanExpiredMachine, CleanDeletedMachine]:
-        house_keeper = house_keeper(app['db'])
+    cache = app['machine_cache'] = MachineCache(app['db'])
+    cache.start()
+    for house_keeper in HouseKeepers:
+        house_keeper = house_keeper(app['db'], cache)
         # Add tasks
         scheduler.add_job(house_keeper.run, 'interval', seconds=house_keeper.INTERVAL * 2)
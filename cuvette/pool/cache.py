@@ -0,0 +1,143 @@
+"""
+Process local materialized view of the machine pool
+
+Kept current from a MongoDB change stream, or by a polling tailer when
+change stream is not avaliable (no replica set, or old server/driver).
+Writes done by this process are applied immediately through Machine listeners,
+so reads right after a write won't go stale while waiting for the next poll.
+"""
+import copy
+import time
+import asyncio
+import logging
+
+from cuvette.machine import Machine
+from cuvette.mongodb import get_machine_collection
+from cuvette.utils.matcher import compile_query
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 10
+
+RETRY_INTERVAL = 5
+
+
+class MachineCache(object):
+    """
+    In memory view of machines collection
+    """
+    def __init__(self, db, poll_interval=POLL_INTERVAL):
+        self.db = db
+        self.poll_interval = poll_interval
+        self.machines = {}
+        self.ready = False
+        self.mode = None
+        self.future = None
+        # _id -> timestamp of last local write, used to avoid a full reload
+        # overriding a newer local write
+        self._touched = {}
+
+    def start(self):
+        Machine.listeners.append(self.on_local_write)
+        self.future = asyncio.ensure_future(self.run())
+        return self.future
+
+    def stop(self):
+        if self.on_local_write in Machine.listeners:
+            Machine.listeners.remove(self.on_local_write)
+        if self.future:
+            self.future.cancel()
+            self.future = None
+        self.ready = False
+
+    def on_local_write(self, machine, deleted):
+        _id = machine.get('_id')
+        if _id is None:
+            return
+        if self.mode != 'change_stream':
+            self._touched[_id] = time.monotonic()
+        if deleted:
+            self.machines.pop(_id, None)
+        else:
+            self.machines[_id] = copy.deepcopy(dict(machine))
+
+    async def reload(self):
+        started = time.monotonic()
+        docs = await get_machine_collection(self.db).find({}).to_list(None)
+        machines = dict((doc['_id'], doc) for doc in docs)
+        for _id, touched in list(self._touched.items()):
+            if touched > started:
+                # Written locally while reloading, keep the local copy
+                if _id in self.machines:
+                    machines[_id] = self.machines[_id]
+                else:
+                    machines.pop(_id, None)
+            else:
+                del self._touched[_id]
+        self.machines = machines
+        self.ready = True
+
+    async def tail_change_stream(self):
+        collection = get_machine_collection(self.db)
+        async with collection.watch(full_document='updateLookup') as stream:
+            self.mode = 'change_stream'
+            # Load after the stream is open so no change is missed in between
+            await self.reload()
+            async for change in stream:
+                _id = change.get('documentKey', {}).get('_id')
+                if change['operationType'] == 'delete':
+                    self.machines.pop(_id, None)
+                elif change['operationType'] in ('insert', 'replace', 'update'):
+                    if change.get('fullDocument') is None:
+                        self.machines.pop(_id, None)
+                    else:
+                        self.machines[_id] = change['fullDocument']
+                elif change['operationType'] in ('drop', 'invalidate'):
+                    self.machines = {}
+                    return
+
+    async def tail_polling(self):
+        self.mode = 'polling'
+        while True:
+            await self.reload()
+            await asyncio.sleep(self.poll_interval)
+
+    async def run(self):
+        while True:
+            try:
+                try:
+                    await self.tail_change_stream()
+                    continue
+                except asyncio.CancelledError:
+                    raise
+                except Exception as error:
+                    # Not a replica set, or not supported by server or driver
+                    logger.warning('Machine change stream unavailable (%s), falling back to polling', error)
+                await self.tail_polling()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.ready = False
+                logger.exception('Machine cache tailer failed, retrying in %ss', RETRY_INTERVAL)
+                await asyncio.sleep(RETRY_INTERVAL)
+
+    def query(self, query: dict, count=None):
+        """
+        Return documents matching the query from memory
+        """
+        ret = []
+        match = compile_query(query)
+        for doc in self.machines.values():
+            if count is not None and len(ret) >= count:
+                break
+            if match(doc):
+                ret.append(doc)
+        return ret
+
+    async def find_all(self, query={}, count=None):
+        """
+        Same as Machine.find_all, served from memory when the cache is ready.
+        """
+        if not self.ready:
+            return await Machine.find_all(self.db, query, count)
+        return [Machine(self.db, copy.deepcopy(doc)) for doc in self.query(query, count)]
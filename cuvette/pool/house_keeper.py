@@ -2,29 +2,55 @@ import asyncio
 import logging
 from datetime import datetime
 from cuvette.tasks.teardown import TeardownTask
+from cuvette.tasks.inspect import InspectTask
 from cuvette.machine import Machine
 
 logger = logging.getLogger(__name__)
 
 
-class CleanExpiredMachine(object):
+class HouseKeeper(object):
     """
-    The worker function that keep scanning
-    main pool to clean expired machines
+    Base class for pool workers, query from the machine cache if given
     """
 
     INTERVAL = 60
 
-    def __init__(self, db):
+    def __init__(self, db, cache=None):
         self.db = db
+        self.cache = cache
 
-    async def run(self):
-        teardown_tasks = []
-        for machine in await Machine.find_all(self.db, {
+    @classmethod
+    def query(cls):
+        """
+        The filter this worker scans the pool with
+        """
+        return {}
+
+    def find_all(self, query):
+        if self.cache is not None:
+            return self.cache.find_all(query)
+        return Machine.find_all(self.db, query)
+
+
+class CleanExpiredMachine(HouseKeeper):
+    """
+    The worker function that keep scanning
+    main pool to clean expired machines
+    """
+
+    INTERVAL = 60
+
+    @classmethod
+    def query(cls):
+        return {
             'expire_time': {
                 '$lte': datetime.now()
             }
-        }):
+        }
+
+    async def run(self):
+        teardown_tasks = []
+        for machine in await self.find_all(self.query()):
             if any(task['type'] == 'teardown' for task in machine['tasks'].values()):
                 continue  # TODO: use mongo query
             teardown_tasks.append(TeardownTask([machine], {}).run())
@@ -34,7 +60,7 @@ class CleanExpiredMachine(object):
             finished, pending = await asyncio.wait(teardown_tasks, timeout=self.INTERVAL)
 
 
-class CleanDeadMachine(object):
+class CleanDeadMachine(HouseKeeper):
     """
     The worker function that keep scanning
     main pool to clean expired machines
@@ -42,19 +68,20 @@ class CleanDeadMachine(object):
 
     INTERVAL = 3600
 
-    def __init__(self, db):
-        self.db = db
-
-    async def run(self):
-        for machine in await Machine.find_all(self.db, {
+    @classmethod
+    def query(cls):
+        return {
             'tasks': {},
             'status': 'preparing'
-        }):
+        }
+
+    async def run(self):
+        for machine in await self.find_all(self.query()):
             logger.debug('Deleting dead machine: %s', machine)
             await machine.delete()
 
 
-class CleanDeletedMachine(object):
+class CleanDeletedMachine(HouseKeeper):
     """
     The worker function that keep scanning
     main pool to clean expired machines
@@ -62,13 +89,36 @@ class CleanDeletedMachine(object):
 
     INTERVAL = 30
 
-    def __init__(self, db):
-        self.db = db
-
-    async def run(self):
-        for machine in await Machine.find_all(self.db, {
+    @classmethod
+    def query(cls):
+        return {
             'tasks': {},
             'status': 'deleted'
-        }):
+        }
+
+    async def run(self):
+        for machine in await self.find_all(self.query()):
             logger.debug('Deleting machine: %s', machine)
             await machine.delete()
+
+
+class InspectIdleMachine(HouseKeeper):
+    """
+    The worker function that periodically re-inspect
+    all idle ready machines in the pool
+    """
+
+    INTERVAL = 43200
+
+    @classmethod
+    def query(cls):
+        return {
+            'tasks': {},
+            'status': 'ready'
+        }
+
+    async def run(self):
+        machines = await self.find_all(self.query())
+        if machines:
+            logger.debug('Re-inspecting %s idle machines', len(machines))
+            await InspectTask(machines, {}).run()
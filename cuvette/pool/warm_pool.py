@@ -0,0 +1,190 @@
+"""
+Warm pool
+
+Request shapes (sanitized queries without count and status) seen by
+/machines/request are recorded with a decaying request counter. The warm
+pool controller keeps enough ready machines for the hottest shapes to
+serve the requests expected during one provision, so they don't wait
+for a provision on a miss, and tears down warm machines idled for too
+long once their shape cooled down.
+
+Machines provisioned by the controller are marked with 'warm-shape'.
+"""
+import math
+import time
+import asyncio
+import logging
+
+from cuvette.machine import Machine
+from cuvette.pipeline import compose_filter, prepare_provision
+from cuvette.pipeline.coalescer import request_shape
+from cuvette.tasks import ProvisionTask
+from cuvette.tasks.teardown import TeardownTask
+
+from .house_keeper import HouseKeeper
+
+logger = logging.getLogger(__name__)
+
+# Weight of a request halves after this many seconds
+DEMAND_HALF_LIFE = 21600
+
+DEMAND_MAX_SHAPES = 100
+
+# Shapes requested less than this many times per hour are not kept warm
+WARM_POOL_MIN_RATE = 0.5
+
+WARM_POOL_SHAPES = 5
+
+# Expected time for a provision, keep machines for requests arriving in this time
+WARM_POOL_LEAD_TIME = 3600
+
+WARM_POOL_MAX_PER_SHAPE = 3
+
+WARM_POOL_MAX_TOTAL = 10
+
+# Surplus warm machines back to ready for longer than this are teared down
+WARM_POOL_IDLE_TIMEOUT = 21600
+
+
+class Demand(object):
+    """
+    Request history per shape
+    """
+    def __init__(self, half_life=DEMAND_HALF_LIFE, max_shapes=DEMAND_MAX_SHAPES):
+        self.half_life = half_life
+        self.max_shapes = max_shapes
+        self.shapes = {}
+        self.stats = {
+            'requests': 0,
+            'hits': 0,
+            'misses': 0,
+        }
+
+    def _decayed(self, entry, now):
+        return entry['score'] * 2 ** (-(now - entry['last_seen']) / self.half_life)
+
+    def record(self, query: dict, hit: bool):
+        now = time.time()
+        key, shape = request_shape(query)
+        entry = self.shapes.get(key)
+        if entry is None:
+            entry = self.shapes[key] = {'shape': shape, 'score': 0.0, 'last_seen': now, 'hits': 0, 'misses': 0}
+        entry['score'] = self._decayed(entry, now) + 1
+        entry['last_seen'] = now
+        entry['hits' if hit else 'misses'] += 1
+        self.stats['requests'] += 1
+        self.stats['hits' if hit else 'misses'] += 1
+        if len(self.shapes) > self.max_shapes:
+            coldest = min(self.shapes, key=lambda key: self._decayed(self.shapes[key], now))
+            del self.shapes[coldest]
+
+    def rate(self, key, now=None):
+        """
+        Requests per hour of a shape, the decayed counter of a steady
+        stream of r requests per second converges to r * half_life / ln2
+        """
+        entry = self.shapes[key]
+        return self._decayed(entry, now or time.time()) * math.log(2) / self.half_life * 3600
+
+    def hottest(self, count):
+        """
+        Return [(key, shape, rate)] of most requested shapes
+        """
+        now = time.time()
+        rates = [(key, entry['shape'], self.rate(key, now)) for key, entry in self.shapes.items()]
+        return sorted(rates, key=lambda item: item[2], reverse=True)[:count]
+
+    def get_stats(self):
+        ret = dict(self.stats)
+        ret['hit_rate'] = ret['hits'] / ret['requests'] if ret['requests'] else None
+        ret['shapes'] = len(self.shapes)
+        return ret
+
+
+RequestDemand = Demand()
+
+
+class WarmPoolController(HouseKeeper):
+    """
+    Provision ready machines ahead of demand for hot request shapes
+    and trim idle surplus
+    """
+
+    INTERVAL = 300
+
+    stats = {
+        'provisioned': 0,
+        'teared_down': 0,
+    }
+
+    @classmethod
+    def query(cls):
+        return {
+            'warm-shape': {'$exists': True},
+            'status': 'ready',
+            'tasks': {},
+        }
+
+    @staticmethod
+    def target(rate):
+        if rate < WARM_POOL_MIN_RATE:
+            return 0
+        return min(WARM_POOL_MAX_PER_SHAPE, int(math.ceil(rate * WARM_POOL_LEAD_TIME / 3600)))
+
+    async def provision(self, key, shape, count):
+        query = dict(shape, count=count, **{'provision-count': count})
+        provisioner, query = prepare_provision(query)
+        if provisioner is None:
+            logger.warning('No provisioner for warm shape %s', shape)
+            return
+        machines = [Machine(self.db) for _ in range(count)]
+        for machine in machines:
+            machine['warm-shape'] = key
+            await machine.save()
+        logger.info('Pre-provisioning %s machine(s) with %s for shape %s', count, provisioner.NAME, shape)
+        self.stats['provisioned'] += count
+        asyncio.ensure_future(ProvisionTask(machines, query, provisioner).run())
+
+    async def run(self):
+        targets = dict((key, (shape, self.target(rate)))
+                       for key, shape, rate in RequestDemand.hottest(WARM_POOL_SHAPES))
+
+        warm_machines = [machine for machine in await self.find_all({
+            'warm-shape': {'$exists': True},
+            'status': {'$in': ['preparing', 'ready']},
+        }) if not any(task['type'] == 'reserve' for task in machine['tasks'].values())]
+        budget = WARM_POOL_MAX_TOTAL - len(warm_machines)
+
+        surplus = {}
+        for key, (shape, target) in targets.items():
+            if not target:
+                continue
+            ready = await self.find_all({'$and': [compose_filter(shape), {'status': 'ready', 'tasks': {}}]})
+            preparing = [machine for machine in warm_machines
+                         if machine['warm-shape'] == key and machine['status'] == 'preparing']
+            deficit = min(target - len(ready) - len(preparing), budget)
+            if deficit > 0:
+                budget -= deficit
+                await self.provision(key, shape, deficit)
+            surplus.update((machine['magic'], machine) for machine in ready[target:] if machine.get('warm-shape'))
+
+        # Warm machines of shapes no longer hot
+        surplus.update((machine['magic'], machine) for machine in warm_machines
+                       if machine['status'] == 'ready' and not machine['tasks'] and
+                       not targets.get(machine['warm-shape'], (None, 0))[1])
+
+        now = time.time()
+        for machine in surplus.values():
+            # Machines made ready before ready_time is recorded only have start_time
+            ready_time = machine.get('ready_time') or machine.get('start_time')
+            if ready_time is None or now - ready_time.timestamp() < WARM_POOL_IDLE_TIMEOUT:
+                continue
+            logger.debug('Tearing down idle warm machine %s', machine)
+            self.stats['teared_down'] += 1
+            asyncio.ensure_future(TeardownTask([machine], {}).run())
+
+    @classmethod
+    def get_stats(cls):
+        ret = RequestDemand.get_stats()
+        ret.update(cls.stats)
+        return ret
@@ -3,15 +3,19 @@ Provisoiners
 """
 import logging
 
-from cuvette.utils import find_all_sub_module, load_all_sub_module, sanitize_query
+from cuvette.utils import find_all_sub_module, load_all_sub_module
 from cuvette.utils.parameters import get_all_parameters
 
+from .registry import ProvisionerRegistry
+
 logger = logging.getLogger(__name__)
 
-__all__ = find_all_sub_module(__file__, exclude=['base'])
+__all__ = find_all_sub_module(__file__, exclude=['base', 'polling', 'registry'])
 
 Provisioners = dict((k, v.Provisioner()) for k, v in load_all_sub_module(__name__).items())
 
+Registry = ProvisionerRegistry(Provisioners)
+
 
 Parameters = get_all_parameters(Provisioners.values(),
                                 'provisoiner',
@@ -32,14 +36,7 @@ Parameters.update({
 
 
 def find_avaliable(query):
-    min_cost, min_cost_provisioner = float('inf'), None
-    for provisioner in Provisioners.values():
-        query = sanitize_query(query, provisioner.PARAMETERS)
-        if provisioner.avaliable(query):
-            if provisioner.cost(query) < min_cost:
-                min_cost_provisioner = provisioner
-
-    return min_cost_provisioner
+    return Registry.find_avaliable(query)
 
 
 def find_by_name(name):
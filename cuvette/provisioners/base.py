@@ -1,5 +1,7 @@
 import abc
 
+from .polling import PollingPolicy
+
 ALWAYS_GREEDY = True
 ALWAYS_UNTRUST = True
 
@@ -11,6 +13,17 @@ class ProvisionerBase(object, metaclass=abc.ABCMeta):
     What parameters this provisioner accepts
     """
 
+    POLLING_POLICY = PollingPolicy()
+    """
+    How often to poll the provisioning service
+    """
+
+    def get_stats(self):
+        """
+        Performance counters of this provisioner
+        """
+        return {}
+
     @abc.abstractmethod
     def avaliable(params: dict):
         """
@@ -6,46 +6,52 @@ import logging
 
 from cuvette.settings import Settings
 from cuvette.provisioners.base import ProvisionerBase
-from cuvette.utils.exceptions import ValidateError, ProvisionError
+from cuvette.utils.exceptions import ProvisionError
 
-from .beaker import query_to_xml, pull_beaker_job, submit_beaker_job, parse_machine_info, cancel_beaker_job
-from .convertor import ACCEPT_PARAMS
+from .beaker import query_to_xml, is_valid_query, parse_machine_info
+from .beaker import pull_beaker_job, submit_beaker_job, cancel_beaker_job
+from .beaker import JobPoller
+from .poller import BeakerPollingPolicy
+from .inventory import Inventory
+from .convertor import ACCEPT_PARAMS, DEFAULTS
 
 logger = logging.getLogger(__name__)
 
 DEFAULT_LIFE_SPAN = 86400
+
+# Expected seconds to get a reserved system, queueing included
+ESTIMATED_PROVISION_TIME = 7200
 BEAKER_URL = Settings.BEAKER_URL.rstrip('/')
 
 
 class Provisioner(ProvisionerBase):
     NAME = 'beaker'
     PARAMETERS = ACCEPT_PARAMS
+    POLLING_POLICY = BeakerPollingPolicy()
 
     def __init__(self):
-        pass
+        JobPoller.policy = self.POLLING_POLICY
+
+    def get_stats(self):
+        return {
+            'job_poller': JobPoller.get_stats(),
+            'inventory': Inventory.get_stats(),
+        }
 
     def avaliable(self, query: dict):
         """
         If given query is acceptable by this provisioner
         """
-        try:
-            query_to_xml(query)
-        except ValidateError:
-            return False
-        else:
-            return True
+        return is_valid_query(query)
 
     def cost(self, query: dict):
         """
         How much time is likely to be costed provision a machine
         matches given query
         """
-        try:
-            query_to_xml(query)
-        except ValidateError:
+        if not is_valid_query(query):
             return float('inf')
-        else:
-            return 100
+        return ESTIMATED_PROVISION_TIME
 
     async def provision_loop(self, machines, sanitized_query, last_job_id=None):
         job_xml = query_to_xml(sanitized_query)
@@ -58,8 +64,10 @@ class Provisioner(ProvisionerBase):
                     raise ProvisionError("Provision cancelled, machine is deleted")
             job_id = job_id or await submit_beaker_job(machines, job_xml)
             for machine in machines:
-                await machine.set('meta.beaker-job_id', job_id)
-                await machine.set('meta.beaker-failure_count', failure_count)
+                await machine.set({
+                    'meta.beaker-job_id': job_id,
+                    'meta.beaker-failure_count': failure_count,
+                })
             recipes = await pull_beaker_job(machines, job_id)
             if recipes is None and failure_count != 10:
                 logger.error("Provision failed, retrying")
@@ -76,9 +84,15 @@ class Provisioner(ProvisionerBase):
             raise ProvisionError("Failed to retrive {} machines with given query from beaker".format(len(machines)))
 
         for idx, recipe in enumerate(recipes):
-            machine_info = await parse_machine_info(recipe)
-            await machines[idx].set('lifespan', sanitized_query.get('provision-lifespan', DEFAULT_LIFE_SPAN))
-            await machines[idx].set(machine_info)
+            machine_info = await parse_machine_info(recipe, machines[idx].db)
+            estimator = getattr(self.POLLING_POLICY, 'estimator', None)
+            if estimator is not None:
+                estimator.learn_system(recipe['system'], machine_info['lab_controller'])
+            machine_info['packages'] = sorted(
+                set(DEFAULTS['job-packages']) | set(sanitized_query.get('packages') or []))
+            async with machines[idx].batch():
+                await machines[idx].set('lifespan', sanitized_query.get('provision-lifespan', DEFAULT_LIFE_SPAN))
+                await machines[idx].set(machine_info)
 
         return machines
 
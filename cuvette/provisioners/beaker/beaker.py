@@ -1,14 +1,17 @@
-import re
+import time
 import asyncio
 import logging
 import datetime
 
-from asyncio.subprocess import PIPE, STDOUT
 from cuvette.settings import Settings
-from cuvette.utils.exceptions import ProvisionError
+from cuvette.utils.exceptions import ProvisionError, ValidateError
 
-from lxml import etree
-from .convertor import convert_query_to_beaker_xml
+from .client import BkrClient, get_client
+from .convertor import convert_query_to_beaker_xml, validate_query
+from .parser import parse_job_recipes, parse_jobs_recipes
+from .inventory import Inventory
+from .poller import BeakerJobPoller, FAILURE_TIMEOUT
+from cuvette.provisioners.polling import backoff
 
 
 logger = logging.getLogger(__name__)
@@ -16,19 +19,23 @@ logger = logging.getLogger(__name__)
 
 BEAKER_URL = Settings.BEAKER_URL.rstrip('/')
 
+# Give up a job not reserved after two hours
+PULL_TIMEOUT = 7200
+
+# Window to buffer pull status of polled machines, longer than any poll
+# interval (60s at most) so several polls are merged into one write
+PULL_STATUS_WINDOW = 300
+
+# Max delay between retries of a failing fetch
+FETCH_MAX_BACKOFF = 120
+
 
 async def bkr_command(*args, input=None):
-    p = await asyncio.create_subprocess_exec(
-        *(['bkr'] + list(args)),
-        stdin=PIPE, stdout=PIPE, stderr=STDOUT)
-    stdout, stderr = await p.communicate(input=bytes(input, 'utf8') if input else None)
-    if stderr:
-        logger.error("Failed calling bkr with error:", stderr)
-    return stdout.decode('utf8')
+    return await BkrClient().command(*args, input=input)
 
 
 async def cancel_beaker_job(job_id: str):
-    await bkr_command('job-cancel', job_id)
+    await get_client().job_cancel(job_id)
 
 
 def query_to_xml(sanitized_query: dict) -> str:
@@ -38,32 +45,66 @@ def query_to_xml(sanitized_query: dict) -> str:
     return convert_query_to_beaker_xml(sanitized_query)
 
 
+def is_valid_query(sanitized_query: dict) -> bool:
+    """
+    If a query could be converted to beaker job XML, without converting it
+    """
+    try:
+        validate_query(sanitized_query)
+    except ValidateError:
+        return False
+    return True
+
+
+async def fetch_job_status(job_id: str):
+    """
+    Fetch job status once, return list of recipe attributes,
+    raise RuntimeError if no recipe is found
+    """
+    active_job_xml_str = await get_client().job_results(job_id)
+    recipes = parse_job_recipes(active_job_xml_str)
+    if not recipes:
+        raise RuntimeError('bkr job-results command failure, may caused by: beaker is down, network'
+                           'issue or some interface changes, can\''
+                           't find valid recipe, xml result is {}'.format(active_job_xml_str))
+    return recipes
+
+
 async def fetch_job_recipes(job_id: str):
     """
     Fetch job status, return set of recipes in XML Element format
     return None on failure
     """
     recipes = []
-    for _ in range(1440):  # Try to fetch for one day
+    deadline = time.monotonic() + FAILURE_TIMEOUT  # Try to fetch for one day
+    failures = 0
+    while True:
         try:
-            active_job_xml_str = await bkr_command('job-results', job_id)
-            active_job_xml = etree.fromstring(active_job_xml_str)
-            recipes = list(map(lambda x: dict(x.attrib), active_job_xml.xpath('//recipe')))
-            if not recipes:
-                raise RuntimeError('bkr job-results command failure, may caused by: beaker is down, network'
-                                   'issue or some interface changes, can\''
-                                   't find valid recipe, xml result is {}'.format(active_job_xml_str))
-            else:
-                break
+            recipes = await fetch_job_status(job_id)
+            break
         except Exception as error:
-            if _ != 1440:
-                logger.exception('Error while fetching beaker job-results, keep trying in 120s...')
-                await asyncio.sleep(120)
+            failures += 1
+            delay = backoff(failures, cap=FETCH_MAX_BACKOFF)
+            if time.monotonic() + delay < deadline:
+                logger.exception('Error while fetching beaker job-results, keep trying in %ds...', delay)
+                await asyncio.sleep(delay)
             else:
                 raise
     return recipes
 
 
+async def fetch_jobs_status(job_ids):
+    """
+    Fetch status of several jobs with one query, return {job_id: recipes},
+    jobs without any recipe found are left out
+    """
+    document = await get_client().jobs_results(job_ids)
+    return dict((job_id, recipes) for job_id, recipes in parse_jobs_recipes(document).items() if recipes)
+
+
+JobPoller = BeakerJobPoller(fetch_jobs_status)
+
+
 def is_recipes_failed(recipes):
     if not recipes:
         return "Invalid recipes"
@@ -86,10 +127,9 @@ async def submit_beaker_job(machines, job_xml: str):
     """
     logger.info("Submitting with beaker Job XML:\n%s", job_xml)
     try:
-        task_id_output = await bkr_command('job-submit', input=job_xml)
-        job_id = re.match("Submitted: \['(J:[0-9]+)'(?:,)?\]", task_id_output).groups()[0]
-    except (ValueError, TypeError, AttributeError):
-        logger.error('Expecting one job id, got: %s', task_id_output)
+        job_id = await get_client().job_submit(job_xml)
+    except ProvisionError as error:
+        logger.error('Failed submitting beaker job: %s', error)
         return None
     else:
         for machine in machines:
@@ -106,12 +146,16 @@ async def pull_beaker_job(machines, job_id: str):
     bkr_task_url = "{}/jobs/{}".format(BEAKER_URL, job_id[2:])
     try:
         for machine in machines:
-            await machine.set('meta.beaker-task_url', bkr_task_url)
-            await machine.set('meta.beaker-pull_count', pull_count)
+            await machine.set({
+                'meta.beaker-task_url': bkr_task_url,
+                'meta.beaker-pull_count': pull_count,
+            })
+            # Poll progress is only informational, save it every few polls
+            machine.write_behind(PULL_STATUS_WINDOW)
 
-        while True and pull_count < 720:  # Pull for two hours
-            await asyncio.sleep(10)
-            recipes = await fetch_job_recipes(job_id)
+        deadline = time.monotonic() + PULL_TIMEOUT
+        while time.monotonic() < deadline:
+            recipes = await JobPoller.wait(job_id)
 
             pull_count += 1
             for machine in machines:
@@ -120,8 +164,10 @@ async def pull_beaker_job(machines, job_id: str):
             failure = is_recipes_failed(recipes)
             if failure:
                 for machine in machines:
-                    await machine.set('meta.beaker-last_failure_reason', failure)
-                    await machine.set('meta.beaker-last_job_id', job_id)
+                    await machine.set({
+                        'meta.beaker-last_failure_reason': failure,
+                        'meta.beaker-last_job_id': job_id,
+                    })
                 return None
             elif is_recipes_finished(recipes):
                 success = True
@@ -129,6 +175,12 @@ async def pull_beaker_job(machines, job_id: str):
             else:
                 pass  # recipes pending, keep pulling
     finally:
+        for machine in machines:
+            machine.write_behind(None)
+            try:
+                await machine.flush()
+            except RuntimeError as error:
+                logger.error('Failed saving pull status of machine %s: %s', machine, error)
         if not success:
             logger.error("Provisioning aborted abnormally. Cancellling beaker job %s", bkr_task_url)
             await cancel_beaker_job(job_id)
@@ -137,84 +189,15 @@ async def pull_beaker_job(machines, job_id: str):
             return recipes
 
 
-async def parse_machine_info(recipe: str):
+async def parse_machine_info(recipe: str, db=None):
     """
-    Parse recipe xml to get machine info
+    Parse recipe xml to get machine info, system details are read
+    from the inventory cache when db is given
     """
     DEFAULT_LIFE_SPAN = 86400
 
-    NS_INV = 'https://fedorahosted.org/beaker/rdfschema/inventory#'
-    NS_INV = '{%s}' % NS_INV
-
-    NS_RDF = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#'
-    NS_RDF = '{%s}' % NS_RDF
-
     ret = {}
 
-    system_tag_map = {
-        '{}cpuSpeed'.format(NS_INV): {
-            'name': 'cpu-speed',
-            'type': float,
-        },
-        '{}cpuVendor'.format(NS_INV): {
-            'name': 'cpu-vendor',
-            'type': str,
-        },
-        '{}cpuFamilyId'.format(NS_INV): {
-            'name': 'cpu-family',
-            'type': int,
-        },
-        '{}cpuModelId'.format(NS_INV): {
-            'name': 'cpu-model',
-            'type': int,
-        },
-        '{}cpuCount'.format(NS_INV): {
-            'name': 'cpu-core_number',
-            'type': int,
-        },
-        '{}cpuSocketCount'.format(NS_INV): {
-            'name': 'cpu-socket_number',
-            'type': int,
-        },
-        '{}cpuFlag'.format(NS_INV): {
-            'name': 'cpu-flags',
-            'type': list,
-        },
-        '{}cpuStepping'.format(NS_INV): {
-            'name': 'cpu-stepping',
-            'type': list,
-        },
-        '{}cpuModelName'.format(NS_INV): {
-            'name': 'cpu-model_name',
-            'type': str,
-        },
-        '{}numaNodes'.format(NS_INV): {
-            'name': 'numa-node_number',
-            'type': int,
-        },
-        '{}model'.format(NS_INV): {
-            'name': 'system-model',
-            'type': str,
-        },
-        '{}vendor'.format(NS_INV): {
-            'name': 'system-vendor',
-            'type': str,
-        },
-        '{}memory'.format(NS_INV): {
-            'name': 'memory-total_size',
-            'type': int,
-        },
-        '{}macAddress'.format(NS_INV): {
-            'name': 'net-mac_address',
-            'type': str,
-        },
-        # TODO
-        # '{}hasDevice'.format(NS_INV): {
-        # },
-    }
-
-    system_tag_map.update(Settings.EXTRA_BEAKER_NS_MAP)
-
     ret['lifespan'] = DEFAULT_LIFE_SPAN
     ret['start_time'] = datetime.datetime.strptime(recipe['start_time'], '%Y-%m-%d %H:%M:%S')
     ret['cpu-arch'] = recipe['arch']
@@ -223,36 +206,13 @@ async def parse_machine_info(recipe: str):
     ret['beaker-distro_variant'] = recipe['variant']
     ret['hostname'] = recipe['system']
 
-    for _ in range(5):  # retry 5 times
-        try:
-            recipe_detail_xml_str = await bkr_command('system-details', recipe['system'])
-            logger.info(recipe_detail_xml_str)
-            recipe_detail = etree.fromstring(bytes(recipe_detail_xml_str, 'utf8'))
-            break
-        except Exception as error:
-            logger.exception("Get error while processing recipe result")
-            await asyncio.sleep(10)
-
-    system = recipe_detail.find('{}System'.format(NS_INV))
-    controlled_by = system.find('{}controlledBy'.format(NS_INV))
-    lab_controller = controlled_by.find('{}LabController'.format(NS_INV))
-    lab_controller_url = lab_controller.get('{}about'.format(NS_RDF))
-    lab_controller = lab_controller_url.split('/')[-1].split('#')[0]
+    if db is not None:
+        lab_controller, system_info = await Inventory.get(db, recipe['system'])
+    else:
+        lab_controller, system_info = await Inventory.fetch(db, recipe['system'])
 
     ret['lab_controller'] = lab_controller
-
-    for tag, meta in system_tag_map.items():
-        key = meta['name']
-        type_ = meta['type']
-        values = system.findall(tag)
-        if not values:
-            continue
-        if type_ == list:
-            ret[key] = [str(v.text) for v in values]
-        else:
-            if len(values) > 1:
-                logger.error('Expectin only one element for %s, got multiple.', tag)
-            ret[key] = type_(values[0].text)
+    ret.update(system_info)
 
     system_type = ret.get('system-type')
     if not system_type or system_type == 'None':
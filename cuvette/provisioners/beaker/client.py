@@ -0,0 +1,277 @@
+"""
+Clients talking to beaker
+
+HTTPClient talks to beaker server directly with a pooled keep-alive
+aiohttp session, BkrClient forks a bkr command for each call. HTTPClient
+fallback to BkrClient when beaker can't be reached after retries.
+
+Both clients have the same interface and return the same types:
+job_results -> job results XML string
+jobs_results -> job results XML string of several jobs under a <jobs> root
+job_submit -> job id like "J:123"
+job_cancel -> None
+system_details -> system details RDF XML string
+
+Submitting a job is not idempotent, it's only retried or sent through
+the fallback when the request never reached beaker.
+"""
+import re
+import asyncio
+import logging
+import xmlrpc.client
+
+from asyncio.subprocess import PIPE, STDOUT
+from xml.parsers.expat import ExpatError
+
+import aiohttp
+
+from cuvette.settings import Settings
+from cuvette.utils.exceptions import ProvisionError
+
+logger = logging.getLogger(__name__)
+
+RETRY = 3
+
+RETRY_BACKOFF = 1
+
+REQUEST_TIMEOUT = 60
+
+MAX_CONNECTIONS = 20
+
+# Faults beaker returns for calls without a valid session
+AUTH_FAULT_RE = re.compile(r'IdentityFailure|Anonymous access denied|[Pp]lease log in')
+
+XML_DECLARATION_RE = re.compile(r'<\?xml[^>]*\?>')
+
+
+class BeakerClientError(ProvisionError):
+    """
+    Raised when beaker returned an error
+    """
+    pass
+
+
+class BeakerAuthError(BeakerClientError):
+    """
+    Raised when beaker rejected the credential or the session
+    """
+    pass
+
+
+# Failed before the request was sent, safe to send any request again
+CONNECT_ERRORS = (aiohttp.ClientConnectorError, ConnectionRefusedError)
+
+# The request may or may not have reached beaker
+REQUEST_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, OSError)
+
+
+def join_job_results(documents):
+    """
+    Join job results documents into one document under a <jobs> root
+    """
+    return '<jobs>{}</jobs>'.format(''.join(XML_DECLARATION_RE.sub('', document) for document in documents))
+
+
+class BkrClient(object):
+    """
+    Call beaker with bkr command
+    """
+    async def command(self, *args, input=None):
+        p = await asyncio.create_subprocess_exec(
+            *(['bkr'] + list(args)),
+            stdin=PIPE, stdout=PIPE, stderr=STDOUT)
+        stdout, stderr = await p.communicate(input=bytes(input, 'utf8') if input else None)
+        if stderr:
+            logger.error("Failed calling bkr with error: %s", stderr)
+        return stdout.decode('utf8')
+
+    async def job_results(self, job_id: str):
+        return await self.command('job-results', job_id)
+
+    async def jobs_results(self, job_ids):
+        # bkr prints results of every job one after another
+        return join_job_results([await self.command('job-results', *job_ids)])
+
+    async def job_submit(self, job_xml: str):
+        output = await self.command('job-submit', input=job_xml)
+        match = re.match(r"Submitted: \['(J:[0-9]+)'(?:,)?\]", output)
+        if not match:
+            raise BeakerClientError('Expecting one job id, got: {}'.format(output))
+        return match.groups()[0]
+
+    async def job_cancel(self, job_id: str):
+        await self.command('job-cancel', job_id)
+
+    async def system_details(self, fqdn: str):
+        return await self.command('system-details', fqdn)
+
+    async def close(self):
+        pass
+
+
+class HTTPClient(object):
+    """
+    Call beaker with HTTP and XML-RPC requests through a shared session
+    """
+    def __init__(self, url=None, username=None, password=None, fallback=None):
+        self.url = (url or Settings.BEAKER_URL).rstrip('/')
+        self.username = username if username is not None else Settings.BEAKER_USERNAME
+        self.password = password if password is not None else Settings.BEAKER_PASSWORD
+        self.fallback = fallback
+        self.session = None
+        self.logged_in = False
+        self._login_lock = None
+
+    def get_session(self):
+        if self.session is None or self.session.closed:
+            # unsafe cookie jar accepts cookies from IP address, eg. a local fake server
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=MAX_CONNECTIONS),
+                cookie_jar=aiohttp.CookieJar(unsafe=True))
+            self.logged_in = False
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def _retry(self, request, *args, errors=REQUEST_ERRORS):
+        """
+        Retry on given errors with exponential backoff
+        """
+        for retry in range(RETRY):
+            try:
+                return await asyncio.wait_for(request(*args), timeout=REQUEST_TIMEOUT)
+            except errors as error:
+                if retry == RETRY - 1:
+                    raise
+                logger.warning('Failed requesting beaker (%s), retry in %ss', error, RETRY_BACKOFF * 2 ** retry)
+                await asyncio.sleep(RETRY_BACKOFF * 2 ** retry)
+
+    async def _get(self, path, params=None):
+        async with self.get_session().get(self.url + path, params=params) as response:
+            text = await response.text()
+            if response.status >= 500:
+                raise aiohttp.ClientError('Beaker server error {}'.format(response.status))
+            elif response.status >= 400:
+                raise BeakerClientError('Beaker returned {} for {}: {}'.format(response.status, path, text))
+            return text
+
+    async def _call(self, method, *params):
+        body = xmlrpc.client.dumps(params, method, allow_none=True)
+        async with self.get_session().post(self.url + '/RPC2', data=body,
+                                           headers={'Content-Type': 'text/xml'}) as response:
+            text = await response.text()
+            if response.status >= 500:
+                raise aiohttp.ClientError('Beaker server error {}'.format(response.status))
+            elif response.status in (401, 403):
+                raise BeakerAuthError('Beaker returned {} for {}'.format(response.status, method))
+            elif response.status >= 400:
+                raise BeakerClientError('Beaker returned {} for {}: {}'.format(response.status, method, text))
+        try:
+            return xmlrpc.client.loads(text)[0][0]
+        except xmlrpc.client.Fault as fault:
+            if AUTH_FAULT_RE.search(fault.faultString):
+                raise BeakerAuthError('Beaker call {} failed: {}'.format(method, fault.faultString))
+            raise BeakerClientError('Beaker call {} failed: {}'.format(method, fault.faultString))
+        except (ExpatError, xmlrpc.client.ResponseError) as error:
+            raise BeakerClientError('Invalid response of beaker call {}: {}'.format(method, error))
+
+    async def login(self, force=False):
+        if self._login_lock is None:
+            self._login_lock = asyncio.Lock()
+        async with self._login_lock:
+            if self.logged_in and not force:
+                return
+            if not self.username:
+                raise BeakerAuthError('No beaker credential configured')
+            try:
+                await self._retry(self._call, 'auth.login_password', self.username, self.password)
+            except BeakerClientError as error:
+                raise BeakerAuthError('Failed login to beaker: {}'.format(error))
+            self.logged_in = True
+
+    async def _authenticated_call(self, method, *params, idempotent=True):
+        """
+        Call with a logged in session, non idempotent calls are only
+        retried when they never reached beaker or were rejected for auth
+        """
+        errors = REQUEST_ERRORS if idempotent else CONNECT_ERRORS
+        await self.login()
+        try:
+            return await self._retry(self._call, method, *params, errors=errors)
+        except BeakerAuthError:
+            # Session might be expired
+            await self.login(force=True)
+            return await self._retry(self._call, method, *params, errors=errors)
+
+    async def _with_fallback(self, name, request, *args, errors=REQUEST_ERRORS + (BeakerClientError, )):
+        try:
+            return await request(*args)
+        except errors as error:
+            if self.fallback is None:
+                raise
+            logger.warning('Beaker HTTP %s failed (%s), fallback to bkr command', name, error)
+            return await getattr(self.fallback, name)(*args)
+
+    async def _job_results(self, job_id: str):
+        return await self._retry(self._get, '/to_xml', {'taskid': job_id, 'pretty': 'False'})
+
+    async def _jobs_results(self, job_ids):
+        """
+        Beaker only serves results of one job per request, fetch them
+        concurrently over the shared session, jobs failed to fetch are
+        left out unless all of them failed
+        """
+        results = await asyncio.gather(*[self._job_results(job_id) for job_id in job_ids],
+                                       return_exceptions=True)
+        documents = [result for result in results if not isinstance(result, Exception)]
+        if results and not documents:
+            raise results[0]
+        for job_id, result in zip(job_ids, results):
+            if isinstance(result, Exception):
+                logger.error('Failed fetching results of beaker job %s: %s', job_id, result)
+        return join_job_results(documents)
+
+    async def _job_submit(self, job_xml: str):
+        return await self._authenticated_call('jobs.upload', job_xml, idempotent=False)
+
+    async def _job_cancel(self, job_id: str):
+        await self._authenticated_call('taskactions.stop', job_id, 'cancel', 'Cancelled by cuvette')
+
+    async def _system_details(self, fqdn: str):
+        return await self._retry(self._get, '/view/{}'.format(fqdn), {'tg_format': 'rdfxml'})
+
+    async def job_results(self, job_id: str):
+        return await self._with_fallback('job_results', self._job_results, job_id)
+
+    async def jobs_results(self, job_ids):
+        return await self._with_fallback('jobs_results', self._jobs_results, job_ids)
+
+    async def job_submit(self, job_xml: str):
+        # Job might be created already, only fallback when it's surely not
+        return await self._with_fallback('job_submit', self._job_submit, job_xml,
+                                         errors=CONNECT_ERRORS + (BeakerAuthError, ))
+
+    async def job_cancel(self, job_id: str):
+        return await self._with_fallback('job_cancel', self._job_cancel, job_id)
+
+    async def system_details(self, fqdn: str):
+        return await self._with_fallback('system_details', self._system_details, fqdn)
+
+
+_client = None
+
+
+def get_client():
+    """
+    Get the shared beaker client according to settings
+    """
+    global _client
+    if _client is None:
+        if Settings.BEAKER_CLIENT == 'http':
+            _client = HTTPClient(fallback=BkrClient())
+        else:
+            _client = BkrClient()
+    return _client
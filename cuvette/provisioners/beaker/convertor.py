@@ -1,10 +1,16 @@
 """
 Translate query dict into beaker xml
 Raise ValidateError if any query param is illegal
+
+Generated job XML is cached by the query, the static part of a recipe
+is built once as a template and copied for every recipe.
 """
+import copy
+import json
+import hashlib
+import collections
 
 from lxml import etree
-from xml.dom import minidom
 from xml.etree.ElementTree import Element
 
 from cuvette.utils.exceptions import ValidateError
@@ -13,6 +19,11 @@ from cuvette.settings import Settings
 
 DEFAULTS = Settings.BEAKER_JOB_DEFAULTS
 
+JOB_XML_CACHE_SIZE = 256
+
+# Keys in a sanitized query which don't affect the generated XML
+NON_XML_KEYS = ['lifespan']
+
 
 ACCEPT_PARAMS = {
     'system-type': {
@@ -168,14 +179,12 @@ def fill_packages(root: Element, query: dict):
     """
     Fill packages element for beaker job XML according to parameters
     """
-    pkg_names = set(DEFAULTS['job-packages'])
+    check_packages(query)
     packages = query.get('packages')
-    if packages:
-        if isinstance(packages, list):
-            pkg_names.extend(packages)
-        else:
-            raise ValidateError('Packages must be a list of package names')
-    for pkg_name in pkg_names:
+    if not packages:
+        return  # Default packages are in the recipe template already
+    pkg_names = set(packages) - set(DEFAULTS['job-packages'])
+    for pkg_name in sorted(pkg_names):
         package_ele = etree.SubElement(root, 'package')
         package_ele.set('name', pkg_name)
 
@@ -203,7 +212,7 @@ def fill_cpu(root: Element, sanitized_query: dict):
 
     cpu_vendor = None
     if sanitized_query.get('cpu-vendor'):
-        cpu_vendor = cpu_vendor_alias.get(value, value)
+        cpu_vendor = cpu_vendor_alias.get(sanitized_query['cpu-vendor'], sanitized_query['cpu-vendor'])
 
     if cpu_models:
         or_op = etree.SubElement(root, 'or')
@@ -259,10 +268,8 @@ def fill_host_requirements(host_requires: Element, sanitized_query: dict):
         require.set("op", op)
         require.set("value", str(value))
 
-    if sanitized_query.get('system-type', 'baremetal') == 'baremetal':
-        add_requirement('hypervisor', '=', '')
-    else:
-        raise ValidateError('System type other that baremetal is not supported yet.')
+    check_system_type(sanitized_query)
+    add_requirement('hypervisor', '=', '')
 
     if sanitized_query.get('cpu-arch'):
         add_requirement('arch', '=', sanitized_query.get('cpu-arch'))
@@ -293,14 +300,6 @@ def add_reserve_task(recipe: Element, sanitized_query: dict):
     """
     Use a reserve task to reserve a machine.
     """
-    task = etree.SubElement(recipe, 'task')
-    task.set('name', '/distribution/dummy')
-    task.set('role', 'STANDALONE')
-    task_params = etree.SubElement(task, 'params')
-    task_param = etree.SubElement(task_params, 'param')
-    task_param.set('name', 'RSTRNT_DISABLED')
-    task_param.set('value', '01_dmesg_check 10_avc_check')
-
     task = etree.SubElement(recipe, 'task')
     task.set('name', '/distribution/reservesys')
     task.set('role', 'STANDALONE')
@@ -312,10 +311,13 @@ def add_reserve_task(recipe: Element, sanitized_query: dict):
     task_param.set('name', 'RESERVETIME')
     task_param.set('value', str(reserve_time))
 
-    sanitized_query['lifespan'] = reserve_time * 2
 
+def build_recipe_template():
+    """
+    Build the part of a recipe which doesn't depend on the query
+    """
+    recipe = etree.Element('recipe')
 
-def fill_boilerplate_recipe(recipe: Element, sanitized_query: dict):
     # Some default params
     recipe.set('whiteboard', DEFAULTS['job-whiteboard'])  # TODO
     recipe.set('role', 'None')
@@ -332,33 +334,103 @@ def fill_boilerplate_recipe(recipe: Element, sanitized_query: dict):
     watchdog = etree.SubElement(recipe, 'watchdog')
     watchdog.set('panic', 'ignore')
 
-    host_requires = etree.SubElement(recipe, 'hostRequires')
+    etree.SubElement(recipe, 'hostRequires')
 
     ks_appends = etree.SubElement(recipe, 'ks_appends')
-    repos = etree.SubElement(recipe, 'repos')
-    distro_requires = etree.SubElement(recipe, 'distroRequires')
+    etree.SubElement(recipe, 'repos')
+    etree.SubElement(recipe, 'distroRequires')
     packages = etree.SubElement(recipe, 'packages')
 
-    fill_ks_appends(ks_appends, sanitized_query)
-    fill_packages(packages, sanitized_query)
-    fill_repos(repos, sanitized_query)
-    fill_distro_requires(distro_requires, sanitized_query)
+    fill_ks_appends(ks_appends, {})
+    for pkg_name in sorted(set(DEFAULTS['job-packages'])):
+        package_ele = etree.SubElement(packages, 'package')
+        package_ele.set('name', pkg_name)
 
-    fill_host_requirements(host_requires, sanitized_query)
+    # Dummy task runs before the reserve task
+    task = etree.SubElement(recipe, 'task')
+    task.set('name', '/distribution/dummy')
+    task.set('role', 'STANDALONE')
+    task_params = etree.SubElement(task, 'params')
+    task_param = etree.SubElement(task_params, 'param')
+    task_param.set('name', 'RSTRNT_DISABLED')
+    task_param.set('value', '01_dmesg_check 10_avc_check')
 
+    return recipe
 
-def convert_query_to_beaker_xml(sanitized_query: dict):
+
+RECIPE_TEMPLATE = build_recipe_template()
+
+
+def fill_boilerplate_recipe(recipe: Element, sanitized_query: dict):
+    fill_packages(recipe.find('packages'), sanitized_query)
+    fill_repos(recipe.find('repos'), sanitized_query)
+    fill_distro_requires(recipe.find('distroRequires'), sanitized_query)
+
+    fill_host_requirements(recipe.find('hostRequires'), sanitized_query)
+
+
+def check_system_type(sanitized_query: dict):
+    if sanitized_query.get('system-type', 'baremetal') != 'baremetal':
+        raise ValidateError('System type other that baremetal is not supported yet.')
+
+
+def check_packages(query: dict):
+    packages = query.get('packages')
+    if packages and not isinstance(packages, list):
+        raise ValidateError('Packages must be a list of package names')
+
+
+def validate_query(sanitized_query: dict):
+    """
+    Raise ValidateError if the query can't be converted,
+    same checks as the conversion without building anything
+    """
+    check_system_type(sanitized_query)
+    check_packages(sanitized_query)
+
+
+def query_hash(sanitized_query: dict):
+    """
+    Canonical hash of a sanitized query, equal queries get equal hash
+    no matter the key order
+    """
+    canonical = json.dumps(
+        dict((key, value) for key, value in sanitized_query.items() if key not in NON_XML_KEYS),
+        sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha1(canonical.encode('utf8')).hexdigest()
+
+
+def build_beaker_xml(sanitized_query: dict):
     job = boilerplate_job(sanitized_query)
 
     # Use normal priority by default
     recipe_set = etree.SubElement(job, 'recipeSet')
     recipe_set.set('priority', 'Normal')
 
-    # Always only one recipe
-    for _ in range(sanitized_query.get('provision-count', 1)):
-        recipe = etree.SubElement(recipe_set, 'recipe')
-        fill_boilerplate_recipe(recipe, sanitized_query)
-        add_reserve_task(recipe, sanitized_query)
+    recipe = copy.deepcopy(RECIPE_TEMPLATE)
+    fill_boilerplate_recipe(recipe, sanitized_query)
+    add_reserve_task(recipe, sanitized_query)
+
+    # Recipes for a multi host job are identical
+    for _ in range(sanitized_query.get('provision-count', 1) - 1):
+        recipe_set.append(copy.deepcopy(recipe))
+    recipe_set.append(recipe)
 
-    pretty_xml = minidom.parseString(etree.tostring(job)).toprettyxml(indent="  ")
-    return pretty_xml
+    return etree.tostring(job, pretty_print=True, encoding='unicode')
+
+
+_job_xml_cache = collections.OrderedDict()
+
+
+def convert_query_to_beaker_xml(sanitized_query: dict):
+    key = query_hash(sanitized_query)
+    job_xml = _job_xml_cache.get(key)
+    if job_xml is None:
+        job_xml = build_beaker_xml(sanitized_query)
+        _job_xml_cache[key] = job_xml
+        if len(_job_xml_cache) > JOB_XML_CACHE_SIZE:
+            _job_xml_cache.popitem(last=False)
+    else:
+        _job_xml_cache.move_to_end(key)
+    sanitized_query['lifespan'] = sanitized_query.get('provision-lifespan', 86400) * 2
+    return job_xml
@@ -0,0 +1,155 @@
+"""
+A fake beaker server for developing and testing offline
+
+Implements the part of beaker API used by HTTPClient, jobs move one
+step forward every time their results are fetched, until all recipes
+are reserved (status Running, result Pass).
+
+Run with:
+    python -m cuvette.provisioners.beaker.fake_server 8000
+and set APP_BEAKER_URL to http://localhost:8000
+"""
+import sys
+import uuid
+import itertools
+import xmlrpc.client
+
+from aiohttp import web
+from lxml import etree
+
+NS_INV = 'https://fedorahosted.org/beaker/rdfschema/inventory#'
+NS_RDF = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#'
+
+RECIPE_STEPS = [
+    ('Queued', 'New'),
+    ('Scheduled', 'New'),
+    ('Waiting', 'New'),
+    ('Installing', 'New'),
+    ('Running', 'Pass'),
+]
+
+
+class FakeBeaker(object):
+    def __init__(self, systems=None, steps=RECIPE_STEPS):
+        self.systems = systems or ['fake-{}.example.com'.format(idx) for idx in range(100)]
+        self.steps = steps
+        self.jobs = {}
+        self.job_ids = itertools.count(1)
+        self.recipe_ids = itertools.count(1)
+        self.sessions = set()
+        self.requests = 0
+
+    def _free_systems(self):
+        used = set(recipe['system'] for job in self.jobs.values()
+                   for recipe in job['recipes'] if job['status'] != 'Cancelled')
+        return [system for system in self.systems if system not in used]
+
+    def upload(self, job_xml):
+        job = etree.fromstring(job_xml.encode('utf8'))
+        recipes = job.findall('.//recipe')
+        systems = self._free_systems()
+        if len(recipes) > len(systems):
+            raise xmlrpc.client.Fault(1, 'No enough systems')
+        job_id = next(self.job_ids)
+        self.jobs[job_id] = {
+            'status': 'Queued',
+            'step': 0,
+            'recipes': [{
+                'id': str(next(self.recipe_ids)),
+                'system': systems[idx],
+                'arch': 'x86_64',
+                'distro': 'RHEL-7.4',
+                'family': 'RedHatEnterpriseLinux7',
+                'variant': 'Server',
+                'start_time': '2017-01-01 00:00:00',
+            } for idx in range(len(recipes))],
+        }
+        return 'J:{}'.format(job_id)
+
+    def stop(self, task_id, action, message):
+        job = self.jobs.get(int(task_id.split(':')[-1]))
+        if job is None:
+            raise xmlrpc.client.Fault(1, 'No such job {}'.format(task_id))
+        job['status'] = 'Cancelled'
+        return True
+
+    def to_xml(self, task_id):
+        job = self.jobs.get(int(task_id.split(':')[-1]))
+        if job is None:
+            return None
+        if job['status'] == 'Cancelled':
+            status, result = 'Cancelled', 'Warn'
+        else:
+            status, result = self.steps[min(job['step'], len(self.steps) - 1)]
+            job['step'] += 1
+        root = etree.Element('job', id=task_id.split(':')[-1])
+        recipe_set = etree.SubElement(root, 'recipeSet')
+        for recipe in job['recipes']:
+            etree.SubElement(recipe_set, 'recipe', status=status, result=result, **recipe)
+        return etree.tostring(root).decode('utf8')
+
+    def system_details(self, fqdn):
+        nsmap = {'inv': NS_INV, 'rdf': NS_RDF}
+        root = etree.Element('{%s}RDF' % NS_RDF, nsmap=nsmap)
+        system = etree.SubElement(root, '{%s}System' % NS_INV)
+        system.set('{%s}about' % NS_RDF, 'http://fake/view/{}#system'.format(fqdn))
+        controlled_by = etree.SubElement(system, '{%s}controlledBy' % NS_INV)
+        lab_controller = etree.SubElement(controlled_by, '{%s}LabController' % NS_INV)
+        lab_controller.set('{%s}about' % NS_RDF, 'http://fake/lc/lab.example.com#lc')
+        for tag, value in [('cpuVendor', 'GenuineIntel'), ('cpuModelId', '42'), ('cpuFamilyId', '6'),
+                           ('cpuCount', '8'), ('cpuSocketCount', '1'), ('cpuSpeed', '2400.0'),
+                           ('cpuModelName', 'Fake CPU'), ('numaNodes', '1'), ('memory', '16384'),
+                           ('model', 'Fake'), ('vendor', 'Fake'),
+                           ('macAddress', '52:54:00:{:02x}:00:01'.format(len(fqdn) % 256))]:
+            etree.SubElement(system, '{%s}%s' % (NS_INV, tag)).text = value
+        for flag in ['fpu', 'sse', 'avx', 'pdpe1gb']:
+            etree.SubElement(system, '{%s}cpuFlag' % NS_INV).text = flag
+        return etree.tostring(root).decode('utf8')
+
+    async def handle_rpc(self, request):
+        self.requests += 1
+        params, method = xmlrpc.client.loads(await request.text())
+        response = web.Response(content_type='text/xml')
+        try:
+            if method == 'auth.login_password':
+                session = str(uuid.uuid4())
+                self.sessions.add(session)
+                response.set_cookie('beaker_auth_token', session)
+                result = params[0]
+            elif request.cookies.get('beaker_auth_token') not in self.sessions:
+                raise xmlrpc.client.Fault(1, 'Anonymous access denied')
+            elif method == 'jobs.upload':
+                result = self.upload(*params)
+            elif method == 'taskactions.stop':
+                result = self.stop(*params)
+            else:
+                raise xmlrpc.client.Fault(1, 'Unknown method {}'.format(method))
+            response.text = xmlrpc.client.dumps((result, ), methodresponse=True, allow_none=True)
+        except xmlrpc.client.Fault as fault:
+            response.text = xmlrpc.client.dumps(fault, methodresponse=True)
+        return response
+
+    async def handle_to_xml(self, request):
+        self.requests += 1
+        job_xml = self.to_xml(request.query['taskid'])
+        if job_xml is None:
+            raise web.HTTPNotFound()
+        return web.Response(text=job_xml, content_type='text/xml')
+
+    async def handle_system_details(self, request):
+        self.requests += 1
+        fqdn = request.match_info['fqdn']
+        if fqdn not in self.systems:
+            raise web.HTTPNotFound()
+        return web.Response(text=self.system_details(fqdn), content_type='application/rdf+xml')
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_post('/RPC2', self.handle_rpc)
+        app.router.add_get('/to_xml', self.handle_to_xml)
+        app.router.add_get('/view/{fqdn}', self.handle_system_details)
+        return app
+
+
+if __name__ == '__main__':
+    web.run_app(FakeBeaker().create_app(), port=int(sys.argv[1]) if len(sys.argv) > 1 else 8000)
@@ -0,0 +1,165 @@
+"""
+Beaker system inventory cache
+
+System details of beaker systems are cached in MongoDB, keyed by fqdn.
+Provisions read the cached details and don't wait for beaker, details
+older than INVENTORY_REFRESH_AGE are refreshed in background, and a
+refresher loop keeps cached systems fresh. Systems not used by any
+provision for INVENTORY_TTL are dropped by a TTL index.
+"""
+import asyncio
+import logging
+import datetime
+
+from cuvette.utils.exceptions import ProvisionError
+
+from .client import get_client
+from .parser import parse_system_details
+
+logger = logging.getLogger(__name__)
+
+INVENTORY_TTL = 2592000
+
+INVENTORY_REFRESH_AGE = 86400
+
+INVENTORY_REFRESH_INTERVAL = 3600
+
+# Max number of systems refreshed at the same time by the refresher
+INVENTORY_REFRESH_CONCURRENCY = 4
+
+FETCH_RETRY = 5
+
+FETCH_RETRY_INTERVAL = 10
+
+
+def get_inventory_collection(db):
+    return db.beaker_systems
+
+
+class SystemInventory(object):
+    def __init__(self):
+        self.db = None
+        self._fetching = {}
+        self._indexed = False
+        self._refresher = None
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'refreshes': 0,
+            'failures': 0,
+        }
+
+    def get_stats(self):
+        return dict(self.stats)
+
+    async def _ensure_index(self, db):
+        if not self._indexed:
+            await get_inventory_collection(db).create_index(
+                'used', expireAfterSeconds=INVENTORY_TTL, name='inventory_ttl')
+            self._indexed = True
+
+    async def _fetch(self, db, fqdn):
+        for retry in range(FETCH_RETRY):
+            try:
+                system_details = await get_client().system_details(fqdn)
+                lab_controller, info = parse_system_details(system_details)
+                break
+            except Exception:
+                logger.exception("Get error while fetching system details of %s", fqdn)
+                if retry == FETCH_RETRY - 1:
+                    self.stats['failures'] += 1
+                    raise ProvisionError('Failed fetching system details of {}'.format(fqdn))
+                await asyncio.sleep(FETCH_RETRY_INTERVAL)
+        if db is not None:
+            await self._ensure_index(db)
+            now = datetime.datetime.now()
+            await get_inventory_collection(db).update_one({'_id': fqdn}, {
+                '$set': {
+                    'lab_controller': lab_controller,
+                    'info': info,
+                    'updated': now,
+                },
+                '$setOnInsert': {
+                    'used': now,
+                },
+            }, upsert=True)
+        return lab_controller, info
+
+    def fetch(self, db, fqdn):
+        """
+        Fetch system details from beaker and update the cache if db
+        is given, concurrent fetches of the same system share one request
+        """
+        future = self._fetching.get(fqdn)
+        if future is None or future.done():
+            future = self._fetching[fqdn] = asyncio.ensure_future(self._fetch(db, fqdn))
+            future.add_done_callback(
+                lambda done: self._fetching.get(fqdn) is done and self._fetching.pop(fqdn))
+        return asyncio.shield(future)
+
+    def _refresh_later(self, db, fqdn):
+        self.stats['refreshes'] += 1
+        future = self.fetch(db, fqdn)
+        # Failure is already logged, consume it
+        future.add_done_callback(lambda future: future.cancelled() or future.exception())
+
+    async def get(self, db, fqdn: str):
+        """
+        Return (lab_controller, system info) of a system, only wait
+        for beaker when the system is not cached
+        """
+        self.start(db)
+        entry = await get_inventory_collection(db).find_one_and_update(
+            {'_id': fqdn}, {'$set': {'used': datetime.datetime.now()}})
+        if entry is None:
+            self.stats['misses'] += 1
+            return await self.fetch(db, fqdn)
+        self.stats['hits'] += 1
+        if datetime.datetime.now() - entry['updated'] > datetime.timedelta(seconds=INVENTORY_REFRESH_AGE):
+            self._refresh_later(db, fqdn)
+        return entry['lab_controller'], entry['info']
+
+    async def refresh_stale(self, db):
+        """
+        Refresh cached systems older than INVENTORY_REFRESH_AGE
+        """
+        semaphore = asyncio.Semaphore(INVENTORY_REFRESH_CONCURRENCY)
+        deadline = datetime.datetime.now() - datetime.timedelta(seconds=INVENTORY_REFRESH_AGE)
+
+        async def refresh(fqdn):
+            async with semaphore:
+                try:
+                    await self.fetch(db, fqdn)
+                except ProvisionError:
+                    pass
+                else:
+                    self.stats['refreshes'] += 1
+
+        stale = await get_inventory_collection(db).find(
+            {'updated': {'$lt': deadline}}, projection=['_id']).to_list(None)
+        await asyncio.gather(*[refresh(entry['_id']) for entry in stale])
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(INVENTORY_REFRESH_INTERVAL)
+            try:
+                await self.refresh_stale(self.db)
+            except Exception:
+                logger.exception('Failed refreshing beaker inventory')
+
+    def start(self, db):
+        """
+        Start the refresher, called on first use since provisioners
+        don't have the database at load time
+        """
+        self.db = db
+        if self._refresher is None or self._refresher.done():
+            self._refresher = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        if self._refresher is not None:
+            self._refresher.cancel()
+            self._refresher = None
+
+
+Inventory = SystemInventory()
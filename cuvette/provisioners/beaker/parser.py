@@ -0,0 +1,143 @@
+"""
+Parsers for beaker job results and system details
+"""
+import logging
+
+from lxml import etree
+
+from cuvette.settings import Settings
+
+logger = logging.getLogger(__name__)
+
+NS_INV = '{https://fedorahosted.org/beaker/rdfschema/inventory#}'
+NS_RDF = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}'
+
+SYSTEM_TAG = '{}System'.format(NS_INV)
+CONTROLLED_BY_TAG = '{}controlledBy'.format(NS_INV)
+LAB_CONTROLLER_TAG = '{}LabController'.format(NS_INV)
+ABOUT_ATTR = '{}about'.format(NS_RDF)
+
+SYSTEM_TAG_MAP = {
+    '{}cpuSpeed'.format(NS_INV): {
+        'name': 'cpu-speed',
+        'type': float,
+    },
+    '{}cpuVendor'.format(NS_INV): {
+        'name': 'cpu-vendor',
+        'type': str,
+    },
+    '{}cpuFamilyId'.format(NS_INV): {
+        'name': 'cpu-family',
+        'type': int,
+    },
+    '{}cpuModelId'.format(NS_INV): {
+        'name': 'cpu-model',
+        'type': int,
+    },
+    '{}cpuCount'.format(NS_INV): {
+        'name': 'cpu-core_number',
+        'type': int,
+    },
+    '{}cpuSocketCount'.format(NS_INV): {
+        'name': 'cpu-socket_number',
+        'type': int,
+    },
+    '{}cpuFlag'.format(NS_INV): {
+        'name': 'cpu-flags',
+        'type': list,
+    },
+    '{}cpuStepping'.format(NS_INV): {
+        'name': 'cpu-stepping',
+        'type': list,
+    },
+    '{}cpuModelName'.format(NS_INV): {
+        'name': 'cpu-model_name',
+        'type': str,
+    },
+    '{}numaNodes'.format(NS_INV): {
+        'name': 'numa-node_number',
+        'type': int,
+    },
+    '{}model'.format(NS_INV): {
+        'name': 'system-model',
+        'type': str,
+    },
+    '{}vendor'.format(NS_INV): {
+        'name': 'system-vendor',
+        'type': str,
+    },
+    '{}memory'.format(NS_INV): {
+        'name': 'memory-total_size',
+        'type': int,
+    },
+    '{}macAddress'.format(NS_INV): {
+        'name': 'net-mac_address',
+        'type': str,
+    },
+    # TODO
+    # '{}hasDevice'.format(NS_INV): {
+    # },
+}
+
+
+def build_dispatch_table(extra=None):
+    """
+    Map tag to (key, type) for every interesting child of System
+    """
+    tag_map = dict(SYSTEM_TAG_MAP)
+    tag_map.update(extra or {})
+    return dict((tag, (meta['name'], meta['type'])) for tag, meta in tag_map.items())
+
+
+SYSTEM_DISPATCH = build_dispatch_table(Settings.EXTRA_BEAKER_NS_MAP)
+
+
+def _parse(document):
+    if isinstance(document, str):
+        # lxml refuses str with an encoding declaration
+        document = document.encode('utf8')
+    return etree.fromstring(document)
+
+
+def parse_job_recipes(document):
+    """
+    Return attributes of every recipe in a job results document
+    """
+    return [dict(recipe.attrib) for recipe in _parse(document).iter('recipe')]
+
+
+def parse_jobs_recipes(document):
+    """
+    Return {job id: [recipe attributes]} of a document with results of
+    one or more jobs, job ids are like "J:123"
+    """
+    return dict(('J:{}'.format(job.get('id')), [dict(recipe.attrib) for recipe in job.iter('recipe')])
+                for job in _parse(document).iter('job'))
+
+
+def parse_system_details(document, dispatch=SYSTEM_DISPATCH):
+    """
+    Return (lab_controller, {key: value}) of a system details RDF document,
+    lab_controller is None if it's not found
+    """
+    system = _parse(document).find(SYSTEM_TAG)
+    if system is None:
+        return None, {}
+
+    lab_controller = None
+    lab_controller_elem = system.find('{}/{}'.format(CONTROLLED_BY_TAG, LAB_CONTROLLER_TAG))
+    if lab_controller_elem is not None and lab_controller_elem.get(ABOUT_ATTR):
+        lab_controller = lab_controller_elem.get(ABOUT_ATTR).split('/')[-1].split('#')[0]
+
+    ret = {}
+    for tag, (key, type_) in dispatch.items():
+        values = system.findall(tag)
+        if not values:
+            continue
+        if type_ == list:
+            ret[key] = [str(v.text) for v in values]
+        else:
+            if len(values) > 1:
+                logger.error('Expectin only one element for %s, got multiple.', tag)
+            ret[key] = type_(values[0].text)
+    return lab_controller, ret
@@ -0,0 +1,245 @@
+"""
+Shared beaker job status poller
+
+Provisions don't poll beaker by themselves, they wait on the poller for
+the next status of their job. The poller fetches all jobs due in a tick
+with one batched results query, and wakes all waiters of a job with the
+same result. So beaker load grows with the number of ticks instead of
+the number of jobs or waiting coroutines, and there is only one polling
+loop no matter how many jobs are in flight.
+
+When a job is due again is decided by the polling policy,
+BeakerPollingPolicy polls slowly while recipes are queued, faster once
+they are installing, following how long installing usually takes for
+the distro in the lab.
+"""
+import time
+import asyncio
+import logging
+
+from cuvette.provisioners.polling import PollingPolicy, PolledJob, BASELINE_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# Resolution of the poller loop
+TICK_INTERVAL = 1
+
+# Max number of job status requests in flight in one tick
+POLL_CONCURRENCY = 8
+
+# Max number of jobs fetched by one job status request
+POLL_BATCH = 100
+
+# Give up a job after failing to poll it for one day
+FAILURE_TIMEOUT = 86400
+
+# Forget the polling state of a job no one waited for this long
+JOB_IDLE_TIMEOUT = 300
+
+# Recipe status in the order they are reached
+RECIPE_STATES = ['New', 'Processed', 'Queued', 'Scheduled', 'Waiting', 'Installing', 'Running',
+                 'Reserved', 'Completed', 'Cancelled', 'Aborted']
+
+INSTALL_STATES = ['Waiting', 'Installing']
+
+INSTALLED_STATES = ['Running', 'Reserved', 'Completed']
+
+DEFAULT_INSTALL_TIME = 1200
+
+
+class InstallTimeEstimator(object):
+    """
+    Moving average of install time per distro and lab controller
+    """
+    def __init__(self, default=DEFAULT_INSTALL_TIME, weight=0.3):
+        self.default = default
+        self.weight = weight
+        self.install_times = {}
+        self.system_labs = {}
+
+    def learn_system(self, system: str, lab_controller: str):
+        self.system_labs[system] = lab_controller
+
+    def _keys(self, recipe):
+        distro, lab_controller = recipe.get('distro'), self.system_labs.get(recipe.get('system'))
+        if lab_controller is None:
+            return [(distro, None)]
+        return [(distro, lab_controller), (distro, None)]
+
+    def record(self, recipe: dict, seconds: float):
+        for key in self._keys(recipe):
+            average = self.install_times.get(key)
+            self.install_times[key] = seconds if average is None else (
+                average * (1 - self.weight) + seconds * self.weight)
+
+    def estimate(self, recipe: dict):
+        for key in self._keys(recipe):
+            if key in self.install_times:
+                return self.install_times[key]
+        return self.default
+
+
+class BeakerPollingPolicy(PollingPolicy):
+    """
+    Poll interval depends on the least progressed recipe of the job
+    """
+    STATE_INTERVALS = {
+        'New': 60,
+        'Processed': 60,
+        'Queued': 60,
+        'Scheduled': 30,
+    }
+
+    def __init__(self, interval=BASELINE_INTERVAL, min_interval=5, max_install_interval=60,
+                 estimator=None, **kwargs):
+        super(BeakerPollingPolicy, self).__init__(interval, **kwargs)
+        self.min_interval = min_interval
+        self.max_install_interval = max_install_interval
+        self.estimator = estimator or InstallTimeEstimator()
+
+    def next_interval(self, job: PolledJob, recipes):
+        if not recipes:
+            return self.interval
+        known = [recipe for recipe in recipes if recipe.get('status') in RECIPE_STATES]
+        if not known:
+            return self.interval
+        slowest = min(known, key=lambda recipe: RECIPE_STATES.index(recipe['status']))
+        state = slowest['status']
+        previous = job.state
+        install_since = getattr(job, 'install_since', None)
+        if job.enter(state):
+            if state in INSTALL_STATES and previous not in INSTALL_STATES:
+                job.install_since = job.state_since
+            elif state in INSTALLED_STATES and install_since is not None:
+                self.estimator.record(slowest, job.state_since - install_since)
+
+        if state in self.STATE_INTERVALS:
+            return self.STATE_INTERVALS[state]
+        elif state in INSTALL_STATES:
+            elapsed = time.monotonic() - job.install_since
+            remaining = self.estimator.estimate(slowest) - elapsed
+            # Halve the wait when getting closer to the expected finish
+            return max(self.min_interval, min(self.max_install_interval, remaining / 2))
+        return self.interval
+
+
+class BeakerJobPoller(object):
+    def __init__(self, fetch, policy=None, concurrency=POLL_CONCURRENCY, batch=POLL_BATCH):
+        """
+        fetch is a coroutine function taking a list of job ids and
+        returning {job_id: recipes}, jobs missing in the return value
+        failed to poll, any exception it raises fails all of the jobs
+        """
+        self.fetch = fetch
+        self.policy = policy or BeakerPollingPolicy()
+        self.concurrency = concurrency
+        self.batch = batch
+        self.waiters = {}
+        self.jobs = {}
+        self._task = None
+        self.stats = {
+            'ticks': 0,
+            'requests': 0,
+            'polls': 0,
+            'failures': 0,
+            'wakeups': 0,
+            'polls_saved': 0,
+        }
+
+    def get_stats(self):
+        ret = dict(self.stats)
+        now = time.monotonic()
+        ret['jobs'] = len(self.jobs)
+        ret['polls_saved'] += sum(job.polls_saved(now=now if job.job_id in self.waiters else job.last_waited)
+                                  for job in self.jobs.values())
+        return ret
+
+    def wait(self, job_id: str):
+        """
+        Return a future resolved with the recipes of given job
+        on the next successful poll of it
+        """
+        future = asyncio.get_event_loop().create_future()
+        self.waiters.setdefault(job_id, []).append(future)
+        job = self.jobs.get(job_id)
+        if job is None:
+            job = self.jobs[job_id] = PolledJob(job_id)
+            job.due = job.since + self.policy.first_interval(job)
+        job.last_waited = time.monotonic()
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self.run())
+        return future
+
+    def _drop_idle(self, now):
+        for job_id, futures in list(self.waiters.items()):
+            futures = [future for future in futures if not future.done()]
+            if futures:
+                self.waiters[job_id] = futures
+            else:
+                del self.waiters[job_id]
+        for job_id, job in list(self.jobs.items()):
+            if job_id not in self.waiters and now - job.last_waited > JOB_IDLE_TIMEOUT:
+                self.stats['polls_saved'] += job.polls_saved(now=job.last_waited)
+                del self.jobs[job_id]
+
+    async def _poll(self, semaphore, job_ids):
+        async with semaphore:
+            return await self.fetch(job_ids)
+
+    def _on_failure(self, job, error, now):
+        self.stats['failures'] += 1
+        job.failures += 1
+        job.failing_since = job.failing_since or now
+        logger.error('Error while fetching beaker job %s: %s', job.job_id, error)
+        if now - job.failing_since < FAILURE_TIMEOUT:
+            # Waiters keep waiting, the job is polled again after backing off
+            job.due = now + self.policy.failure_interval(job)
+            return
+        for future in self.waiters.pop(job.job_id, []):
+            if not future.done():
+                future.set_exception(error)
+        job.failures, job.failing_since = 0, None
+
+    def _on_success(self, job, recipes, now):
+        job.failures, job.failing_since = 0, None
+        job.due = now + self.policy.next_interval(job, recipes)
+        for future in self.waiters.pop(job.job_id, []):
+            if not future.done():
+                future.set_result(recipes)
+                self.stats['wakeups'] += 1
+
+    async def tick(self):
+        now = time.monotonic()
+        self._drop_idle(now)
+        job_ids = [job_id for job_id in self.waiters if self.jobs[job_id].due <= now]
+        if not job_ids:
+            return
+        batches = [job_ids[idx:idx + self.batch] for idx in range(0, len(job_ids), self.batch)]
+        self.stats['ticks'] += 1
+        self.stats['requests'] += len(batches)
+        self.stats['polls'] += len(job_ids)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        results = await asyncio.gather(
+            *[self._poll(semaphore, batch) for batch in batches], return_exceptions=True)
+        now = time.monotonic()
+        for batch, result in zip(batches, results):
+            for job_id in batch:
+                job = self.jobs[job_id]
+                job.polls += 1
+                if isinstance(result, Exception):
+                    self._on_failure(job, result, now)
+                elif not result.get(job_id):
+                    self._on_failure(job, RuntimeError('No recipe found for beaker job {}'.format(job_id)), now)
+                else:
+                    self._on_success(job, result[job_id], now)
+
+    async def run(self):
+        """
+        Poll until no one is waiting, restarted by next wait()
+        """
+        while self.waiters:
+            await asyncio.sleep(TICK_INTERVAL)
+            try:
+                await self.tick()
+            except Exception:
+                logger.exception('Beaker job poller tick failed')
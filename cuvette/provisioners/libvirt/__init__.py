@@ -0,0 +1,275 @@
+"""
+Provision local virtual machines with libvirt
+
+Machines are ready in seconds instead of hours, so this provisioner is
+preferred whenever the query accepts a VM and asks for nothing a VM on
+this host can't provide (specific CPU, NUMA, devices...).
+"""
+import time
+import asyncio
+import logging
+import datetime
+
+from cuvette.settings import Settings
+from cuvette.machine import Machine
+from cuvette.provisioners.base import ProvisionerBase
+from cuvette.provisioners.polling import PollingPolicy, PolledJob
+from cuvette.utils.exceptions import ProvisionError
+
+from .driver import get_driver
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LIFE_SPAN = 86400
+
+DEFAULT_MEMORY = 2048
+
+MAX_MEMORY = 16384
+
+DEFAULT_DISK = 20
+
+MAX_DISK = 200
+
+DEFAULT_VCPUS = 2
+
+# Give up a domain without an address after ten minutes
+BOOT_TIMEOUT = 600
+
+BOOT_POLL_INTERVAL = 2
+
+# Expected seconds to get a booted domain
+COST = 60
+
+SIZE_OPS = ['$eq', '$lt', '$gt', '$lte', '$gte']
+
+ACCEPT_PARAMS = {
+    'system-type': {
+        'type': str,
+        'ops': [None],
+    },
+    'cpu-arch': {
+        'type': str,
+        'ops': [None],
+    },
+    'memory-total_size': {
+        'type': int,
+        'ops': SIZE_OPS,
+        'description': 'Size in MB',
+    },
+    'disk-total_size': {
+        'type': int,
+        'ops': SIZE_OPS,
+        'description': 'Size in GB',
+    },
+}
+
+# Query params a local VM can't satisfy
+UNSUPPORTED_PARAMS = ['cpu-vendor', 'cpu-model', 'cpu-flags', 'disk-number', 'numa-node_number',
+                      'hvm', 'sriov', 'npiv', 'device_drivers', 'location', 'packages']
+
+
+def pick_size(condition, default: int, maximum: int):
+    """
+    Pick a size closest to default matching the condition,
+    return None if no size up to maximum matches
+    """
+    if condition is None:
+        return default
+    if not isinstance(condition, dict):
+        condition = {'$eq': condition}
+    low, high = 1, maximum
+    for op, value in condition.items():
+        value = int(value)
+        if op == '$eq':
+            low, high = max(low, value), min(high, value)
+        elif op == '$gte':
+            low = max(low, value)
+        elif op == '$gt':
+            low = max(low, value + 1)
+        elif op == '$lte':
+            high = min(high, value)
+        elif op == '$lt':
+            high = min(high, value - 1)
+        else:
+            return None
+    if low > high:
+        return None
+    return min(max(default, low), high)
+
+
+def domain_name(machine):
+    return 'cuvette-{}'.format(machine['magic'])
+
+
+class Provisioner(ProvisionerBase):
+    NAME = 'libvirt'
+    PARAMETERS = ACCEPT_PARAMS
+    POLLING_POLICY = PollingPolicy(interval=BOOT_POLL_INTERVAL)
+
+    def __init__(self):
+        self.stats = {
+            'created': 0,
+            'destroyed': 0,
+            'boot_timeouts': 0,
+            'reused_addresses': 0,
+        }
+        self._create_lock = None
+
+    @property
+    def create_lock(self):
+        # Created lazily so it's binded to the running loop
+        if self._create_lock is None:
+            self._create_lock = asyncio.Lock()
+        return self._create_lock
+
+    def get_stats(self):
+        return dict(self.stats)
+
+    def spec(self, query: dict):
+        """
+        Return the domain spec for the query, None if it can't be satisfied
+        """
+        driver = get_driver()
+        if driver is None:
+            return None
+        if query.get('system-type', 'vm') != 'vm':
+            return None
+        if query.get('cpu-arch', driver.arch) != driver.arch:
+            return None
+        if any(query.get(param) for param in UNSUPPORTED_PARAMS):
+            return None
+        memory = pick_size(query.get('memory-total_size'), DEFAULT_MEMORY, MAX_MEMORY)
+        disk = pick_size(query.get('disk-total_size'), DEFAULT_DISK, MAX_DISK)
+        if memory is None or disk is None:
+            return None
+        return {
+            'memory': memory,
+            'vcpus': DEFAULT_VCPUS,
+            'disk': disk,
+        }
+
+    def avaliable(self, query: dict):
+        """
+        If given query is acceptable by this provisioner
+        """
+        return self.spec(query) is not None
+
+    def cost(self, query: dict):
+        """
+        How much time is likely to be costed provision a machine
+        matches given query
+        """
+        if not self.avaliable(query):
+            return float('inf')
+        return COST
+
+    async def wait_address(self, machine, name: str):
+        driver = get_driver()
+        job = PolledJob(name)
+        interval = self.POLLING_POLICY.first_interval(job)
+        deadline = time.monotonic() + BOOT_TIMEOUT
+        while time.monotonic() < deadline:
+            await machine.refresh()
+            if machine['status'] == 'deleted':
+                raise ProvisionError("Provision cancelled, machine is deleted")
+            address = await driver.address(name)
+            job.polls += 1
+            if address:
+                return address
+            await asyncio.sleep(interval)
+            interval = self.POLLING_POLICY.next_interval(job, None)
+        self.stats['boot_timeouts'] += 1
+        raise ProvisionError("Domain {} got no address after {}s".format(name, BOOT_TIMEOUT))
+
+    async def create_domains(self, machines, spec: dict):
+        """
+        Create domains not created yet, capacity is checked and taken
+        under a lock so concurrent provisions can't overcommit the host
+        """
+        driver = get_driver()
+        async with self.create_lock:
+            missing = []
+            for machine in machines:
+                if await driver.state(domain_name(machine)) is None:
+                    missing.append(machine)
+            if await driver.count() + len(missing) > Settings.LIBVIRT_MAX_DOMAINS:
+                raise ProvisionError("Not enough capacity for {} more domain(s)".format(len(missing)))
+            for machine in machines:
+                await machine.set('meta.libvirt-domain', domain_name(machine))
+            for machine in missing:
+                await driver.create(domain_name(machine), **spec)
+                self.stats['created'] += 1
+
+    async def claim_address(self, machine, address: str):
+        """
+        DHCP may give the address of a gone domain to a new one, drop it
+        from failed or deleted machines still in the pool
+        """
+        holders = await Machine.find_all(machine.db, {'hostname': address, 'magic': {'$ne': machine['magic']}})
+        stale = [holder for holder in holders if holder['status'] in ['failed', 'deleted']]
+        if stale:
+            self.stats['reused_addresses'] += 1
+            await Machine.bulk_unset(stale, 'hostname')
+        if len(stale) < len(holders):
+            raise ProvisionError("Address {} of domain {} is still used by another machine".format(
+                address, domain_name(machine)))
+
+    async def boot(self, machine, spec: dict, sanitized_query: dict):
+        driver = get_driver()
+        address = await self.wait_address(machine, domain_name(machine))
+        await self.claim_address(machine, address)
+        await machine.set({
+            'hostname': address,
+            'system-type': 'vm',
+            'cpu-arch': driver.arch,
+            'memory-total_size': spec['memory'],
+            'disk-total_size': spec['disk'],
+            'disk-number': 1,
+            'start_time': datetime.datetime.now(),
+            'lifespan': sanitized_query.get('provision-lifespan', DEFAULT_LIFE_SPAN),
+        })
+
+    async def provision_all(self, machines, sanitized_query: dict):
+        spec = self.spec(sanitized_query)
+        if spec is None:
+            raise ProvisionError("Query can't be satisfied by a local VM")
+        try:
+            await self.create_domains(machines, spec)
+            results = await asyncio.gather(*[self.boot(machine, spec, sanitized_query) for machine in machines],
+                                           return_exceptions=True)
+        except ProvisionError:
+            await self.teardown(machines, sanitized_query)
+            raise
+        failures = [result for result in results if isinstance(result, Exception)]
+        if failures:
+            await self.teardown(machines, sanitized_query)
+            raise ProvisionError("Failed to boot {} of {} domain(s): {}".format(
+                len(failures), len(machines), failures[0]))
+        return machines
+
+    async def provision(self, machines, sanitized_query: dict):
+        """
+        Trigger the provision with given query
+        """
+        return await self.provision_all(machines, sanitized_query)
+
+    async def resume(self, machines, sanitized_query: dict):
+        """
+        Domains already created are waited for, missing ones are created again
+        """
+        return await self.provision_all(machines, sanitized_query)
+
+    async def teardown(self, machines, query: dict):
+        """
+        Destroy the domains and their storage
+        """
+        driver = get_driver()
+        for machine in machines:
+            await driver.destroy(domain_name(machine))
+            self.stats['destroyed'] += 1
+
+    async def is_teareddown(self, machine, meta: dict, query: dict):
+        """
+        If the domain is gone
+        """
+        return await get_driver().state(domain_name(machine)) is None
@@ -0,0 +1,142 @@
+"""
+Drivers managing local virtual machines
+
+VirshDriver creates domains with virt-install on LIBVIRT_URI, each
+domain gets a copy-on-write disk backed by LIBVIRT_IMAGE, the image is
+expected to boot with sshd running and the key of cuvette authorized.
+FakeDriver keeps domains in memory and boots them instantly, for
+developing and testing without libvirt, each fake domain gets its own
+loopback address so they are all reachable at local sshd.
+
+Both drivers have the same interface:
+create -> None, domain is defined and started
+address -> hostname or IP of the domain, None if not booted yet
+state -> domain state like 'running', None if domain doesn't exist
+destroy -> None, domain and its storage are removed
+"""
+import re
+import asyncio
+import logging
+import platform
+
+from asyncio.subprocess import PIPE
+
+from cuvette.settings import Settings
+from cuvette.utils.exceptions import ProvisionError
+
+logger = logging.getLogger(__name__)
+
+IPV4_RE = re.compile(r'ipv4\s+([0-9.]+)/')
+
+
+class LibvirtDriverError(ProvisionError):
+    """
+    Raised when libvirt returned an error
+    """
+    pass
+
+
+class VirshDriver(object):
+    """
+    Manage domains with virt-install and virsh commands
+    """
+    def __init__(self, uri=None, image=None, network=None):
+        self.uri = uri or Settings.LIBVIRT_URI
+        self.image = image or Settings.LIBVIRT_IMAGE
+        self.network = network or Settings.LIBVIRT_NETWORK
+        self.arch = platform.machine()
+
+    async def command(self, *args, check=True):
+        p = await asyncio.create_subprocess_exec(*args, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        stdout, stderr = await p.communicate()
+        if p.returncode and check:
+            raise LibvirtDriverError('Failed calling {} with error: {}'.format(
+                args[0], stderr.decode('utf8').strip()))
+        return p.returncode, stdout.decode('utf8')
+
+    async def virsh(self, *args, check=True):
+        return await self.command('virsh', '--connect', self.uri, *args, check=check)
+
+    async def create(self, name: str, memory: int, vcpus: int, disk: int):
+        await self.command(
+            'virt-install', '--connect', self.uri,
+            '--name', name,
+            '--memory', str(memory),
+            '--vcpus', str(vcpus),
+            '--disk', 'size={},backing_store={},format=qcow2'.format(disk, self.image),
+            '--network', 'network={}'.format(self.network),
+            '--import', '--noautoconsole', '--noreboot')
+        await self.virsh('start', name)
+
+    async def address(self, name: str):
+        _, output = await self.virsh('domifaddr', name)
+        match = IPV4_RE.search(output)
+        return match.groups()[0] if match else None
+
+    async def state(self, name: str):
+        returncode, output = await self.virsh('domstate', name, check=False)
+        if returncode:
+            return None
+        return output.strip()
+
+    async def destroy(self, name: str):
+        await self.virsh('destroy', name, check=False)
+        await self.virsh('undefine', name, '--remove-all-storage', check=False)
+
+    async def count(self):
+        _, output = await self.virsh('list', '--all', '--name')
+        return len([line for line in output.splitlines() if line.startswith('cuvette-')])
+
+
+class FakeDriver(object):
+    """
+    Keep domains in memory, every domain gets an unique address in 127.0.0.0/8
+    """
+    def __init__(self):
+        self.arch = platform.machine()
+        self.domains = {}
+        self.created = 0
+
+    def _fake_address(self):
+        self.created += 1
+        return '127.{}.{}.{}'.format((self.created >> 16) & 255, (self.created >> 8) & 255, self.created & 255)
+
+    async def create(self, name: str, memory: int, vcpus: int, disk: int):
+        if name in self.domains:
+            raise LibvirtDriverError('Domain {} already exists'.format(name))
+        self.domains[name] = {
+            'memory': memory,
+            'vcpus': vcpus,
+            'disk': disk,
+            'address': self._fake_address(),
+        }
+
+    async def address(self, name: str):
+        return self.domains[name]['address'] if name in self.domains else None
+
+    async def state(self, name: str):
+        return 'running' if name in self.domains else None
+
+    async def destroy(self, name: str):
+        self.domains.pop(name, None)
+
+    async def count(self):
+        return len(self.domains)
+
+
+_driver = None
+
+
+def get_driver():
+    """
+    Get the shared driver according to settings, None if disabled
+    """
+    global _driver
+    if _driver is None:
+        if Settings.LIBVIRT_DRIVER == 'virsh':
+            _driver = VirshDriver()
+        elif Settings.LIBVIRT_DRIVER == 'fake':
+            _driver = FakeDriver()
+        elif Settings.LIBVIRT_DRIVER:
+            raise RuntimeError('Unknown libvirt driver {}'.format(Settings.LIBVIRT_DRIVER))
+    return _driver
@@ -0,0 +1,75 @@
+"""
+Polling policies
+
+A provisioner waiting on a remote service asks its policy how long to
+wait before polling a job again, so it could poll slowly while nothing
+is going to happen, fast when the job is about to finish, and back off
+when the service is failing.
+
+The default policy polls at the baseline interval, every provisioner
+could plug in its own one by setting POLLING_POLICY.
+"""
+import time
+import random
+
+# The fixed interval used before polling became adaptive,
+# polls saved are counted against it
+BASELINE_INTERVAL = 10
+
+MAX_BACKOFF = 600
+
+
+def backoff(failures: int, base=BASELINE_INTERVAL, cap=MAX_BACKOFF, jitter=0.5):
+    """
+    Exponential backoff with jitter for the n-th consecutive failure,
+    jitter spreads the retries of jobs failed at the same time
+    """
+    delay = min(cap, base * 2 ** max(failures - 1, 0))
+    return delay * (1 - jitter * random.random())
+
+
+class PolledJob(object):
+    """
+    Polling state of a job
+    """
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.since = time.monotonic()
+        self.due = None
+        self.polls = 0
+        self.failures = 0
+        self.failing_since = None
+        self.state = None
+        self.state_since = None
+        self.last_waited = self.since
+
+    def enter(self, state):
+        """
+        Record current state, return True if it's changed
+        """
+        if state == self.state:
+            return False
+        self.state, self.state_since = state, time.monotonic()
+        return True
+
+    def polls_saved(self, baseline=BASELINE_INTERVAL, now=None):
+        elapsed = (now or time.monotonic()) - self.since
+        return int(elapsed // baseline) - self.polls
+
+
+class PollingPolicy(object):
+    """
+    Poll at a fixed interval, back off on failures
+    """
+    def __init__(self, interval=BASELINE_INTERVAL, max_backoff=MAX_BACKOFF):
+        self.interval = interval
+        self.max_backoff = max_backoff
+
+    def first_interval(self, job: PolledJob):
+        return self.interval
+
+    def next_interval(self, job: PolledJob, result):
+        return self.interval
+
+    def failure_interval(self, job: PolledJob):
+        return backoff(job.failures, self.interval, self.max_backoff)
@@ -0,0 +1,126 @@
+"""
+Provisioner registry
+
+Picks the cheapest provisioner for a query. Capability checks
+(sanitizing the query, avaliable() and cost() of each provisioner) are
+cached per canonical query, and the static cost of a provisioner is
+corrected by what's learned from past provisions:
+
+    cost = expected time to ready * (1 + QUEUE_WEIGHT * provisions in flight)
+           / chance of success
+
+Expected time to ready starts from the static cost() of the provisioner
+and follows a moving average of past provision time once there is any.
+"""
+import copy
+import json
+import hashlib
+import collections
+
+from cuvette.utils import sanitize_query
+from cuvette.utils.exceptions import ValidateError
+
+CAPABILITY_CACHE_SIZE = 512
+
+# Weight of newest sample in moving averages
+COST_SAMPLE_WEIGHT = 0.2
+
+# How much each provision in flight slows down a new one
+QUEUE_WEIGHT = 0.1
+
+# Never trust a provisioner failing more often than this
+MAX_FAILURE_RATE = 0.9
+
+
+def query_key(query: dict):
+    canonical = json.dumps(query, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha1(canonical.encode('utf8')).hexdigest()
+
+
+class CostModel(object):
+    """
+    Learned cost of one provisioner
+    """
+    def __init__(self):
+        self.time_to_ready = None
+        self.failure_rate = 0.0
+        self.in_flight = 0
+        self.provisions = 0
+
+    def started(self):
+        self.in_flight += 1
+
+    def finished(self, seconds: float, success: bool):
+        self.in_flight = max(self.in_flight - 1, 0)
+        self.provisions += 1
+        self.failure_rate += COST_SAMPLE_WEIGHT * ((0.0 if success else 1.0) - self.failure_rate)
+        if success:
+            self.time_to_ready = seconds if self.time_to_ready is None else (
+                self.time_to_ready + COST_SAMPLE_WEIGHT * (seconds - self.time_to_ready))
+
+    def cost(self, static_cost: float):
+        if static_cost == float('inf'):
+            return static_cost
+        time_to_ready = static_cost if self.time_to_ready is None else self.time_to_ready
+        success_rate = 1 - min(self.failure_rate, MAX_FAILURE_RATE)
+        return time_to_ready * (1 + QUEUE_WEIGHT * self.in_flight) / success_rate
+
+    def to_dict(self):
+        return {
+            'time_to_ready': self.time_to_ready,
+            'failure_rate': self.failure_rate,
+            'in_flight': self.in_flight,
+            'provisions': self.provisions,
+        }
+
+
+class ProvisionerRegistry(object):
+    def __init__(self, provisioners: dict, cache_size=CAPABILITY_CACHE_SIZE):
+        self.provisioners = provisioners
+        self.models = dict((provisioner.NAME, CostModel()) for provisioner in provisioners.values())
+        self.cache_size = cache_size
+        self._capabilities = collections.OrderedDict()
+
+    def capabilities(self, query: dict):
+        """
+        Return [(provisioner, static cost)] of provisioners accepting the query
+        """
+        key = query_key(query)
+        capabilities = self._capabilities.get(key)
+        if capabilities is not None:
+            self._capabilities.move_to_end(key)
+            return capabilities
+        capabilities = []
+        for provisioner in self.provisioners.values():
+            try:
+                sanitized_query = sanitize_query(copy.deepcopy(query), provisioner.PARAMETERS)
+            except ValidateError:
+                continue
+            if provisioner.avaliable(sanitized_query):
+                capabilities.append((provisioner, provisioner.cost(sanitized_query)))
+        self._capabilities[key] = capabilities
+        if len(self._capabilities) > self.cache_size:
+            self._capabilities.popitem(last=False)
+        return capabilities
+
+    def rank(self, query: dict):
+        """
+        Return [(provisioner, cost)] of provisioners accepting the query, cheapest first
+        """
+        return sorted(((provisioner, self.models[provisioner.NAME].cost(static_cost))
+                       for provisioner, static_cost in self.capabilities(query)),
+                      key=lambda item: item[1])
+
+    def find_avaliable(self, query: dict):
+        min_cost, min_cost_provisioner = float('inf'), None
+        for provisioner, static_cost in self.capabilities(query):
+            cost = self.models[provisioner.NAME].cost(static_cost)
+            if cost < min_cost:
+                min_cost, min_cost_provisioner = cost, provisioner
+        return min_cost_provisioner
+
+    def started(self, provisioner):
+        self.models[provisioner.NAME].started()
+
+    def finished(self, provisioner, seconds: float, success: bool):
+        self.models[provisioner.NAME].finished(seconds, success)
@@ -39,6 +39,18 @@ class Settings(object):
 
     BEAKER_URL = 'https://example.com'
 
+    # 'http' to talk to beaker directly (fallback to bkr command on failure), or 'bkr'
+    BEAKER_CLIENT = 'http'
+    BEAKER_USERNAME = ''
+    BEAKER_PASSWORD = ''
+
+    # 'virsh' to create local VMs with virt-install, 'fake' for an in-memory stand-in, empty to disable
+    LIBVIRT_DRIVER = ''
+    LIBVIRT_URI = 'qemu:///system'
+    LIBVIRT_IMAGE = '/var/lib/libvirt/images/cuvette-base.qcow2'
+    LIBVIRT_NETWORK = 'default'
+    LIBVIRT_MAX_DOMAINS = 8
+
     DB_NAME = Required(str)
     DB_USER = Required(str)
     DB_PASSWORD = Required(str)
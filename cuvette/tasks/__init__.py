@@ -10,10 +10,12 @@ from .provision import ProvisionTask
 from .inspect import InspectTask
 from .reserve import ReserveTask
 from .teardown import TeardownTask
+from .transform import TransformTask
 
 logger = logging.getLogger(__name__)
 
-__all__ = ['BaseTask', 'ProvisionTask', 'InspectTask', 'ReserveTask', 'TeardownTask', 'Tasks', 'resume_task']
+__all__ = ['BaseTask', 'ProvisionTask', 'InspectTask', 'ReserveTask', 'TeardownTask', 'TransformTask',
+           'Tasks', 'resume_task']
 
 
 async def retrive_tasks_from_machine(machine):
@@ -32,15 +34,18 @@ async def retrive_tasks_from_machine(machine):
 
 
 async def resume_task(task_uuid, task_type, task_query, machines):
-    for task in [ProvisionTask, InspectTask, ReserveTask, TeardownTask]:
+    """
+    Resume an interrupted task, return the future of its run,
+    None if the task type is unknown
+    """
+    for task in [ProvisionTask, InspectTask, ReserveTask, TeardownTask, TransformTask]:
         if task.TYPE == task_type:
             task = await task.resume(task_uuid, task_query, machines)
-            await asyncio.wait([task.run()], timeout=0)
-            return
+            return asyncio.ensure_future(task.run())
     logger.error("Unknown task type: %s: %s", task_type, task_uuid)
 
 
 Parameters = get_all_parameters(
-    [ProvisionTask, InspectTask, ReserveTask, TeardownTask], 'task',
+    [ProvisionTask, InspectTask, ReserveTask, TeardownTask, TransformTask], 'task',
     name_getter=lambda task: str(task)
 )
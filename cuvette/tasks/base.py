@@ -10,6 +10,7 @@ import abc
 from uuid import uuid1
 from concurrent.futures import ThreadPoolExecutor
 from cuvette.utils import sanitize_query
+from cuvette.machine import Machine
 
 logger = logging.getLogger(__name__)
 
@@ -63,17 +64,21 @@ class BaseTask(object, metaclass=abc.ABCMeta):
         await task._save_task()
         return task
 
+    def to_dict(self):
+        """
+        The task as saved in tasks of machines
+        """
+        return {
+            'query': self.query,
+            'type': self.TYPE,
+            'status': self.status,
+        }
+
     async def _save_task(self):
-        for machine in self.machines:
-            await machine.set('tasks.{}'.format(self.uuid), {
-                'query': self.query,
-                'type': self.TYPE,
-                'status': self.status,
-            })
+        await Machine.bulk_set(self.machines, 'tasks.{}'.format(self.uuid), self.to_dict())
 
     async def _delete_task(self):
-        for machine in self.machines:
-            await machine.unset('tasks.{}'.format(self.uuid))
+        await Machine.bulk_unset(self.machines, 'tasks.{}'.format(self.uuid))
 
     async def on_done(self):
         pass
@@ -4,7 +4,7 @@ Async Executor for tasks.
 Some jobs are synchronous, let them run in executor
 """
 import logging
-from cuvette.inspectors import perform_check
+from cuvette.inspectors import perform_checks
 from cuvette.tasks import BaseTask
 
 logger = logging.getLogger(__name__)
@@ -15,12 +15,17 @@ class InspectTask(BaseTask):
     The helper task to teardown a machine
     """
     TYPE = 'inspect'
+    PARAMETERS = {
+        'inspect-force': {
+            'type': bool,
+            'description': "Ignore cached facts of hosts and inspect everything again"
+        },
+    }
 
     def __init__(self, *args, **kwargs):
         super(InspectTask, self).__init__(*args, **kwargs)
 
     async def routine(self):
-        for machine in self.machines:
-            await perform_check(machine)
+        await perform_checks(self.machines, force=bool(self.query.get('inspect-force')))
 
     resume_routine = routine
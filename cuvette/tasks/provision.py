@@ -3,12 +3,15 @@ Async Executor for tasks.
 
 Some jobs are synchronous, let them run in executor
 """
+import time
 import logging
+import datetime
 
+from cuvette.machine import Machine
 from cuvette.inspectors import perform_check
 from cuvette.tasks import BaseTask
 from cuvette.utils.exceptions import ProvisionError
-from cuvette.provisioners import find_by_name
+from cuvette.provisioners import find_by_name, Registry
 
 logger = logging.getLogger(__name__)
 
@@ -42,28 +45,43 @@ class ProvisionTask(BaseTask):
 
     async def on_start(self):
         await super(ProvisionTask, self).on_start()
-        for machine in self.machines:
-            await machine.set('provisioner', self.provisioner.NAME)
+        await Machine.bulk_set(self.machines, 'provisioner', self.provisioner.NAME)
 
-    async def routine(self):
-        # TODO: Better pre parameters passthrough
-        for machine in self.machines:
-            for key, value in self.query.items():
-                if isinstance(value, str):
-                    machine.setdefault(key, value)
-            await machine.set('provisioner', self.provisioner.NAME)
-            await machine.set('status', 'preparing')
+    async def _run_provisioner(self, provision):
+        """
+        Call provision or resume of the provisioner and record how long it
+        took in the registry, machines are inspected on success and marked
+        failed on provision failure.
+        """
+        started = time.monotonic()
+        success = False
+        Registry.started(self.provisioner)
         try:
-            await self.provisioner.provision(self.machines, self.query)
+            await provision(self.machines, self.query)
+            success = True
         except (ProvisionError, RuntimeError) as error:
             for machine in self.machines:
                 await machine.refresh()
                 if machine['status'] != 'deleted':
                     await machine.fail(error or 'Unknown failure')
-        else:
+        finally:
+            Registry.finished(self.provisioner, time.monotonic() - started, success)
+        if success:
             for machine in self.machines:
                 await perform_check(machine)
 
+    async def routine(self):
+        # TODO: Better pre parameters passthrough
+        for machine in self.machines:
+            for key, value in self.query.items():
+                if isinstance(value, str):
+                    machine.setdefault(key, value)
+        await Machine.bulk_set(self.machines, {
+            'provisioner': self.provisioner.NAME,
+            'status': 'preparing',
+        })
+        await self._run_provisioner(self.provisioner.provision)
+
     async def resume_routine(self):
         # TODO: Better pre parameters passthrough
         for machine in self.machines:
@@ -73,18 +91,11 @@ class ProvisionTask(BaseTask):
             await machine.save()
             if machine['status'] != 'preparing':
                 await machine.set('status', 'preparing')
-        try:
-            await self.provisioner.resume(self.machines, self.query)
-        except (ProvisionError, RuntimeError) as error:
-            for machine in self.machines:
-                await machine.refresh()
-                if machine['status'] != 'deleted':
-                    await machine.fail(error or 'Unknown failure')
-        else:
-            for machine in self.machines:
-                await perform_check(machine)
+        await self._run_provisioner(self.provisioner.resume)
 
     async def on_success(self):
         await super(ProvisionTask, self).on_success()
-        for machine in self.machines:
-            await machine.set('status', 'ready')
+        await Machine.bulk_set(self.machines, {
+            'status': 'ready',
+            'ready_time': datetime.datetime.now(),
+        })
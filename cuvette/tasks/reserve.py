@@ -9,6 +9,7 @@ import datetime
 from dateutil.parser import parse
 
 from cuvette.tasks import BaseTask
+from cuvette.machine import Machine
 from cuvette.inspectors import perform_check
 
 logger = logging.getLogger(__name__)
@@ -43,32 +44,34 @@ class ReserveTask(BaseTask):
         self.reserve_duration = self.query['reserve-duration']
 
     async def on_start(self):
-        for machine in self.machines:
-            await machine.set({
-                'reserve-duration': self.reserve_duration,
-                'reserve-whilteboard': self.query['reserve-whiteboard']
-            })
+        await Machine.bulk_set(self.machines, {
+            'reserve-duration': self.reserve_duration,
+            'reserve-whilteboard': self.query['reserve-whiteboard']
+        })
 
     async def on_done(self):
         for machine in self.machines:
             await perform_check(machine)
-            await machine.set('status', 'ready')
+        await Machine.bulk_set(self.machines, {
+            'status': 'ready',
+            'ready_time': datetime.datetime.now(),
+        })
+        await Machine.bulk_unset(self.machines, 'reservation')
 
     async def routine(self):
-        for machine in self.machines:
-            await machine.set({
-                'status': 'reserved',
-                'meta.reserve-start_time': datetime.datetime.now().isoformat()
-            })
+        await Machine.bulk_set(self.machines, {
+            'status': 'reserved',
+            'meta.reserve-start_time': datetime.datetime.now().isoformat()
+        })
         try:
             await asyncio.sleep(self.reserve_duration)
         except asyncio.CancelledError as error:
             logger.exception(error)
 
     async def resume_routine(self):
-        for machine in self.machines:
-            await machine.set('status', 'reserved')
+        await Machine.bulk_set(self.machines, 'status', 'reserved')
         try:
+            machine = self.machines[-1]
             start_time = machine['meta']['reserve-start_time']
             if isinstance(start_time, str):
                 start_time = parse(start_time)
@@ -8,6 +8,8 @@ import logging
 import cuvette.provisioners as provisioner
 
 from cuvette.tasks import BaseTask
+from cuvette.machine import Machine
+from cuvette.inspectors import SSHPool
 
 logger = logging.getLogger(__name__)
 
@@ -31,7 +33,8 @@ class TeardownTask(BaseTask):
             await provisioner.Provisioners.get(provisioner_name).teardown(machines, {})
 
     async def on_success(self):
+        await Machine.bulk_set(self.machines, 'status', 'deleted')
         for machine in self.machines:
-            await machine.mark_delete()
+            SSHPool.evict(machine.get('hostname'))
 
     resume_routine = routine
@@ -0,0 +1,47 @@
+"""
+Async Executor for tasks.
+
+Some jobs are synchronous, let them run in executor
+"""
+import asyncio
+import logging
+
+from cuvette.tasks import BaseTask
+from cuvette.inspectors import SSHPool, perform_check
+from cuvette.transformers import Transformers
+
+logger = logging.getLogger(__name__)
+
+
+class TransformTask(BaseTask):
+    """
+    The helper task to transform machines to match the query
+    """
+    TYPE = 'transform'
+
+    def __init__(self, *args, **kwargs):
+        super(TransformTask, self).__init__(*args, **kwargs)
+        # Machines transformed successfully
+        self.transformed = []
+
+    async def transform(self, machine):
+        transformers = [transformer for transformer in Transformers.values()
+                        if transformer.needed(machine, self.query)]
+        async with SSHPool.connection(machine['hostname']) as conn:
+            for transformer in transformers:
+                logger.debug('Transforming machine %s with %s', machine['hostname'], transformer.NAME)
+                await transformer.transform(machine, self.query, conn)
+
+    async def routine(self):
+        results = await asyncio.gather(*[self.transform(machine) for machine in self.machines],
+                                       return_exceptions=True)
+        for machine, result in zip(self.machines, results):
+            if isinstance(result, Exception):
+                # Machine is likely still healthy, inspect it again to
+                # get what is left by the transformer
+                logger.error('Failed transforming machine %s: %s', machine.get('hostname'), result)
+                await perform_check(machine, force=True)
+            else:
+                self.transformed.append(machine)
+
+    resume_routine = routine
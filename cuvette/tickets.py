@@ -0,0 +1,180 @@
+"""
+Request tickets
+
+A ticket tracks one machine request from creation until machines are
+reserved or the request failed, so clients don't have to hold a
+connection open for the whole provision. Every change of a ticket bumps
+its version and wakes up clients waiting for a newer version, changes
+of machines assigned to a ticket are pushed the same way.
+
+Tickets are kept in memory and saved to MongoDB on status change, so a
+client reconnecting later, even after a restart, still gets the result.
+"""
+import uuid
+import asyncio
+import logging
+import datetime
+
+from cuvette.machine import Machine
+
+logger = logging.getLogger(__name__)
+
+# Saved tickets are dropped by a TTL index after a day
+TICKET_TTL = 86400
+
+# Finished tickets are kept in memory for this long
+TICKET_MEMORY_TIME = 600
+
+TERMINAL_STATUS = ['ready', 'failed']
+
+
+def get_ticket_collection(db):
+    return db.tickets
+
+
+class Ticket(dict):
+    """
+    A ticket document, with versions to wait on
+    """
+    def __init__(self, *args, **kwargs):
+        super(Ticket, self).__init__(*args, **kwargs)
+        self.changed = asyncio.Event()
+
+    @property
+    def done(self):
+        return self['status'] in TERMINAL_STATUS
+
+    def bump(self):
+        self['version'] += 1
+        self['updated'] = datetime.datetime.now()
+        # Wake up all current waiters, later waiters wait for the next change
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def wait(self, version: int, timeout=None):
+        """
+        Wait until the ticket is newer than given version or finished
+        """
+        changed = self.changed
+        if self['version'] > version or self.done:
+            return self
+        try:
+            await asyncio.wait_for(changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self
+
+
+class TicketBoard(object):
+    def __init__(self):
+        self.tickets = {}
+        self.watching = {}
+        self._indexed = False
+        self.stats = {
+            'created': 0,
+            'ready': 0,
+            'failed': 0,
+        }
+        Machine.listeners.append(self.on_machine_write)
+
+    def get_stats(self):
+        ret = dict(self.stats)
+        ret['pending'] = len([ticket for ticket in self.tickets.values() if not ticket.done])
+        return ret
+
+    async def _ensure_index(self, db):
+        if not self._indexed:
+            await get_ticket_collection(db).create_index(
+                'updated', expireAfterSeconds=TICKET_TTL, name='ticket_ttl')
+            self._indexed = True
+
+    async def _save(self, db, ticket: Ticket):
+        await self._ensure_index(db)
+        document = dict(ticket)
+        if document.get('result') is not None:
+            # Reserved machines are saved as plain documents
+            document['result'] = [dict(machine) for machine in document['result']]
+        await get_ticket_collection(db).replace_one({'_id': ticket['_id']}, document, upsert=True)
+
+    async def create(self, db):
+        now = datetime.datetime.now()
+        ticket = Ticket({
+            '_id': str(uuid.uuid1()),
+            'status': 'queued',
+            'version': 0,
+            'machines': {},
+            'message': None,
+            'created': now,
+            'updated': now,
+        })
+        self.tickets[ticket['_id']] = ticket
+        self.stats['created'] += 1
+        await self._save(db, ticket)
+        return ticket
+
+    async def get(self, db, ticket_id: str):
+        """
+        Return the ticket, load it from MongoDB if it's not in memory,
+        None if it doesn't exist
+        """
+        ticket = self.tickets.get(ticket_id)
+        if ticket is None:
+            document = await get_ticket_collection(db).find_one({'_id': ticket_id})
+            if document is not None:
+                ticket = Ticket(document)
+                if not ticket.done:
+                    # Saved by a previous run, nobody is working on it anymore
+                    ticket['status'] = 'failed'
+                    ticket['message'] = 'Request interrupted by a restart'
+        return ticket
+
+    async def update(self, db, ticket: Ticket, status: str, message=None, machines=None):
+        """
+        Change the ticket status, machines given are assigned to the ticket,
+        and they are the result if the ticket is ready
+        """
+        ticket['status'] = status
+        ticket['message'] = message
+        if machines is not None:
+            self.watch(ticket, machines)
+            if status == 'ready':
+                ticket['result'] = machines
+        ticket.bump()
+        if ticket.done:
+            self.stats[status] += 1
+            for magic in list(ticket['machines']):
+                if self.watching.get(magic) is ticket:
+                    del self.watching[magic]
+            asyncio.get_event_loop().call_later(
+                TICKET_MEMORY_TIME, lambda: self.tickets.pop(ticket['_id'], None))
+        await self._save(db, ticket)
+
+    def watch(self, ticket: Ticket, machines):
+        """
+        Push changes of these machines to the ticket
+        """
+        for machine in machines:
+            self.watching[machine['magic']] = ticket
+            ticket['machines'][machine['magic']] = self._summary(machine)
+        ticket.bump()
+
+    @staticmethod
+    def _summary(machine):
+        return {
+            'status': machine.get('status'),
+            'hostname': machine.get('hostname'),
+        }
+
+    def on_machine_write(self, machine, deleted):
+        ticket = self.watching.get(machine.get('magic'))
+        if ticket is None:
+            return
+        summary = self._summary(machine)
+        if deleted:
+            summary['status'] = 'deleted'
+        if ticket['machines'].get(machine['magic']) != summary:
+            ticket['machines'][machine['magic']] = summary
+            ticket.bump()
+
+
+Tickets = TicketBoard()
@@ -0,0 +1,48 @@
+"""
+Base classed and helper for transformers
+
+A transformer changes some properties of an existing machine over SSH,
+so a machine failing the hard filter of a query but passing the soft
+filter could be reused instead of provisioning a new one.
+"""
+import abc
+import logging
+
+from cuvette.utils.matcher import compile_query
+from cuvette.inspectors.base import flat_filter
+
+logger = logging.getLogger(__name__)
+
+
+class TransformerBase(object, metaclass=abc.ABCMeta):
+    PARAMETERS = abc.abstractproperty()
+    NAME = abc.abstractproperty()
+    """
+    What parameters this transformer could change
+    """
+
+    def needed(self, machine, query: dict):
+        """
+        If the machine doesn't match the query on parameters of this transformer,
+        a machine missing the property always needs it
+        """
+        for prop in self.PARAMETERS:
+            if prop in query and prop not in machine.keys():
+                return True
+        return not compile_query(flat_filter(self, query))(machine)
+
+    @abc.abstractmethod
+    def cost(self, machine, query: dict):
+        """
+        How much time is likely to be costed transforming the machine
+        to match given query, inf if it's impossible
+        """
+        pass
+
+    @abc.abstractmethod
+    async def transform(self, machine, query: dict, conn):
+        """
+        Transform the machine with given ssh connection and update
+        changed properties, raise TransformError on failure
+        """
+        pass
@@ -0,0 +1,67 @@
+"""
+Reserve hugepages
+"""
+import logging
+
+from cuvette.transformers.base import TransformerBase
+from cuvette.utils.exceptions import TransformError
+
+logger = logging.getLogger(__name__)
+
+SYSCTL_COST = 30
+
+
+def wanted_hugepages(condition, current: int):
+    """
+    Number of hugepages closest to current matching the condition,
+    None if no number matches
+    """
+    if not isinstance(condition, dict):
+        condition = {'$eq': condition}
+    low, high = 0, float('inf')
+    for op, value in condition.items():
+        value = int(value)
+        if op == '$eq':
+            low, high = max(low, value), min(high, value)
+        elif op == '$gte':
+            low = max(low, value)
+        elif op == '$gt':
+            low = max(low, value + 1)
+        elif op == '$lte':
+            high = min(high, value)
+        elif op == '$lt':
+            high = min(high, value - 1)
+        else:
+            return None
+    if low > high:
+        return None
+    return int(min(max(current, low), high))
+
+
+class Transformer(TransformerBase):
+    """
+    Change the number of hugepages reserved with sysctl
+    """
+    NAME = 'hugepage'
+    PARAMETERS = {
+        "memory-hugepages": {
+            "type": int,
+        },
+    }
+
+    def cost(self, machine, query: dict):
+        if wanted_hugepages(query['memory-hugepages'], machine.get('memory-hugepages') or 0) is None:
+            return float('inf')
+        return SYSCTL_COST
+
+    async def transform(self, machine, query: dict, conn):
+        wanted = wanted_hugepages(query['memory-hugepages'], machine.get('memory-hugepages') or 0)
+        res = await conn.run('sysctl -w vm.nr_hugepages={} && cat /proc/sys/vm/nr_hugepages'.format(wanted))
+        try:
+            hugepages = int(res.stdout.split()[-1])
+        except (IndexError, ValueError):
+            raise TransformError('Failed setting hugepages on {}: {}'.format(machine['hostname'], res.stderr))
+        await machine.set('memory-hugepages', hugepages)
+        if hugepages != wanted:
+            raise TransformError('Only {} of {} hugepages reserved on {}'.format(
+                hugepages, wanted, machine['hostname']))
@@ -0,0 +1,48 @@
+"""
+Install missing packages
+"""
+import logging
+
+from cuvette.transformers.base import TransformerBase
+from cuvette.utils.exceptions import TransformError
+
+logger = logging.getLogger(__name__)
+
+# Time to start a package transaction, and to install each package
+INSTALL_BASE_COST = 60
+INSTALL_PACKAGE_COST = 15
+
+
+def wanted_packages(query: dict):
+    packages = query.get('packages') or []
+    if isinstance(packages, dict):
+        packages = packages.get('$all') or packages.get('$eq') or []
+    return set(packages)
+
+
+class Transformer(TransformerBase):
+    """
+    Install packages requested but missing on the machine with yum
+    """
+    NAME = 'packages'
+    PARAMETERS = {
+        "packages": {
+            "type": list,
+        },
+    }
+
+    def missing(self, machine, query: dict):
+        return sorted(wanted_packages(query) - set(machine.get('packages') or []))
+
+    def cost(self, machine, query: dict):
+        return INSTALL_BASE_COST + INSTALL_PACKAGE_COST * len(self.missing(machine, query))
+
+    async def transform(self, machine, query: dict, conn):
+        missing = self.missing(machine, query)
+        if not missing:
+            return
+        res = await conn.run('yum install -y {}'.format(' '.join(missing)))
+        if res.exit_status:
+            raise TransformError('Failed installing packages {} on {}: {}'.format(
+                missing, machine['hostname'], res.stderr))
+        await machine.set('packages', sorted(set(machine.get('packages') or []) | set(missing)))
@@ -15,3 +15,10 @@ class ProvisionError(RuntimeError):
     Raised when any parameter failed validation
     """
     pass
+
+
+class TransformError(RuntimeError):
+    """
+    Raised when a machine failed to be transformed
+    """
+    pass
@@ -0,0 +1,241 @@
+"""
+Compile MongoDB like queries into python closures
+
+Used to evaluate queries generated by parse_query/sanitize_query and
+inspectors against machine dicts in memory, without a MongoDB round trip.
+
+Compiled plan only depends on the shape of the query (keys and operations),
+so plans are cached per shape and values are bound when compiling.
+"""
+import operator
+
+MISSING = object()
+
+# shape -> list of (getter, tester)
+_PLAN_CACHE = {}
+
+PLAN_CACHE_SIZE = 1024
+
+LOGICAL_OPERATORS = ('$and', '$or', '$nor')
+
+
+def _resolve(node, names):
+    """
+    Walk a dotted path like MongoDB, a list on the way is walked into
+    every element and all values found are returned together, along
+    with found lists themselves so they can still be matched as a whole.
+    """
+    for index, name in enumerate(names):
+        if isinstance(node, list):
+            if name.isdigit():
+                node = node[int(name)] if int(name) < len(node) else MISSING
+            else:
+                values = []
+                for item in node:
+                    value = _resolve(item, names[index:]) if isinstance(item, dict) else MISSING
+                    if isinstance(value, list):
+                        values.extend(value)
+                        values.append(value)
+                    elif value is not MISSING:
+                        values.append(value)
+                return values or MISSING
+        elif isinstance(node, dict):
+            node = node.get(name, MISSING)
+        else:
+            return MISSING
+        if node is MISSING:
+            return MISSING
+    return node
+
+
+def _getter(path: str):
+    names = path.split('.')
+    if len(names) == 1:
+        name = names[0]
+
+        def get(doc):
+            return doc.get(name, MISSING)
+    else:
+        def get(doc):
+            return _resolve(doc, names)
+    return get
+
+
+def _eq(value, expected):
+    if value is MISSING:
+        return expected is None
+    if value == expected:
+        return True
+    if isinstance(value, list):
+        return expected in value
+    return False
+
+
+def _comparator(compare):
+    def test(value, expected):
+        if value is MISSING:
+            return False
+        if isinstance(value, list) and not isinstance(expected, list):
+            for item in value:
+                try:
+                    if compare(item, expected):
+                        return True
+                except TypeError:
+                    continue
+            return False
+        try:
+            return compare(value, expected)
+        except TypeError:
+            # Like MongoDB, values of different type don't match
+            return False
+    return test
+
+
+def _in(value, expected):
+    if isinstance(expected, frozenset):
+        if value is MISSING:
+            return None in expected
+        if isinstance(value, list):
+            return any(item in expected for item in value if _hashable(item))
+        return _hashable(value) and value in expected
+    return any(_eq(value, item) for item in expected)
+
+
+def _all(value, expected):
+    if value is MISSING:
+        return False
+    if not isinstance(value, list):
+        return all(value == item for item in expected)
+    return all(item in value for item in expected)
+
+
+TESTERS = {
+    '$eq': _eq,
+    '$ne': lambda value, expected: not _eq(value, expected),
+    '$lt': _comparator(operator.lt),
+    '$lte': _comparator(operator.le),
+    '$gt': _comparator(operator.gt),
+    '$gte': _comparator(operator.ge),
+    '$in': _in,
+    '$nin': lambda value, expected: not _in(value, expected),
+    '$all': _all,
+    '$exists': lambda value, expected: (value is not MISSING) == bool(expected),
+}
+
+
+def _hashable(value):
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+
+def _is_operation(cond):
+    return isinstance(cond, dict) and bool(cond) and all(key.startswith('$') for key in cond.keys())
+
+
+def query_shape(query: dict):
+    """
+    Hashable shape of a query, values are ignored
+    """
+    shape = []
+    for key, cond in sorted(query.items()):
+        if key in LOGICAL_OPERATORS:
+            shape.append((key, tuple(query_shape(sub_query) for sub_query in cond)))
+        elif key.startswith('$'):
+            # Never take an operator as a field name, that silently matches nothing
+            raise RuntimeError('Unsupported operation: "{}"'.format(key))
+        elif _is_operation(cond):
+            shape.append((key, tuple(sorted(cond.keys()))))
+        else:
+            shape.append((key, None))
+    return tuple(shape)
+
+
+def _bind_values(query: dict):
+    """
+    Values of a query in the same order as query_shape
+    """
+    values = []
+    for key, cond in sorted(query.items()):
+        if key in LOGICAL_OPERATORS:
+            values.append(tuple(_bind_values(sub_query) for sub_query in cond))
+        elif _is_operation(cond):
+            for op in sorted(cond.keys()):
+                expected = cond[op]
+                if op in ('$in', '$nin') and all(_hashable(item) and not isinstance(item, list)
+                                                 for item in expected):
+                    expected = frozenset(expected)
+                values.append(expected)
+        else:
+            values.append(cond)
+    return values
+
+
+def _build_plan(shape):
+    plan = []
+    for key, ops in shape:
+        if key in LOGICAL_OPERATORS:
+            sub_plans = [_build_plan(sub_shape) for sub_shape in ops]
+            if key == '$and':
+                def test(_, sub_values, sub_plans=sub_plans):
+                    return all(_run(sub_plan, values, _)
+                               for sub_plan, values in zip(sub_plans, sub_values))
+            elif key == '$or':
+                def test(_, sub_values, sub_plans=sub_plans):
+                    return any(_run(sub_plan, values, _)
+                               for sub_plan, values in zip(sub_plans, sub_values))
+            else:
+                def test(_, sub_values, sub_plans=sub_plans):
+                    return not any(_run(sub_plan, values, _)
+                                   for sub_plan, values in zip(sub_plans, sub_values))
+            plan.append((lambda doc: doc, test))
+        elif ops is None:
+            plan.append((_getter(key), _eq))
+        else:
+            getter = _getter(key)
+            for op in ops:
+                if op not in TESTERS:
+                    raise RuntimeError('Unsupported operation: "{}"'.format(op))
+                plan.append((getter, TESTERS[op]))
+    return plan
+
+
+def _run(plan, values, doc):
+    for (getter, test), expected in zip(plan, values):
+        if not test(getter(doc), expected):
+            return False
+    return True
+
+
+def compile_query(query: dict):
+    """
+    Compile a MongoDB like query into a function that takes a dict and
+    return True if it matches, eg:
+
+        match = compile_query({'status': 'ready', 'memory-total_size': {'$gte': 4096}})
+        ready_machines = [machine for machine in machines if match(machine)]
+    """
+    shape = query_shape(query)
+    plan = _PLAN_CACHE.get(shape)
+    if plan is None:
+        if len(_PLAN_CACHE) >= PLAN_CACHE_SIZE:
+            _PLAN_CACHE.clear()
+        plan = _PLAN_CACHE[shape] = _build_plan(shape)
+    checks = list(zip(plan, _bind_values(query)))
+
+    def match(doc):
+        for (getter, test), expected in checks:
+            if not test(getter(doc), expected):
+                return False
+        return True
+
+    return match
+
+
+def match(doc: dict, query: dict):
+    """
+    Evaluate a MongoDB like query against a document
+    """
+    return compile_query(query)(doc)
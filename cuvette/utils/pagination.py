@@ -0,0 +1,132 @@
+"""
+Projection, sorting and cursor based pagination for machine listings
+
+Pagination token is opaque to clients, it records the sort value and _id
+of the last returned document, next page starts right after it.
+"""
+import base64
+
+from bson import json_util
+
+from .exceptions import ValidateError
+
+DEFAULT_SORT = '_id'
+
+# Larger limits are capped, use the next page token for more
+MAX_LIMIT = 1000
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return [item.strip() for item in value.split(',') if item.strip()]
+    return list(value)
+
+
+def parse_projection(fields=None, exclude=None):
+    """
+    Build a MongoDB projection from comma separated strings or lists of field names
+    """
+    fields, exclude = _as_list(fields), _as_list(exclude)
+    if fields and exclude:
+        raise ValidateError('"fields" and "exclude" can\'t be used together')
+    if fields:
+        return dict((field, True) for field in fields)
+    if exclude:
+        if '_id' in exclude:
+            raise ValidateError('"_id" can\'t be excluded')
+        return dict((field, False) for field in exclude)
+    return None
+
+
+def parse_sort(sort=None):
+    """
+    Parse sort option like 'hostname' or '-expire_time' into (key, direction)
+    """
+    sort = sort or DEFAULT_SORT
+    if sort.startswith('-'):
+        return sort[1:], -1
+    return sort.lstrip('+'), 1
+
+
+def parse_limit(limit=None):
+    if limit is None:
+        return None
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        raise ValidateError('Invalid limit {}'.format(limit))
+    if limit <= 0:
+        raise ValidateError('Limit must be positive')
+    return min(limit, MAX_LIMIT)
+
+
+def _get_path(document, path):
+    for name in path.split('.'):
+        if not isinstance(document, dict):
+            return None
+        document = document.get(name)
+    return document
+
+
+def encode_after(document, sort_key):
+    """
+    Token pointing at given document
+    """
+    return base64.urlsafe_b64encode(json_util.dumps({
+        'k': _get_path(document, sort_key) if sort_key != '_id' else None,
+        'id': document['_id'],
+    }).encode('utf8')).decode('ascii')
+
+
+def after_filter(token, sort_key, direction):
+    """
+    MongoDB filter matching documents after the one token is pointing at
+    """
+    try:
+        after = json_util.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf8'))
+        value, _id = after['k'], after['id']
+    except Exception:
+        raise ValidateError('Invalid pagination token')
+    op = '$gt' if direction > 0 else '$lt'
+    if sort_key == '_id':
+        return {'_id': {op: _id}}
+    # Null and missing values sort before everything else, and range
+    # operators never match across types, so null needs its own branch
+    if value is None:
+        if direction > 0:
+            return {'$or': [
+                {sort_key: {'$ne': None}},
+                {sort_key: None, '_id': {op: _id}},
+            ]}
+        return {sort_key: None, '_id': {op: _id}}
+    ret = [
+        {sort_key: {op: value}},
+        {sort_key: value, '_id': {op: _id}},
+    ]
+    if direction < 0:
+        ret.append({sort_key: None})
+    return {'$or': ret}
+
+
+def paginate(query: dict, projection=None, sort=None, limit=None, after=None):
+    """
+    Return (filter, find_kwargs) for a paginated find
+    """
+    sort_key, direction = parse_sort(sort)
+    if after:
+        query = {'$and': [query, after_filter(after, sort_key, direction)]}
+    if projection and all(projection.values()):
+        # Sort key is needed for the next token
+        projection = dict(projection, **{sort_key: True})
+    elif projection:
+        projection.pop(sort_key, None)
+    kwargs = {
+        'sort': [(sort_key, direction)] + ([('_id', direction)] if sort_key != '_id' else []),
+    }
+    if projection:
+        kwargs['projection'] = projection
+    if limit:
+        kwargs['limit'] = limit
+    return query, kwargs
@@ -0,0 +1,92 @@
+"""
+JSON serializer for HTTP responses
+
+Use orjson if it's installed, else fallback to stdlib json.
+Both handle datetime and ObjectId natively so documents from the pool
+could be serialized without converting them key by key.
+"""
+import json
+import datetime
+
+from aiohttp import web
+from bson import ObjectId
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+CONTENT_TYPE_JSON = 'application/json'
+CONTENT_TYPE_NDJSON = 'application/x-ndjson'
+
+STREAM_FORMATS = ['json', 'ndjson']
+
+
+def default(obj):
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    elif isinstance(obj, ObjectId):
+        return str(obj)
+    elif isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(obj).__name__))
+
+
+if orjson is not None:
+    def dumps(data) -> bytes:
+        return orjson.dumps(data, default=default, option=orjson.OPT_NON_STR_KEYS)
+else:
+    _encoder = json.JSONEncoder(default=default, separators=(',', ':'))
+
+    def dumps(data) -> bytes:
+        return _encoder.encode(data).encode('utf8')
+
+
+def public(document: dict):
+    """
+    Strip private fields (starting with '_') from a machine document
+    """
+    return dict((key, value) for key, value in document.items() if not key.startswith('_'))
+
+
+def json_response(data, status=200, **kwargs):
+    """
+    Like aiohttp.web.json_response, but use the faster serializer
+    """
+    return web.Response(body=dumps(data), status=status, content_type=CONTENT_TYPE_JSON, **kwargs)
+
+
+def machines_response(machines, status=200, **kwargs):
+    return json_response([public(machine) for machine in machines], status=status, **kwargs)
+
+
+async def stream_response(request, cursor, format='json', transform=public):
+    """
+    Stream documents from a Motor cursor with chunked encoding,
+    only one batch of documents is kept in memory.
+
+    format could be 'json' for a JSON array or 'ndjson' for
+    newline delimited JSON.
+    """
+    if format not in STREAM_FORMATS:
+        raise web.HTTPBadRequest(text='Unknown stream format {}'.format(format))
+    response = web.StreamResponse()
+    response.content_type = CONTENT_TYPE_NDJSON if format == 'ndjson' else CONTENT_TYPE_JSON
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+
+    first = True
+    if format == 'json':
+        response.write(b'[')
+    while await cursor.fetch_next:
+        document = cursor.next_object()
+        if format == 'json':
+            response.write((b'' if first else b',') + dumps(transform(document)))
+        else:
+            response.write(dumps(transform(document)) + b'\n')
+        first = False
+        await response.drain()
+    if format == 'json':
+        response.write(b']')
+    await response.write_eof()
+    return response
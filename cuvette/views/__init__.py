@@ -4,8 +4,15 @@ from aiohttp import web
 
 from cuvette.utils import parse_query, parse_request_params, sanitize_query
 from cuvette.utils import format_to_json, type_to_string
-from cuvette.pipeline import Pipeline, Parameters
-from cuvette.provisioners import Provisioners
+from cuvette.utils.serializer import json_response, machines_response, stream_response
+from cuvette.utils.pagination import parse_projection, parse_limit, parse_sort, encode_after
+from cuvette.pipeline import Pipeline, Parameters, Coalescer
+from cuvette.provisioners import Provisioners, Registry
+from cuvette.mongodb import explain_report
+from cuvette.machine import write_stats
+from cuvette.inspectors import SSHPool
+from cuvette.pool import RequestDemand, WarmPoolController
+from cuvette.tickets import Tickets
 
 logger = logging.getLogger(__name__)
 
@@ -30,15 +37,27 @@ async def index(request):
 async def provisioners(request):
     """
     Method: GET
-    Return info of provisioners
+    Return info of provisioners and their learned costs
     """
     data = dict([
-        (provisioner_name, provisioner.name)
+        (provisioner_name, Registry.models[provisioner.NAME].to_dict())
         for provisioner_name, provisioner in Provisioners.items()
     ])
     return web.json_response(data)
 
 
+async def provisioners_rank(request):
+    """
+    Method: GET
+    Rank provisioners accepting the query, cheapest first
+    """
+    query_params = sanitize_query(parse_query(parse_request_params(request.query)), Parameters)
+    return web.json_response([
+        {'name': provisioner.NAME, 'cost': cost}
+        for provisioner, cost in Registry.rank(query_params)
+    ])
+
+
 async def parameters(request):
     """
     Method: GET
@@ -48,14 +67,77 @@ async def parameters(request):
     return web.json_response(data)
 
 
+async def metrics(request):
+    """
+    Method: GET
+    Return performance counters
+    """
+    return json_response({
+        'machine_writes': write_stats(),
+        'ssh': SSHPool.get_stats(),
+        'requests': WarmPoolController.get_stats(),
+        'coalescer': Coalescer.get_stats(),
+        'tickets': Tickets.get_stats(),
+        'provisioners': dict((name, provisioner.get_stats()) for name, provisioner in Provisioners.items()),
+    })
+
+
+async def indexes(request):
+    """
+    Method: GET
+    Explain recent pool queries, tell which of them still do a collection scan
+    """
+    return json_response(await explain_report(request.app['db']))
+
+
+async def acquire_machines(pipeline: Pipeline, query_params: dict, on_launch=None):
+    """
+    Find, transform or provision ready machines for the query and reserve them,
+    raise RuntimeError if the query can't be fulfilled
+    """
+    query_params.setdefault('status', 'ready')
+    machines = await pipeline.reserve(query_params)
+    RequestDemand.record(query_params, hit=bool(machines))
+    if not machines:
+        machines = await pipeline.transform_or_provision(query_params, on_launch)
+        if machines:
+            machines = await pipeline.reserve(query_params, machines)
+    return machines
+
+
 class MachineView(object):
     @staticmethod
     async def get(request):
-        query_params = sanitize_query(
-            parse_query(parse_request_params(request.query)),
-            Parameters)
+        """
+        Method: GET
+        List machines matching the query, use param stream=json or stream=ndjson
+        to stream the result with chunked encoding.
+
+        Extra params:
+        fields / exclude: comma separated field names to include or exclude
+        sort: field name to sort with, prefix with '-' for descending order
+        limit: page size, when a full page is returned, header X-Next-After
+               contains the token to pass as param after for next page
+        """
+        request_params = parse_request_params(request.query)
+        stream = request_params.pop('stream', None)
+        projection = parse_projection(request_params.pop('fields', None), request_params.pop('exclude', None))
+        sort = request_params.pop('sort', None)
+        limit = parse_limit(request_params.pop('limit', None))
+        after = request_params.pop('after', None)
+        query_params = sanitize_query(parse_query(request_params), Parameters)
+        if stream or projection or sort or limit or after:
+            cursor = Pipeline(request).query_cursor(
+                query_params, nocount=True, projection=projection, sort=sort, limit=limit, after=after)
+            if stream:
+                return await stream_response(request, cursor, stream)
+            machines = await cursor.to_list(None)
+            headers = {}
+            if limit and len(machines) == limit:
+                headers['X-Next-After'] = encode_after(machines[-1], parse_sort(sort)[0])
+            return machines_response(machines, headers=headers)
         machines = await Pipeline(request).query(query_params, nocount=True)
-        return web.json_response([machine.to_json() for machine in machines])
+        return machines_response(machines)
 
     @staticmethod
     async def put(request):
@@ -82,8 +164,8 @@ class MachineView(object):
         machines = await Pipeline(request).query(query_params, nocount=True)
         for machine in machines:
             await machine.delete()
-            data.append(machine.to_json())
-        return web.json_response(data, status=200)
+            data.append(machine)
+        return machines_response(data, status=200)
 
     @staticmethod
     async def request(request):
@@ -99,22 +181,16 @@ class MachineView(object):
 
         query_params = sanitize_query(query_params, Parameters)
 
-        # Find / provision a ready machine and reserve it
-        query_params.setdefault('status', 'ready')
-        machines = await Pipeline(request).query(query_params)
-        if not machines:
-            try:
-                machines = await Pipeline(request).provision(query_params, timeout=None)
-            except RuntimeError as error:
-                return web.json_response({
-                    'message': error
-                }, status=400)
-        if machines:
-            machines = await Pipeline(request).reserve(query_params)
+        try:
+            machines = await acquire_machines(Pipeline(request), query_params)
+        except RuntimeError as error:
+            return json_response({
+                'message': str(error)
+            }, status=400)
         if machines and len(machines):
-            return web.json_response([m.to_json() for m in machines])
+            return machines_response(machines)
         else:
-            return web.json_response({
+            return json_response({
                 'message': 'Failed to find or provision a machine'
             }, status=404)
 
@@ -127,10 +203,20 @@ class MachineView(object):
         query_params = sanitize_query(parse_query(await request.json()), Parameters)
 
         if not await request['magic'].allow_provision(query_params):
-            return web.json_response({'message': 'no avaliable'}, status=406)
+            return json_response({'message': 'no avaliable'}, status=406)
 
         machines = await Pipeline(request).provision(query_params)
-        return web.json_response([m.to_json() for m in machines])
+        return machines_response(machines)
+
+    @staticmethod
+    async def inspect(request):
+        """
+        Method: POST
+        Non blocking API to request to re-inspect machines, an empty query inspects the whole pool
+        """
+        query_params = sanitize_query(parse_query(await request.json()), Parameters)
+        machines = await Pipeline(request).inspect(query_params)
+        return machines_response(machines)
 
     @staticmethod
     async def teardown(request):
@@ -140,7 +226,7 @@ class MachineView(object):
         """
         query_params = sanitize_query(parse_query(await request.json()), Parameters)
         machines = await Pipeline(request).teardown(query_params)
-        return web.json_response([m.to_json() for m in machines])
+        return machines_response(machines)
 
     @staticmethod
     async def release(request):
@@ -150,4 +236,4 @@ class MachineView(object):
         """
         query_params = sanitize_query(parse_query(await request.json()), Parameters)
         machines = await Pipeline(request).release(query_params)
-        return web.json_response([m.to_json() for m in machines])
+        return machines_response(machines)
@@ -1,7 +1,7 @@
 import logging
 import socket
-from aiohttp import web
 from cuvette.pipeline import Pipeline
+from cuvette.utils.serializer import json_response, machines_response
 
 logger = logging.getLogger(__name__)
 
@@ -38,9 +38,9 @@ async def tear_me_down(request):
     })
 
     if machines and len(machines) > 0:
-        return web.json_response(machines)
+        return machines_response(machines)
     else:
-        return web.json_response({
+        return json_response({
             'message': "Can't find a machine with any following hostname '{}'".format(host_candidates)
         }, status=400)
 
@@ -59,9 +59,9 @@ async def release_me(request):
     })
 
     if machines and len(machines) > 0:
-        return web.json_response(machines)
+        return machines_response(machines)
     else:
-        return web.json_response({
+        return json_response({
             'message': "Can't find a machine with any following hostname '{}'".format(host_candidates)
         }, status=400)
 
@@ -80,8 +80,8 @@ async def describ_me(request):
     })
 
     if machines and len(machines) > 0:
-        return web.json_response(machines)
+        return machines_response(machines)
     else:
-        return web.json_response({
+        return json_response({
             'message': "Can't find a machine with any following hostname '{}'".format(host_candidates)
         }, status=400)
@@ -0,0 +1,179 @@
+"""
+Non blocking machine request API
+
+POST /tickets takes the same query as /machines/request and returns a
+ticket at once, the request is fulfilled in background. Clients follow
+the ticket with any of:
+
+GET /tickets/{ticket}?version=N&timeout=S
+    Long-poll, return when the ticket is newer than version N,
+    finished, or after S seconds
+GET /tickets/{ticket}/events
+    Server-Sent Events, one event per ticket version,
+    Last-Event-ID resumes from the last version received
+GET /tickets/{ticket}/ws
+    WebSocket, one text message per ticket version
+
+Ticket status is queued -> searching -> preparing -> ready or failed,
+'machines' has the status of machines assigned to the ticket, and
+'result' has the reserved machines once the ticket is ready.
+"""
+import math
+import asyncio
+import logging
+
+from aiohttp import web, WSMsgType
+
+from cuvette.utils import parse_query, parse_request_params, sanitize_query
+from cuvette.utils.exceptions import ValidateError
+from cuvette.utils.serializer import json_response, dumps, public
+from cuvette.pipeline import Pipeline, Parameters
+from cuvette.tickets import Tickets
+from cuvette.views import acquire_machines
+
+logger = logging.getLogger(__name__)
+
+LONG_POLL_TIMEOUT = 30
+
+MAX_LONG_POLL_TIMEOUT = 120
+
+# Send a comment to keep idle event streams from being closed by proxies
+EVENT_KEEPALIVE = 15
+
+
+def parse_version(version, name='version'):
+    try:
+        return int(version)
+    except (TypeError, ValueError):
+        raise ValidateError('Invalid {} {}'.format(name, version))
+
+
+def parse_timeout(timeout=None):
+    if timeout is None:
+        return LONG_POLL_TIMEOUT
+    try:
+        timeout = float(timeout)
+    except (TypeError, ValueError):
+        raise ValidateError('Invalid timeout {}'.format(timeout))
+    if math.isnan(timeout) or timeout < 0:
+        raise ValidateError('Timeout must not be negative')
+    return min(timeout, MAX_LONG_POLL_TIMEOUT)
+
+
+def format_ticket(ticket):
+    data = dict(ticket)
+    data['ticket'] = data.pop('_id')
+    if data.get('result') is not None:
+        data['result'] = [public(machine) for machine in data['result']]
+    return data
+
+
+async def fulfil(pipeline: Pipeline, ticket, query_params: dict):
+    """
+    Fulfil the request of a ticket in background
+    """
+    db = pipeline.request.app['db']
+    try:
+        await Tickets.update(db, ticket, 'searching')
+        machines = await acquire_machines(
+            pipeline, query_params,
+            on_launch=lambda machines: asyncio.ensure_future(
+                Tickets.update(db, ticket, 'preparing', machines=machines)))
+    except Exception as error:
+        logger.exception('Failed fulfilling ticket %s', ticket['_id'])
+        await Tickets.update(db, ticket, 'failed', message=str(error))
+        return
+    if machines:
+        await Tickets.update(db, ticket, 'ready', machines=machines)
+    else:
+        await Tickets.update(db, ticket, 'failed', message='Failed to find or provision a machine')
+
+
+async def get_ticket(request):
+    ticket = await Tickets.get(request.app['db'], request.match_info['ticket'])
+    if ticket is None:
+        raise web.HTTPNotFound(text='No such ticket')
+    return ticket
+
+
+class TicketView(object):
+    @staticmethod
+    async def post(request):
+        """
+        Method: POST
+        Request machines, return a ticket to follow without waiting
+        """
+        query_params = sanitize_query(parse_query(await request.json()), Parameters)
+        ticket = await Tickets.create(request.app['db'])
+        asyncio.ensure_future(fulfil(Pipeline(request), ticket, query_params))
+        location = request.app.router['ticket_get'].url_for(ticket=ticket['_id'])
+        return json_response(format_ticket(ticket), status=202, headers={'Location': str(location)})
+
+    @staticmethod
+    async def get(request):
+        """
+        Method: GET
+        Get a ticket, with param version, wait until the ticket is newer than it
+        """
+        ticket = await get_ticket(request)
+        request_params = parse_request_params(request.query)
+        if request_params.get('version') is not None:
+            version = parse_version(request_params['version'])
+            await ticket.wait(version, parse_timeout(request_params.get('timeout') or None))
+        return json_response(format_ticket(ticket))
+
+    @staticmethod
+    async def events(request):
+        """
+        Method: GET
+        Stream versions of a ticket as Server-Sent Events until it's finished
+        """
+        ticket = await get_ticket(request)
+        version = parse_version(request.headers.get('Last-Event-ID') or -1, 'Last-Event-ID')
+        response = web.StreamResponse(headers={'Cache-Control': 'no-cache'})
+        response.content_type = 'text/event-stream'
+        await response.prepare(request)
+        while True:
+            await ticket.wait(version, EVENT_KEEPALIVE)
+            if ticket['version'] > version:
+                version = ticket['version']
+                response.write('id: {}\nevent: ticket\ndata: '.format(version).encode('utf8') +
+                               dumps(format_ticket(ticket)) + b'\n\n')
+            else:
+                response.write(b': keepalive\n\n')
+            await response.drain()
+            if ticket.done:
+                break
+        await response.write_eof()
+        return response
+
+    @staticmethod
+    async def websocket(request):
+        """
+        Method: GET
+        Push versions of a ticket through a WebSocket until it's finished
+        """
+        ticket = await get_ticket(request)
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        version = -1
+        receiving = asyncio.ensure_future(ws.receive())
+        try:
+            while True:
+                if ticket['version'] > version:
+                    version = ticket['version']
+                    ws.send_str(dumps(format_ticket(ticket)).decode('utf8'))
+                if ticket.done:
+                    break
+                waiting = asyncio.ensure_future(ticket.wait(version))
+                await asyncio.wait([receiving, waiting], return_when=asyncio.FIRST_COMPLETED)
+                if receiving.done():
+                    waiting.cancel()
+                    if receiving.result().type in (WSMsgType.CLOSE, WSMsgType.CLOSED, WSMsgType.ERROR):
+                        break
+                    # Clients have nothing to say, ignore it
+                    receiving = asyncio.ensure_future(ws.receive())
+        finally:
+            receiving.cancel()
+        await ws.close()
+        return ws
@@ -0,0 +1,92 @@
+import pytest
+from lxml import etree
+from aiohttp.test_utils import TestServer
+
+from cuvette.provisioners.beaker.client import HTTPClient, BeakerClientError, join_job_results
+from cuvette.provisioners.beaker.fake_server import FakeBeaker, RECIPE_STEPS, NS_INV
+from cuvette.provisioners.beaker.parser import parse_jobs_recipes
+
+JOB_XML = '<job><recipeSet><recipe/><recipe/></recipeSet></job>'
+
+
+@pytest.fixture
+def beaker(loop):
+    """
+    Start a fake beaker server, return (fake beaker, client connected to it)
+    """
+    fake = FakeBeaker(systems=['fake-0.example.com', 'fake-1.example.com'])
+    server = TestServer(fake.create_app())
+    loop.run_until_complete(server.start_server(loop=loop))
+    client = HTTPClient(str(server.make_url('')), 'user', 'password')
+    yield fake, client
+    loop.run_until_complete(client.close())
+    loop.run_until_complete(server.close())
+
+
+def recipe_status(job_xml):
+    return [(recipe.get('status'), recipe.get('result'))
+            for recipe in etree.fromstring(job_xml.encode('utf8')).iter('recipe')]
+
+
+def test_job_lifecycle(loop, beaker):
+    fake, client = beaker
+
+    async def run():
+        job_id = await client.job_submit(JOB_XML)
+        assert job_id == 'J:1'
+
+        # Job moves one step forward every fetch, then stays reserved
+        for status in RECIPE_STEPS + RECIPE_STEPS[-1:]:
+            assert recipe_status(await client.job_results(job_id)) == [status, status]
+
+        job = etree.fromstring((await client.job_results(job_id)).encode('utf8'))
+        hostnames = [recipe.get('system') for recipe in job.iter('recipe')]
+        assert sorted(hostnames) == fake.systems
+
+        details = etree.fromstring((await client.system_details(hostnames[0])).encode('utf8'))
+        assert details.find('.//{%s}cpuVendor' % NS_INV).text == 'GenuineIntel'
+        assert [flag.text for flag in details.iter('{%s}cpuFlag' % NS_INV)] == ['fpu', 'sse', 'avx', 'pdpe1gb']
+
+        # All systems are taken
+        with pytest.raises(BeakerClientError):
+            await client.job_submit(JOB_XML)
+
+        # Expired session is renewed
+        fake.sessions.clear()
+        await client.job_cancel(job_id)
+        assert recipe_status(await client.job_results(job_id)) == [('Cancelled', 'Warn')] * 2
+
+        # Systems are free again
+        assert await client.job_submit(JOB_XML) == 'J:2'
+
+    loop.run_until_complete(run())
+
+
+def test_unknown_system(loop, beaker):
+    fake, client = beaker
+    with pytest.raises(BeakerClientError):
+        loop.run_until_complete(client.system_details('unknown.example.com'))
+
+
+def test_jobs_results(loop, beaker):
+    fake, client = beaker
+
+    async def run():
+        first = await client.job_submit('<job><recipeSet><recipe/></recipeSet></job>')
+        second = await client.job_submit('<job><recipeSet><recipe/></recipeSet></job>')
+        # Unknown jobs are left out
+        return first, second, parse_jobs_recipes(await client.jobs_results([first, second, 'J:404']))
+
+    first, second, recipes = loop.run_until_complete(run())
+    assert sorted(recipes) == [first, second]
+    assert [recipe['system'] for recipe in recipes[first] + recipes[second]] == fake.systems
+
+
+def test_join_bkr_output():
+    # bkr job-results prints one document per job
+    fake = FakeBeaker()
+    job_ids = [fake.upload('<job><recipeSet><recipe/></recipeSet></job>') for _ in range(2)]
+    output = ''.join('<?xml version="1.0" encoding="utf-8"?>{}\n'.format(fake.to_xml(job_id)) for job_id in job_ids)
+    recipes = parse_jobs_recipes(join_job_results([output]))
+    assert sorted(recipes) == job_ids
+    assert all(len(recipes[job_id]) == 1 for job_id in job_ids)
@@ -0,0 +1,90 @@
+import time
+
+from lxml import etree
+
+from cuvette.provisioners.beaker.fake_server import FakeBeaker
+from cuvette.provisioners.beaker.parser import (
+    parse_job_recipes, parse_system_details,
+    NS_INV, NS_RDF, SYSTEM_TAG, CONTROLLED_BY_TAG, LAB_CONTROLLER_TAG, ABOUT_ATTR
+)
+
+
+def synthetic_job(recipes):
+    job = etree.Element('job', id='1')
+    recipe_set = etree.SubElement(job, 'recipeSet')
+    for idx in range(recipes):
+        recipe = etree.SubElement(recipe_set, 'recipe', id=str(idx), status='Running', result='Pass',
+                                  system='host-{}.example.com'.format(idx), distro='RHEL-7.4')
+        for task_idx in range(20):
+            task = etree.SubElement(recipe, 'task', name='/task/{}'.format(task_idx), status='Running')
+            etree.SubElement(task, 'logs').text = 'x' * 200
+    return etree.tostring(job)
+
+
+def synthetic_system(flags):
+    root = etree.Element('{}RDF'.format(NS_RDF), nsmap={'inv': NS_INV[1:-1], 'rdf': NS_RDF[1:-1]})
+    system = etree.SubElement(root, SYSTEM_TAG)
+    lab_controller = etree.SubElement(etree.SubElement(system, CONTROLLED_BY_TAG), LAB_CONTROLLER_TAG)
+    lab_controller.set(ABOUT_ATTR, 'http://beaker/lc/lab.example.com#lc')
+    for tag, value in [('cpuVendor', 'GenuineIntel'), ('cpuModelId', '42'), ('cpuCount', '8'),
+                       ('memory', '16384'), ('model', 'Fake'), ('vendor', 'Fake')]:
+        etree.SubElement(system, '{}{}'.format(NS_INV, tag)).text = value
+    for idx in range(flags):
+        etree.SubElement(system, '{}cpuFlag'.format(NS_INV)).text = 'flag{}'.format(idx)
+        # Not mapped to any machine field
+        etree.SubElement(system, '{}hasDevice'.format(NS_INV)).text = 'device{}'.format(idx)
+    return etree.tostring(root)
+
+
+def test_job_recipes():
+    fake = FakeBeaker()
+    job_id = fake.upload('<job><recipeSet><recipe/><recipe/></recipeSet></job>')
+    # Declared encoding is accepted for str documents
+    recipes = parse_job_recipes('<?xml version="1.0" encoding="utf-8"?>' + fake.to_xml(job_id))
+    assert recipes == [dict(fake.jobs[1]['recipes'][idx], status='Queued', result='New') for idx in range(2)]
+
+
+def test_system_details():
+    lab_controller, info = parse_system_details(FakeBeaker().system_details('fake-0.example.com'))
+    assert lab_controller == 'lab.example.com'
+    assert info == {
+        'cpu-vendor': 'GenuineIntel',
+        'cpu-model': 42,
+        'cpu-family': 6,
+        'cpu-core_number': 8,
+        'cpu-socket_number': 1,
+        'cpu-speed': 2400.0,
+        'cpu-model_name': 'Fake CPU',
+        'cpu-flags': ['fpu', 'sse', 'avx', 'pdpe1gb'],
+        'numa-node_number': 1,
+        'memory-total_size': 16384,
+        'system-model': 'Fake',
+        'system-vendor': 'Fake',
+        'net-mac_address': '52:54:00:12:00:01',
+    }
+
+
+def test_system_details_without_system():
+    assert parse_system_details('<rdf:RDF xmlns:rdf="{}"/>'.format(NS_RDF[1:-1])) == (None, {})
+
+
+def test_benchmark():
+    """
+    Parse large synthetic documents, run with -s to see the numbers
+    """
+    job, system = synthetic_job(1000), synthetic_system(10000)
+
+    started = time.perf_counter()
+    recipes = parse_job_recipes(job)
+    job_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    lab_controller, info = parse_system_details(system)
+    system_time = time.perf_counter() - started
+
+    print('\nJob results: {:.2f}ms ({} KiB), system details: {:.2f}ms ({} KiB)'.format(
+        job_time * 1000, len(job) // 1024, system_time * 1000, len(system) // 1024))
+    assert [recipe['system'] for recipe in recipes] == ['host-{}.example.com'.format(idx) for idx in range(1000)]
+    assert lab_controller == 'lab.example.com'
+    assert info['cpu-flags'] == ['flag{}'.format(idx) for idx in range(10000)]
+    assert info['memory-total_size'] == 16384
@@ -0,0 +1,72 @@
+from cuvette.provisioners.polling import PollingPolicy
+from cuvette.provisioners.beaker.poller import BeakerJobPoller
+
+RECIPES = [{'status': 'Running', 'result': 'Pass'}]
+
+
+class FakeFetch(object):
+    """
+    Return recipes of known jobs, record job ids of every call
+    """
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.calls = []
+        self.failing = False
+
+    async def __call__(self, job_ids):
+        self.calls.append(list(job_ids))
+        if self.failing:
+            raise OSError('Beaker is down')
+        return dict((job_id, self.jobs[job_id]) for job_id in job_ids if job_id in self.jobs)
+
+
+def poll(loop, poller, job_ids):
+    """
+    Wait for given jobs and run one tick, return the waiters
+    """
+    async def run():
+        futures = [poller.wait(job_id) for job_id in job_ids]
+        poller._task.cancel()
+        await poller.tick()
+        return futures
+    return loop.run_until_complete(run())
+
+
+def test_one_query_per_tick(loop):
+    fetch = FakeFetch({'J:1': RECIPES, 'J:2': RECIPES, 'J:3': RECIPES})
+    poller = BeakerJobPoller(fetch, policy=PollingPolicy(interval=0))
+    futures = poll(loop, poller, ['J:1', 'J:2', 'J:2', 'J:3'])
+    assert fetch.calls == [['J:1', 'J:2', 'J:3']]
+    assert [future.result() for future in futures] == [RECIPES] * 4
+    assert poller.stats['requests'] == 1
+    assert poller.stats['polls'] == 3
+
+
+def test_batches(loop):
+    fetch = FakeFetch(dict(('J:{}'.format(idx), RECIPES) for idx in range(5)))
+    poller = BeakerJobPoller(fetch, policy=PollingPolicy(interval=0), batch=2)
+    futures = poll(loop, poller, ['J:{}'.format(idx) for idx in range(5)])
+    assert fetch.calls == [['J:0', 'J:1'], ['J:2', 'J:3'], ['J:4']]
+    assert all(future.result() == RECIPES for future in futures)
+
+
+def test_missing_job_keeps_waiting(loop):
+    fetch = FakeFetch({'J:1': RECIPES})
+    poller = BeakerJobPoller(fetch, policy=PollingPolicy(interval=0))
+    found, missing = poll(loop, poller, ['J:1', 'J:2'])
+    assert found.result() == RECIPES
+    assert not missing.done()
+    assert poller.jobs['J:2'].failures == 1
+    assert poller.stats['failures'] == 1
+    missing.cancel()
+
+
+def test_failed_query_fails_all_jobs(loop):
+    fetch = FakeFetch({'J:1': RECIPES, 'J:2': RECIPES})
+    fetch.failing = True
+    poller = BeakerJobPoller(fetch, policy=PollingPolicy(interval=0))
+    futures = poll(loop, poller, ['J:1', 'J:2'])
+    assert not any(future.done() for future in futures)
+    assert poller.stats['failures'] == 2
+    for future in futures:
+        future.cancel()
@@ -0,0 +1,139 @@
+import copy
+import uuid
+import random
+import asyncio
+
+import pytest
+
+from cuvette.settings import Settings
+from cuvette.machine import Machine
+from cuvette.utils.matcher import compile_query
+
+CLAIMANTS = 200
+
+# Same filter Pipeline.reserve claims ready machines with
+READY_FILTER = {'$and': [{'cpu-arch': 'x86_64'}, {'status': 'ready', 'tasks': {}}]}
+
+
+class MemoryCollection(object):
+    """
+    Machine collection in memory, other calls run between a document being
+    found and updated, the update is only applied if the document still
+    matches, like MongoDB does on a write conflict
+    """
+    def __init__(self, documents):
+        self.documents = documents
+
+    async def find_one(self, query):
+        await asyncio.sleep(random.random() / 1000)
+        match = compile_query(query)
+        for document in self.documents:
+            if match(document):
+                return copy.deepcopy(document)
+        return None
+
+    async def find_one_and_update(self, query, update, return_document=None):
+        match = compile_query(query)
+        for document in self.documents:
+            if not match(document):
+                continue
+            await asyncio.sleep(random.random() / 1000)
+            if not match(document):
+                continue
+            machine = Machine(None, document)
+            for key, value in update['$set'].items():
+                machine._apply_local('$set', key, value)
+            document.update(machine)
+            return copy.deepcopy(document)
+        return None
+
+
+def make_machines(number):
+    return [{
+        'magic': str(uuid.uuid1()),
+        'hostname': 'host-{}.example.com'.format(index),
+        'cpu-arch': 'x86_64',
+        'status': 'ready',
+        'tasks': {},
+        'meta': {},
+    } for index in range(number)]
+
+
+async def reserve(db, pool, count=1):
+    reservation = str(uuid.uuid1())
+    return await Machine.claim(db, READY_FILTER, {
+        'status': 'reserved',
+        'reservation': reservation,
+        'tasks.{}'.format(reservation): {'query': {}, 'type': 'reserve', 'status': 'pending'},
+    }, count, pool=pool)
+
+
+async def find_then_reserve(db, pool, count=1):
+    """
+    Claim without making the update conditional, machines could be taken twice
+    """
+    reservation = str(uuid.uuid1())
+    document = await pool.find_one(READY_FILTER)
+    if document is None:
+        return []
+    return await Machine.claim(db, {'magic': document['magic']}, {
+        'status': 'reserved',
+        'reservation': reservation,
+    }, pool=pool)
+
+
+async def stress(db, pool, count=1, reserve=reserve):
+    results = await asyncio.gather(*[reserve(db, pool, count) for _ in range(CLAIMANTS)])
+    return [machine for machines in results for machine in machines]
+
+
+def test_one_machine_one_winner(loop):
+    documents = make_machines(1)
+    claimed = loop.run_until_complete(stress(None, MemoryCollection(documents)))
+    assert len(claimed) == 1
+    assert claimed[0]['magic'] == documents[0]['magic']
+    assert documents[0]['status'] == 'reserved'
+    assert list(documents[0]['tasks']) == [documents[0]['reservation']]
+
+
+def test_no_double_allocation(loop):
+    documents = make_machines(50)
+    claimed = loop.run_until_complete(stress(None, MemoryCollection(documents), count=3))
+    magics = [machine['magic'] for machine in claimed]
+    assert len(magics) == len(set(magics)) == 50
+    assert all(len(document['tasks']) == 1 for document in documents)
+
+
+def test_interleaved_claims_are_detected(loop):
+    # Make sure claims really interleave in the memory collection
+    claimed = loop.run_until_complete(stress(None, MemoryCollection(make_machines(1)), reserve=find_then_reserve))
+    assert len(claimed) > 1
+
+
+@pytest.fixture
+def collection(loop):
+    pymongo = pytest.importorskip('pymongo')
+    motor_asyncio = pytest.importorskip('motor.motor_asyncio')
+    try:
+        pymongo.MongoClient(Settings.DB_HOST, serverSelectionTimeoutMS=500).admin.command('ping')
+    except pymongo.errors.PyMongoError:
+        pytest.skip('MongoDB is not reachable at {}'.format(Settings.DB_HOST))
+    collection = motor_asyncio.AsyncIOMotorClient(Settings.DB_HOST, io_loop=loop)['cuvette_test']['machines']
+    loop.run_until_complete(collection.drop())
+    yield collection
+    loop.run_until_complete(collection.drop())
+
+
+def test_one_machine_one_winner_mongodb(loop, collection):
+    loop.run_until_complete(collection.insert_many(make_machines(1)))
+    claimed = loop.run_until_complete(stress(collection.database, collection))
+    assert len(claimed) == 1
+    reserved = loop.run_until_complete(collection.find({'status': 'reserved'}).to_list(None))
+    assert [machine['magic'] for machine in reserved] == [claimed[0]['magic']]
+
+
+def test_no_double_allocation_mongodb(loop, collection):
+    loop.run_until_complete(collection.insert_many(make_machines(50)))
+    claimed = loop.run_until_complete(stress(collection.database, collection, count=3))
+    magics = [machine['magic'] for machine in claimed]
+    assert len(magics) == len(set(magics)) == 50
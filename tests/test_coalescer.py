@@ -0,0 +1,76 @@
+import asyncio
+
+import pytest
+
+import cuvette.machine
+import cuvette.pipeline.coalescer
+from cuvette.machine import Machine
+from cuvette.pipeline.coalescer import ProvisionCoalescer
+
+
+class InsertResult(object):
+    def __init__(self, inserted_id):
+        self.inserted_id = inserted_id
+
+
+class MemoryCollection(object):
+    def __init__(self):
+        self.documents = []
+
+    async def insert_one(self, document):
+        self.documents.append(dict(document))
+        return InsertResult(len(self.documents))
+
+
+class FakeProvisioner(object):
+    NAME = 'fake'
+
+
+class FakeProvisionTask(object):
+    """
+    Provision finishes once tests made all machines ready
+    """
+    def __init__(self, machines, query, provisioner):
+        self.machines = machines
+
+    async def run(self):
+        while any(machine['status'] != 'ready' for machine in self.machines):
+            await asyncio.sleep(0.01)
+
+
+@pytest.fixture
+def coalescer(monkeypatch):
+    monkeypatch.setattr(cuvette.machine, 'get_machine_collection', lambda db: MemoryCollection())
+    monkeypatch.setattr(cuvette.pipeline.coalescer, 'ProvisionTask', FakeProvisionTask)
+    coalescer = ProvisionCoalescer(lambda query: (FakeProvisioner, query), window=0.01)
+    yield coalescer
+    Machine.listeners.remove(coalescer.on_machine_write)
+
+
+def test_waiters_get_their_share(loop, coalescer):
+    launched = {}
+
+    async def request(name, count):
+        return await coalescer.join(None, {'cpu-arch': 'x86_64', 'count': count},
+                                    on_launch=lambda machines: launched.setdefault(name, machines))
+
+    async def run():
+        requests = [asyncio.ensure_future(request('first', 1)),
+                    asyncio.ensure_future(request('second', 2))]
+        while len(launched) < 2:
+            await asyncio.sleep(0.01)
+        # The last machine of the flight is ready first
+        for machine in reversed(launched['first'] + launched['second']):
+            machine['status'] = 'ready'
+            coalescer.on_machine_write(machine, False)
+        ret = await asyncio.gather(*requests)
+        await asyncio.sleep(0.02)
+        return ret
+
+    first, second = loop.run_until_complete(run())
+    assert len(launched['first']) == 1
+    assert len(launched['second']) == 2
+    assert first == launched['first']
+    assert sorted(machine['magic'] for machine in second) == sorted(
+        machine['magic'] for machine in launched['second'])
+    assert coalescer.stats['flights'] == 1
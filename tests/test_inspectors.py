@@ -0,0 +1,192 @@
+import re
+import copy
+import datetime
+
+import pytest
+
+import cuvette.machine
+import cuvette.inspectors
+import cuvette.inspectors.host_cache
+import cuvette.tasks.transform
+from cuvette.machine import Machine
+from cuvette.inspectors import perform_check
+from cuvette.inspectors.host_cache import FINGERPRINT_COMMANDS
+from tests.test_machine import MemoryCollection
+
+OUTPUTS = {
+    'cat /proc/sys/kernel/random/boot_id': 'boot-id\n',
+    'cat /etc/machine-id': 'machine-id\n',
+    'lscpu': 'Architecture: x86_64\nVendor ID: GenuineIntel\nModel: 42\n',
+    'cat /proc/cpuinfo': 'processor\t: 0\nflags\t\t: fpu sse avx\n',
+    'cat /proc/meminfo': 'MemTotal: 4096 kB\nHugePages_Total: 16\n',
+}
+
+BATCH_LINE_RE = re.compile(r"^\( (.*) \) 2>/dev/null$")
+
+
+class FakeResult(object):
+    def __init__(self, stdout, exit_status=0):
+        self.stdout = stdout
+        self.stderr = ''
+        self.exit_status = exit_status
+
+
+class FakeConnection(object):
+    """
+    Answer commands with OUTPUTS, batched scripts are executed command
+    by command, every command executed is recorded
+    """
+    def __init__(self, outputs):
+        self.outputs = outputs
+        self.commands = []
+
+    def _execute(self, command):
+        self.commands.append(command)
+        return self.outputs.get(command, '')
+
+    async def run(self, command):
+        if '\n' not in command:
+            return FakeResult(self._execute(command))
+        stdout = []
+        for line in command.splitlines():
+            match = BATCH_LINE_RE.match(line)
+            if match:
+                stdout.append(self._execute(match.group(1)))
+            elif line.startswith('echo '):
+                stdout.append(line[len("echo '"):-1] + '\n')
+            else:
+                marker = line[len("printf '\\n"):].split(' %s', 1)[0]
+                stdout.append('\n' + marker + ' 0\n')
+        return FakeResult(''.join(stdout))
+
+
+class FakeSSHPool(object):
+    def __init__(self, conn):
+        self.conn = conn
+
+    def connection(self, hostname):
+        return self
+
+    async def __aenter__(self):
+        return self.conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
+
+
+class HostCollection(object):
+    def __init__(self):
+        self.hosts = {}
+
+    async def find_one(self, query):
+        host = self.hosts.get(query['hostname'])
+        if host and host['updated'] >= query['updated']['$gte']:
+            return copy.deepcopy(host)
+        return None
+
+    async def update_one(self, query, update, upsert=False):
+        host = self.hosts.setdefault(query['hostname'], {'hostname': query['hostname']})
+        for key, value in update['$set'].items():
+            if key.startswith('facts.'):
+                host.setdefault('facts', {})[key[len('facts.'):]] = copy.deepcopy(value)
+            else:
+                host[key] = copy.deepcopy(value)
+
+
+@pytest.fixture
+def conn(monkeypatch):
+    conn = FakeConnection(OUTPUTS)
+    monkeypatch.setattr(cuvette.inspectors, 'SSHPool', FakeSSHPool(conn))
+    return conn
+
+
+@pytest.fixture
+def hosts(monkeypatch):
+    hosts = HostCollection()
+    monkeypatch.setattr(cuvette.inspectors.host_cache, 'get_host_collection', lambda db: hosts)
+    return hosts
+
+
+@pytest.fixture
+def collection(monkeypatch):
+    collection = MemoryCollection({
+        '_id': 1,
+        'magic': 'magic',
+        'hostname': 'host.example.com',
+        'status': 'ready',
+        'tasks': {},
+        'meta': {},
+        'start_time': datetime.datetime(2017, 1, 1),
+        'lifespan': 3600,
+        'disk-total_size': 100,
+        'disk-number': 1,
+    })
+    monkeypatch.setattr(cuvette.machine, 'get_machine_collection', lambda db: collection)
+    return collection
+
+
+def test_inspected_fields_are_saved(loop, conn, hosts, collection):
+    machine = Machine(None, copy.deepcopy(collection.document))
+    loop.run_until_complete(perform_check(machine))
+
+    document = collection.document
+    assert document['memory-hugepages'] == 16
+    assert document['cpu-arch'] == 'x86_64'
+    assert document['cpu-vendor'] == 'GenuineIntel'
+    assert document['expire_time'] == datetime.datetime(2017, 1, 1, 1)
+    assert document == dict(machine)
+    # Unchanged fields are not sent again
+    assert len(collection.updates) == 1
+    assert 'hostname' not in collection.updates[0]['$set']
+
+
+def batched_commands(conn):
+    return [command for command in conn.commands if command not in FINGERPRINT_COMMANDS]
+
+
+def test_fingerprint_hit_skips_cached_commands(loop, conn, hosts, collection):
+    loop.run_until_complete(perform_check(Machine(None, copy.deepcopy(collection.document))))
+    assert sorted(batched_commands(conn)) == ['cat /proc/cpuinfo', 'cat /proc/meminfo', 'lscpu']
+    assert sorted(output['command'] for output in hosts.hosts['host.example.com']['outputs']) == [
+        'cat /proc/cpuinfo', 'lscpu']
+
+    conn.commands = []
+    loop.run_until_complete(perform_check(Machine(None, copy.deepcopy(collection.document))))
+    # Runtime outputs are always fetched again
+    assert batched_commands(conn) == ['cat /proc/meminfo']
+
+
+def test_cached_facts_are_saved(loop, conn, hosts, collection):
+    loop.run_until_complete(perform_check(Machine(None, copy.deepcopy(collection.document))))
+
+    # A new provision of the same host
+    collection.document = dict(
+        (key, value) for key, value in collection.document.items() if not key.startswith('cpu-'))
+    del collection.document['expire_time']
+    collection.document['start_time'] = datetime.datetime(2017, 1, 2)
+    conn.commands = []
+    machine = Machine(None, copy.deepcopy(collection.document))
+    loop.run_until_complete(perform_check(machine))
+
+    assert 'lscpu' not in conn.commands
+    assert collection.document['cpu-arch'] == 'x86_64'
+    assert collection.document['cpu-model'] == '42'
+    assert collection.document['expire_time'] == datetime.datetime(2017, 1, 2, 1)
+    assert collection.document == dict(machine)
+
+
+def test_reinspect_after_failed_transform_is_saved(loop, monkeypatch, conn, hosts, collection):
+    monkeypatch.setattr(cuvette.tasks.transform, 'SSHPool', cuvette.inspectors.SSHPool)
+    collection.document['memory-hugepages'] = 0
+    # sysctl fails, but some hugepages are reserved
+    conn.outputs = dict(OUTPUTS)
+    conn.outputs['sysctl -w vm.nr_hugepages=32 && cat /proc/sys/vm/nr_hugepages'] = ''
+
+    machine = Machine(None, copy.deepcopy(collection.document))
+    task = cuvette.tasks.transform.TransformTask([machine], {'memory-hugepages': 32})
+    loop.run_until_complete(task.routine())
+
+    assert task.transformed == []
+    assert collection.document['memory-hugepages'] == 16
+    assert collection.document['cpu-arch'] == 'x86_64'
+    assert collection.document == dict(machine)
@@ -0,0 +1,203 @@
+import copy
+import asyncio
+
+import pytest
+
+import cuvette.machine
+from cuvette.machine import Machine, WRITE_STATS
+
+
+class MemoryCollection(object):
+    """
+    Machine collection in memory, records every update sent to it
+    """
+    def __init__(self, document):
+        self.document = copy.deepcopy(document)
+        self.updates = []
+        self.failing = False
+        self.latency = 0
+
+    async def find_one_and_update(self, query, update, return_document=None):
+        await asyncio.sleep(self.latency)
+        if self.failing:
+            raise OSError('Connection lost')
+        self.updates.append(copy.deepcopy(update))
+        machine = Machine(None, copy.deepcopy(self.document))
+        for op, fields in update.items():
+            for key, value in fields.items():
+                machine._apply_local(op, key, value)
+        self.document = dict(machine)
+        return copy.deepcopy(self.document)
+
+
+@pytest.fixture
+def collection(monkeypatch):
+    collection = MemoryCollection({
+        '_id': 1,
+        'magic': 'magic',
+        'hostname': 'host.example.com',
+        'status': 'ready',
+        'tasks': {},
+        'meta': {'beaker-pull_count': 0},
+        'retries': 1,
+    })
+    monkeypatch.setattr(cuvette.machine, 'get_machine_collection', lambda db: collection)
+    return collection
+
+
+@pytest.fixture
+def machine(collection):
+    return Machine(None, copy.deepcopy(collection.document))
+
+
+def test_batch_merges_updates(loop, collection, machine):
+    buffered, flushed = WRITE_STATS['buffered'], WRITE_STATS['flushed']
+
+    async def run():
+        async with machine.batch():
+            await machine.set('meta.beaker-pull_count', 1)
+            await machine.set('meta.beaker-pull_count', 2)
+            await machine.inc('retries')
+            await machine.unset('tasks')
+            # Reads inside the block see new values
+            assert machine['meta']['beaker-pull_count'] == 2
+            assert machine['retries'] == 2
+            assert collection.updates == []
+
+    loop.run_until_complete(run())
+    assert collection.updates == [{
+        '$set': {'meta.beaker-pull_count': 2},
+        '$unset': {'tasks': ''},
+        '$inc': {'retries': 1},
+    }]
+    assert collection.document['meta'] == {'beaker-pull_count': 2}
+    assert 'tasks' not in collection.document
+    assert WRITE_STATS['buffered'] - buffered == 4
+    assert WRITE_STATS['flushed'] - flushed == 1
+
+
+def test_merge_operations_on_same_key(loop, collection, machine):
+    async def run():
+        async with machine.batch():
+            await machine.set('retries', 5)
+            await machine.inc('retries', 2)
+            await machine.unset('meta.beaker-pull_count')
+            await machine.inc('meta.beaker-pull_count', 1)
+
+    loop.run_until_complete(run())
+    assert collection.updates == [{'$set': {'retries': 7, 'meta.beaker-pull_count': 1}}]
+
+
+def test_parent_path_update(loop, collection, machine):
+    async def run():
+        async with machine.batch():
+            await machine.set('meta.beaker-pull_count', 3)
+            # Overwrites the pending child update
+            await machine.set('meta', {'libvirt-domain': 'cuvette-magic'})
+            # Conflicts with the pending parent update, flushed first
+            await machine.set('meta.beaker-job_id', 'J:1')
+
+    loop.run_until_complete(run())
+    assert collection.updates == [
+        {'$set': {'meta': {'libvirt-domain': 'cuvette-magic'}}},
+        {'$set': {'meta.beaker-job_id': 'J:1'}},
+    ]
+    assert collection.document['meta'] == machine['meta'] == {
+        'libvirt-domain': 'cuvette-magic', 'beaker-job_id': 'J:1'}
+
+
+def test_write_behind_window(loop, collection, machine):
+    async def run():
+        machine.write_behind(0.05)
+        for count in range(1, 6):
+            await machine.set('meta.beaker-pull_count', count)
+        assert collection.updates == []
+        await asyncio.sleep(0.1)
+        assert collection.updates == [{'$set': {'meta.beaker-pull_count': 5}}]
+        machine.write_behind(None)
+        await machine.set('status', 'reserved')
+
+    loop.run_until_complete(run())
+    assert len(collection.updates) == 2
+    assert collection.document['status'] == 'reserved'
+
+
+def test_updates_buffered_during_flush_are_kept(loop, collection, machine):
+    collection.latency = 0.05
+
+    async def run():
+        machine.write_behind(60)
+        await machine.set('meta.beaker-pull_count', 1)
+        await machine.inc('retries')
+        flushing = asyncio.ensure_future(machine.flush())
+        await asyncio.sleep(0.01)
+        await machine.set('meta.beaker-pull_count', 2)
+        await machine.inc('retries')
+        await flushing
+        # Response of the first flush doesn't clobber newer local values
+        assert machine['meta']['beaker-pull_count'] == 2
+        assert machine['retries'] == 3
+        assert collection.document['retries'] == 2
+        machine.write_behind(None)
+        await machine.flush()
+
+    loop.run_until_complete(run())
+    assert collection.updates == [
+        {'$set': {'meta.beaker-pull_count': 1}, '$inc': {'retries': 1}},
+        {'$set': {'meta.beaker-pull_count': 2}, '$inc': {'retries': 1}},
+    ]
+    assert collection.document['retries'] == machine['retries'] == 3
+
+
+def test_failed_flush_restores_pending(loop, collection, machine):
+    collection.latency = 0.05
+    collection.failing = True
+
+    async def run():
+        machine.write_behind(60)
+        await machine.set('status', 'reserved')
+        await machine.set('meta.beaker-pull_count', 1)
+        await machine.inc('retries', 2)
+        flushing = asyncio.ensure_future(machine.flush())
+        await asyncio.sleep(0.01)
+        # Newer updates buffered while the failing flush is on its way
+        await machine.set('status', 'ready')
+        await machine.inc('retries')
+        await machine.set('meta', {'beaker-job_id': 'J:2'})
+        with pytest.raises(OSError):
+            await flushing
+        collection.failing = False
+        machine.write_behind(None)
+        await machine.flush()
+
+    loop.run_until_complete(run())
+    # Nothing is lost, newer updates win over restored ones
+    assert collection.updates == [{
+        '$set': {'status': 'ready', 'meta': {'beaker-job_id': 'J:2'}},
+        '$inc': {'retries': 3},
+    }]
+    assert collection.document['status'] == 'ready'
+    assert collection.document['retries'] == 4
+    assert collection.document['meta'] == {'beaker-job_id': 'J:2'}
+
+
+def test_restore_resends_parent_of_newer_update(loop, collection, machine):
+    collection.latency = 0.05
+    collection.failing = True
+
+    async def run():
+        machine.write_behind(60)
+        await machine.set('meta', {'libvirt-domain': 'cuvette-magic'})
+        flushing = asyncio.ensure_future(machine.flush())
+        await asyncio.sleep(0.01)
+        await machine.set('meta.beaker-job_id', 'J:3')
+        with pytest.raises(OSError):
+            await flushing
+        collection.failing = False
+        machine.write_behind(None)
+        await machine.flush()
+
+    loop.run_until_complete(run())
+    assert collection.updates == [
+        {'$set': {'meta': {'libvirt-domain': 'cuvette-magic', 'beaker-job_id': 'J:3'}}},
+    ]
@@ -0,0 +1,156 @@
+import time
+
+import pytest
+
+from cuvette.settings import Settings
+from cuvette.utils.matcher import compile_query, match
+
+DOCS = [
+    {'_id': 0, 'status': 'ready', 'memory-total_size': 4096, 'cpu-flags': ['sse', 'avx', 'vmx'],
+     'meta': {'beaker-pull_count': 3}, 'disks': [{'size': 100}, {'size': 500}]},
+    {'_id': 1, 'status': 'ready', 'memory-total_size': 16384, 'cpu-flags': ['sse', 'avx512'],
+     'meta': {}, 'disks': [{'size': 1000}]},
+    {'_id': 2, 'status': 'reserved', 'memory-total_size': 8192, 'cpu-flags': [], 'tags': None},
+    {'_id': 3, 'status': 'failed', 'memory-total_size': 'unknown', 'cpu-flags': 'sse'},
+    {'_id': 4, 'status': 'ready'},
+]
+
+# Query -> _id of matched documents, as MongoDB returns for DOCS
+CASES = [
+    ({'status': 'ready'}, [0, 1, 4]),
+    ({'status': {'$eq': 'ready'}}, [0, 1, 4]),
+    ({'status': {'$ne': 'ready'}}, [2, 3]),
+    ({'memory-total_size': {'$gte': 8192}}, [1, 2]),
+    ({'memory-total_size': {'$gt': 4096, '$lt': 16384}}, [2]),
+    ({'memory-total_size': {'$lte': 4096}}, [0]),
+    ({'status': {'$in': ['reserved', 'failed']}}, [2, 3]),
+    ({'status': {'$nin': ['reserved', 'failed']}}, [0, 1, 4]),
+    # Scalar is an element of list fields
+    ({'cpu-flags': 'avx'}, [0]),
+    ({'cpu-flags': 'sse'}, [0, 1, 3]),
+    ({'cpu-flags': {'$in': ['avx', 'avx512']}}, [0, 1]),
+    ({'cpu-flags': {'$nin': ['sse']}}, [2, 4]),
+    ({'cpu-flags': {'$ne': 'sse'}}, [2, 4]),
+    ({'cpu-flags': {'$all': ['sse', 'avx']}}, [0]),
+    ({'cpu-flags': {'$all': ['sse']}}, [0, 1, 3]),
+    # Whole list equality
+    ({'cpu-flags': ['sse', 'avx512']}, [1]),
+    ({'cpu-flags': []}, [2]),
+    # Null matches missing fields too
+    ({'tags': None}, [0, 1, 2, 3, 4]),
+    ({'cpu-flags': None}, [4]),
+    ({'cpu-flags': {'$in': [None, 'vmx']}}, [0, 4]),
+    ({'cpu-flags': {'$nin': [None]}}, [0, 1, 2, 3]),
+    ({'tags': {'$exists': True}}, [2]),
+    ({'tags': {'$exists': False}}, [0, 1, 3, 4]),
+    ({'memory-total_size': {'$exists': True}, 'status': 'ready'}, [0, 1]),
+    # Nested paths, walking into lists of documents
+    ({'meta.beaker-pull_count': 3}, [0]),
+    ({'meta.beaker-pull_count': {'$exists': False}}, [1, 2, 3, 4]),
+    ({'meta.beaker-pull_count': None}, [1, 2, 3, 4]),
+    ({'disks.size': 500}, [0]),
+    ({'disks.size': {'$gte': 1000}}, [1]),
+    ({'disks.size': {'$all': [100, 500]}}, [0]),
+    ({'disks.0.size': 100}, [0]),
+    ({'disks.1.size': {'$exists': True}}, [0]),
+    # Values of different types never match
+    ({'memory-total_size': {'$gt': 0}}, [0, 1, 2]),
+    ({'memory-total_size': {'$lt': 'z'}}, [3]),
+    # Logical operators
+    ({'$and': [{'status': 'ready'}, {'cpu-flags': 'avx'}]}, [0]),
+    ({'$or': [{'status': 'failed'}, {'memory-total_size': 16384}]}, [1, 3]),
+    ({'$nor': [{'status': 'ready'}, {'cpu-flags': 'sse'}]}, [2]),
+    ({'$and': [{'status': 'ready'}, {'$nor': [{'memory-total_size': {'$gte': 8192}}]}]}, [0, 4]),
+]
+
+
+def matched(query):
+    test = compile_query(query)
+    return [doc['_id'] for doc in DOCS if test(doc)]
+
+
+@pytest.mark.parametrize('query, expected', CASES)
+def test_match(query, expected):
+    assert matched(query) == expected
+
+
+def test_plan_is_shared_by_query_shape():
+    assert matched({'memory-total_size': {'$gte': 8192}}) == [1, 2]
+    assert matched({'memory-total_size': {'$gte': 16384}}) == [1]
+    assert match(DOCS[0], {'memory-total_size': {'$gte': 4096}})
+
+
+@pytest.mark.parametrize('query', [
+    {'$not': {'status': 'ready'}},
+    {'$where': 'this.status == "ready"'},
+    {'status': {'$regex': '^re'}},
+    {'$or': [{'cpu-flags': {'$size': 2}}]},
+])
+def test_unsupported_operation(query):
+    with pytest.raises(RuntimeError):
+        compile_query(query)
+
+
+@pytest.fixture(scope='module')
+def mongodb():
+    pymongo = pytest.importorskip('pymongo')
+    client = pymongo.MongoClient(Settings.DB_HOST, serverSelectionTimeoutMS=500)
+    try:
+        client.admin.command('ping')
+    except pymongo.errors.PyMongoError:
+        pytest.skip('MongoDB is not reachable at {}'.format(Settings.DB_HOST))
+    return client['cuvette_test']
+
+
+@pytest.fixture
+def collection(mongodb):
+    collection = mongodb['matcher']
+    collection.drop()
+    yield collection
+    collection.drop()
+
+
+@pytest.mark.parametrize('query, expected', CASES)
+def test_mongodb_parity(collection, query, expected):
+    collection.insert_many(DOCS)
+    assert sorted(doc['_id'] for doc in collection.find(query)) == matched(query) == expected
+
+
+def make_machines(number):
+    return [{
+        '_id': index,
+        'status': ['ready', 'reserved', 'failed'][index % 3],
+        'memory-total_size': 1024 * (index % 32),
+        'cpu-flags': ['sse', 'avx'] if index % 2 else ['sse'],
+        'disk-total_size': index % 500,
+    } for index in range(number)]
+
+
+BENCHMARK_QUERY = {
+    'status': 'ready',
+    'memory-total_size': {'$gte': 8192},
+    'cpu-flags': {'$all': ['avx']},
+    'disk-total_size': {'$in': list(range(0, 500, 2))},
+}
+
+
+def test_benchmark(collection):
+    """
+    Match thousands of cached machines in memory against the same
+    find on MongoDB, run with -s to see the numbers
+    """
+    machines = make_machines(5000)
+    collection.insert_many(machines)
+
+    started = time.perf_counter()
+    test = compile_query(BENCHMARK_QUERY)
+    in_memory = [machine['_id'] for machine in machines if test(machine)]
+    matcher_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    found = sorted(doc['_id'] for doc in collection.find(BENCHMARK_QUERY, projection=['_id']))
+    find_time = time.perf_counter() - started
+
+    print('\nMatched {} of {} machines, compiled matcher: {:.2f}ms, find: {:.2f}ms'.format(
+        len(in_memory), len(machines), matcher_time * 1000, find_time * 1000))
+    assert in_memory == found
@@ -0,0 +1,25 @@
+import pytest
+
+from cuvette.utils.exceptions import ValidateError
+
+views = pytest.importorskip('cuvette.views.tickets')
+
+
+@pytest.mark.parametrize('version', ['abc', '1.5', '', {'$gt': 1}, None])
+def test_invalid_version(version):
+    with pytest.raises(ValidateError):
+        views.parse_version(version)
+
+
+@pytest.mark.parametrize('timeout', ['abc', 'nan', '-1', {'$gt': 1}])
+def test_invalid_timeout(timeout):
+    with pytest.raises(ValidateError):
+        views.parse_timeout(timeout)
+
+
+def test_parse():
+    assert views.parse_version('3') == 3
+    assert views.parse_version(-1, 'Last-Event-ID') == -1
+    assert views.parse_timeout() == views.LONG_POLL_TIMEOUT
+    assert views.parse_timeout('0.5') == 0.5
+    assert views.parse_timeout('inf') == views.MAX_LONG_POLL_TIMEOUT
@@ -0,0 +1,58 @@
+import copy
+
+import pytest
+
+from cuvette.machine import Machine
+from cuvette.tickets import TicketBoard
+
+
+class MemoryCollection(object):
+    def __init__(self):
+        self.documents = {}
+
+    async def create_index(self, *args, **kwargs):
+        pass
+
+    async def replace_one(self, query, document, upsert=False):
+        self.documents[query['_id']] = copy.deepcopy(document)
+
+    async def find_one(self, query):
+        return copy.deepcopy(self.documents.get(query['_id']))
+
+
+class FakeDB(object):
+    def __init__(self):
+        self.tickets = MemoryCollection()
+
+
+@pytest.fixture
+def boards():
+    """
+    Create ticket boards, their machine listeners are removed after the test
+    """
+    created = []
+
+    def create():
+        created.append(TicketBoard())
+        return created[-1]
+
+    yield create
+    for board in created:
+        Machine.listeners.remove(board.on_machine_write)
+
+
+def test_result_survives_restart(loop, boards):
+    db = FakeDB()
+    board = boards()
+    machine = Machine(db, {'_id': 1, 'magic': 'magic', 'hostname': 'host.example.com', 'status': 'reserved'})
+
+    async def run():
+        ticket = await board.create(db)
+        await board.update(db, ticket, 'ready', machines=[machine])
+        # A new process only has the saved ticket
+        return await boards().get(db, ticket['_id'])
+
+    ticket = loop.run_until_complete(run())
+    assert ticket['status'] == 'ready'
+    assert ticket['result'] == [dict(machine)]
+    assert ticket['machines'] == {'magic': {'status': 'reserved', 'hostname': 'host.example.com'}}